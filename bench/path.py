@@ -0,0 +1,3 @@
+import os.path
+
+src_path = os.path.abspath('../src/py3/')
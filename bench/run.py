@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+'''Run the benchmarks and compare the results with a baseline.
+
+Most benchmarks report rates where higher is better. Durations in
+seconds and counts of threads are better when lower. Results are written
+as JSON so that runs can be compared::
+
+    python3 run.py --output baseline.json
+    python3 run.py --baseline baseline.json
+
+The exit status is 1 if a result got worse by more than the threshold.
+'''
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import os
+import os.path
+import path
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, path.src_path)
+
+from bytestag.dht.models import NodeList
+from bytestag.dht.network import DHTNetwork
+from bytestag.dht.tables import RoutingTable, Node, BucketFullError
+from bytestag.events import EventReactor
+from bytestag.keys import KeyBytes
+from bytestag.lib.bencode import bencode, bdecode
+from bytestag.network import (Network, UDPServer, BatchUDPServer,
+    UDP_INBOUND_EVENT)
+from bytestag.storage import (DatabaseKVPTable, SharedFilesKVPTable,
+    SharedFilesHashTask, MemoryKVPTable)
+from bytestag.tables import KVPID
+
+BENCHMARKS = collections.OrderedDict()
+LOWER_IS_BETTER_UNITS = ('s', 'threads')
+STARTUP_SCRIPT = '''
+import json
+import tempfile
+import threading
+import time
+
+start_time = time.perf_counter()
+
+from bytestag.client import Client
+
+import_time = time.perf_counter() - start_time
+
+with tempfile.TemporaryDirectory() as dir_name:
+    start_time = time.perf_counter()
+    client = Client(dir_name, address=('127.0.0.1', 0))
+    init_time = time.perf_counter() - start_time
+
+    print(json.dumps([import_time, init_time, threading.active_count()]))
+'''
+
+
+def benchmark(name):
+    '''Register a benchmark function.
+
+    The function accepts the ``scale`` and ``repeat`` and returns a list
+    of ``(name, value, unit)``.
+    '''
+
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+
+        return fn
+
+    return decorator
+
+
+def best_rate(fn, count, repeat):
+    '''Return the best of the counts per second of calling a function.'''
+
+    best_duration = None
+
+    for dummy in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        duration = time.perf_counter() - start_time
+
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+
+    return count / max(best_duration, 1e-9)
+
+
+def random_key(random_obj):
+    return KeyBytes(bytes(random_obj.getrandbits(8) for dummy in range(20)))
+
+
+def random_nodes(random_obj, count):
+    return [Node(random_key(random_obj),
+        ('10.0.{}.{}'.format(i >> 8 & 0xff, i & 0xff), 38664))
+        for i in range(count)]
+
+
+@benchmark('codec')
+def bench_codec(scale, repeat):
+    random_obj = random.Random(1)
+    event_reactor = EventReactor()
+    network = Network(event_reactor)
+    node_list = NodeList(random_nodes(random_obj, 20))
+    packet_dict = {'rpc': 'find_node', 'key': random_key(random_obj).base64,
+        'nodes': node_list.to_json_dumpable(), 'seq_id': 123456}
+    data = network._pack_udp_data(packet_dict)
+    count = 2000 * scale
+
+    def pack():
+        for dummy in range(count):
+            network._pack_udp_data(packet_dict)
+
+    def unpack():
+        for dummy in range(count):
+            network._unpack_udp_data(data)
+
+    return [
+        ('pack', best_rate(pack, count, repeat), 'packets/s'),
+        ('unpack', best_rate(unpack, count, repeat), 'packets/s'),
+    ]
+
+
+@benchmark('keys')
+def bench_keys(scale, repeat):
+    random_obj = random.Random(2)
+    keys = [random_key(random_obj) for dummy in range(1000)]
+    target_key = random_key(random_obj)
+    node_list = NodeList(random_nodes(random_obj, 200))
+    count = 20 * scale
+
+    def distance_int():
+        for dummy in range(count):
+            for key in keys:
+                key.distance_int(target_key)
+
+    def sort_distance():
+        for dummy in range(count):
+            node_list.sort_distance(target_key)
+
+    return [
+        ('distance_int', best_rate(distance_int, count * len(keys), repeat),
+            'ops/s'),
+        ('sort_distance_200', best_rate(sort_distance, count, repeat),
+            'sorts/s'),
+    ]
+
+
+@benchmark('routing')
+def bench_routing(scale, repeat):
+    random_obj = random.Random(3)
+    nodes = random_nodes(random_obj, 2000 * scale)
+    target_keys = [random_key(random_obj) for dummy in range(200 * scale)]
+    routing_table = RoutingTable(random_key(random_obj))
+
+    def node_update():
+        for node in nodes:
+            try:
+                routing_table.node_update(node)
+            except BucketFullError:
+                pass
+
+    def get_close_nodes():
+        for key in target_keys:
+            routing_table.get_close_nodes(key, 8)
+
+    event_reactor = EventReactor()
+    dht_network = DHTNetwork(event_reactor, MemoryKVPTable(),
+        network=Network(event_reactor))
+
+    for node in nodes:
+        try:
+            dht_network.routing_table.node_update(node)
+        except BucketFullError:
+            pass
+
+    close_node_lists = [dht_network.routing_table.get_close_nodes(key, 20)
+        for key in target_keys]
+
+    def encode_node_list():
+        for close_nodes in close_node_lists:
+            dht_network._node_list_dumpable(close_nodes)
+
+    return [
+        ('node_update', best_rate(node_update, len(nodes), repeat),
+            'ops/s'),
+        ('get_close_nodes', best_rate(get_close_nodes, len(target_keys),
+            repeat), 'ops/s'),
+        ('encode_node_list_20', best_rate(encode_node_list,
+            len(close_node_lists), repeat), 'ops/s'),
+    ]
+
+
+@benchmark('storage')
+def bench_storage(scale, repeat):
+    count = 500 * scale
+    values = [os.urandom(1024) for dummy in range(count)]
+    kvpids = [KVPID(KeyBytes(), KeyBytes.new_hash(value))
+        for value in values]
+    results = []
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        kvp_table = DatabaseKVPTable(os.path.join(dir_name, 'bench.db'))
+
+        def set_():
+            for kvpid, value in zip(kvpids, values):
+                kvp_table[kvpid] = value
+
+        def get():
+            for kvpid in kvpids:
+                kvp_table[kvpid]
+
+        def contains():
+            for kvpid in kvpids:
+                kvpid in kvp_table
+
+        def record():
+            for kvpid in kvpids:
+                kvp_table.record(kvpid).timestamp
+
+        for name, fn in (('set', set_), ('get', get), ('contains', contains),
+        ('record', record)):
+            results.append((name, best_rate(fn, count, repeat), 'ops/s'))
+
+        if hasattr(kvp_table, 'close'):
+            kvp_table.close()
+
+    return results
+
+
+@benchmark('hashing')
+def bench_hashing(scale, repeat):
+    size = 2 ** 24 * scale
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        shared_dir = os.path.join(dir_name, 'shared')
+        os.mkdir(shared_dir)
+
+        with open(os.path.join(shared_dir, 'file.bin'), 'wb') as f:
+            for dummy in range(size // 2 ** 20):
+                f.write(os.urandom(2 ** 20))
+
+        def hash_files():
+            db_path = os.path.join(dir_name, 'shared.db')
+
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+            kvp_table = SharedFilesKVPTable(db_path)
+            kvp_table.shared_directories.append(shared_dir)
+            SharedFilesHashTask(kvp_table)()
+
+        return [
+            ('shared_files', best_rate(hash_files, size / 2 ** 20, repeat),
+                'MB/s'),
+        ]
+
+
+@benchmark('bencode')
+def bench_bencode(scale, repeat):
+    random_obj = random.Random(4)
+    obj = {
+        b'announce': b'http://example.com/announce',
+        b'info': {
+            b'name': b'example',
+            b'piece length': 2 ** 18,
+            b'pieces': bytes(random_obj.getrandbits(8)
+                for dummy in range(20 * 200)),
+            b'files': [{b'length': i * 1000, b'path': [b'dir',
+                'file{}'.format(i).encode()]} for i in range(50)],
+        },
+    }
+    data = bencode(obj)
+    count = 200 * scale
+
+    def encode():
+        for dummy in range(count):
+            bencode(obj)
+
+    def decode():
+        for dummy in range(count):
+            bdecode(data)
+
+    return [
+        ('encode', best_rate(encode, count, repeat), 'ops/s'),
+        ('decode', best_rate(decode, count, repeat), 'ops/s'),
+    ]
+
+
+@benchmark('transfer')
+def bench_transfer(scale, repeat):
+    size = 2 ** 22 * scale
+    data = os.urandom(size)
+    data_hash = hashlib.sha1(data).digest()
+    event_reactors = [EventReactor(), EventReactor()]
+    threads = []
+
+    for event_reactor in event_reactors:
+        thread = threading.Thread(target=event_reactor.start)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    networks = [Network(event_reactor) for event_reactor in event_reactors]
+
+    def transfer():
+        transfer_id = 'bench{}'.format(time.time())
+        download_task = networks[1].expect_incoming_transfer(transfer_id)
+        networks[0].send_bytes(networks[1].server_address, transfer_id,
+            data).result()
+        f = download_task.result()
+        f.seek(0)
+
+        assert hashlib.sha1(f.read()).digest() == data_hash
+
+    try:
+        return [
+            ('send_bytes', best_rate(transfer, size / 2 ** 20, repeat),
+                'MB/s'),
+        ]
+    finally:
+        for event_reactor in event_reactors:
+            event_reactor.put(EventReactor.STOP_ID)
+
+        for thread in threads:
+            thread.join(5)
+
+
+def receive_rate(server_class, count, repeat):
+    '''Return the datagrams per second a server hands to the reactor.'''
+
+    event_reactor = EventReactor(max_queue_size=count + 1)
+    server = server_class(event_reactor)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = os.urandom(200)
+    received = threading.Semaphore(0)
+
+    event_reactor.register_handler(UDP_INBOUND_EVENT,
+        lambda event_id, address, data: received.release())
+
+    reactor_thread = threading.Thread(target=event_reactor.start)
+    reactor_thread.daemon = True
+    reactor_thread.start()
+    server.start()
+
+    def flood():
+        num_received = 0
+
+        # Send in bursts so the socket buffer does not overflow
+        for dummy in range(count // 100):
+            for dummy in range(100):
+                client.sendto(data, server.server_address)
+
+            for dummy in range(100):
+                if not received.acquire(timeout=1):
+                    break
+
+                num_received += 1
+
+        assert num_received == count // 100 * 100
+
+    try:
+        return best_rate(flood, count // 100 * 100, repeat)
+    finally:
+        event_reactor.put(EventReactor.STOP_ID)
+        reactor_thread.join(5)
+        client.close()
+
+
+@benchmark('receive')
+def bench_receive(scale, repeat):
+    count = 20000 * scale
+
+    return [
+        ('udp_server', receive_rate(UDPServer, count, repeat), 'packets/s'),
+        ('batch_udp_server', receive_rate(BatchUDPServer, count, repeat),
+            'packets/s'),
+    ]
+
+
+@benchmark('startup')
+def bench_startup(scale, repeat):
+    env = dict(os.environ, PYTHONPATH=path.src_path)
+    samples = []
+
+    for dummy in range(repeat):
+        start_time = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c',
+            STARTUP_SCRIPT], env=env)
+        process_time = time.perf_counter() - start_time
+
+        samples.append([process_time] + json.loads(output.decode()))
+
+    process_time, import_time, init_time, num_threads = [
+        min(values) for values in zip(*samples)]
+
+    return [
+        ('process', process_time, 's'),
+        ('import_client', import_time, 's'),
+        ('client_init', init_time, 's'),
+        ('client_threads', num_threads, 'threads'),
+    ]
+
+
+def run_benchmarks(names, scale, repeat):
+    results = collections.OrderedDict()
+
+    for name in names:
+        start_time = time.perf_counter()
+
+        for result_name, value, unit in BENCHMARKS[name](scale, repeat):
+            full_name = '{}.{}'.format(name, result_name)
+            results[full_name] = {'value': value, 'unit': unit}
+            print('{:32} {:14.4f} {}'.format(full_name, value, unit))
+
+        print('{:32} ({:.1f}s)'.format('', time.perf_counter() - start_time))
+
+    return results
+
+
+def environment_info():
+    return {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(baseline_doc, results_doc, threshold):
+    '''Print the change of each result.
+
+    :returns: The names of the results that got worse by more than the
+        threshold.
+    '''
+
+    regressions = []
+    baseline = baseline_doc['results']
+
+    print('{:32} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline',
+        'current', 'change'))
+
+    for name, result in results_doc['results'].items():
+        if name not in baseline:
+            print('{:32} {:>14} {:14.4f} {:>8}'.format(name, '-',
+                result['value'], 'new'))
+            continue
+
+        old_value = baseline[name]['value']
+        change = (result['value'] - old_value) / old_value if old_value \
+            else 0
+        marker = ''
+
+        if result['unit'] in LOWER_IS_BETTER_UNITS:
+            is_regression = change > threshold
+        else:
+            is_regression = change < -threshold
+
+        if is_regression:
+            regressions.append(name)
+            marker = ' REGRESSION'
+
+        print('{:32} {:14.4f} {:14.4f} {:+7.1%}{}'.format(name, old_value,
+            result['value'], change, marker))
+
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    arg_parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS),
+        default=list(BENCHMARKS), help='benchmarks to run')
+    arg_parser.add_argument('--scale', default=1, type=int,
+        help='multiplier of the amount of work')
+    arg_parser.add_argument('--repeat', default=3, type=int,
+        help='the best of this many runs is reported')
+    arg_parser.add_argument('--output', help='write the results to a file')
+    arg_parser.add_argument('--baseline',
+        help='compare with the results in a file')
+    arg_parser.add_argument('--results',
+        help='compare the results in a file instead of running')
+    arg_parser.add_argument('--threshold', default=0.1, type=float,
+        help='the fraction a result may worsen before it is a regression')
+
+    args = arg_parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            results_doc = json.load(f)
+    else:
+        results_doc = {
+            'environment': environment_info(),
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'results': run_benchmarks(args.only, args.scale, args.repeat),
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results_doc, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_doc = json.load(f)
+
+        print()
+
+        if compare(baseline_doc, results_doc, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
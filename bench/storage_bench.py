@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+'''Benchmark the cache KVPTable backends with small and large values.'''
+
+import argparse
+import os
+import os.path
+import path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, path.src_path)
+
+from bytestag.keys import KeyBytes
+from bytestag.storage import DatabaseKVPTable, LogStructuredKVPTable
+from bytestag.tables import KVPID
+
+
+BACKENDS = {
+    'database': lambda path: DatabaseKVPTable(path),
+    'log': lambda path: LogStructuredKVPTable(path, compact_interval=None),
+}
+
+
+def timed(fn, *args):
+    start_time = time.perf_counter()
+    fn(*args)
+
+    return time.perf_counter() - start_time
+
+
+def run_backend(name, value_size, count):
+    temp_dir = tempfile.TemporaryDirectory()
+    kvp_table = BACKENDS[name](os.path.join(temp_dir.name, 'bench.db'))
+    values = [os.urandom(value_size) for dummy in range(count)]
+    kvpids = [KVPID(KeyBytes(), KeyBytes.new_hash(value))
+        for value in values]
+
+    def write():
+        for kvpid, value in zip(kvpids, values):
+            kvp_table[kvpid] = value
+
+    def read():
+        for kvpid in kvpids:
+            kvp_table[kvpid]
+
+    def delete():
+        for kvpid in kvpids[::2]:
+            del kvp_table[kvpid]
+
+        if hasattr(kvp_table, 'compact'):
+            kvp_table.compact()
+
+    results = {
+        'write': timed(write),
+        'read': timed(read),
+        'overwrite': timed(write),
+        'delete': timed(delete),
+        'disk_size': kvp_table.database_size,
+    }
+
+    if hasattr(kvp_table, 'close'):
+        kvp_table.close()
+
+    temp_dir.cleanup()
+
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--count-small', default=2000, type=int,
+        help='number of 1 KB values')
+    arg_parser.add_argument('--count-large', default=50, type=int,
+        help='number of 1 MB values')
+    arg_parser.add_argument('--backend', nargs='*',
+        default=sorted(BACKENDS), choices=sorted(BACKENDS),
+        help='backends to run')
+
+    args = arg_parser.parse_args()
+
+    print('{:10} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'backend', 'size', 'count', 'write', 'read', 'overwrite', 'delete',
+        'disk bytes'))
+
+    for value_size, count in ((2 ** 10, args.count_small),
+    (2 ** 20, args.count_large)):
+        for name in args.backend:
+            results = run_backend(name, value_size, count)
+
+            print('{:10} {:8} {:6} {:10.4f} {:10.4f} {:10.4f} {:10.4f} '
+                '{:12}'.format(name, value_size, count, results['write'],
+                results['read'], results['overwrite'], results['delete'],
+                results['disk_size']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+'''Simulate a network of many nodes in one process.
+
+No real network or display is needed. Latency is simulated by a virtual
+clock so it costs no real time.
+'''
+
+import argparse
+import json
+import logging
+import path
+import sys
+
+sys.path.insert(0, path.src_path)
+
+from bytestag.simulation import Simulation
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--log-level', default='WARNING', type=str,
+        help='Python log level')
+    arg_parser.add_argument('--nodes', default=100, type=int,
+        help='number of nodes')
+    arg_parser.add_argument('--lookups', default=100, type=int,
+        help='number of node lookups of random keys')
+    arg_parser.add_argument('--values', default=0, type=int,
+        help='number of values published and then looked up')
+    arg_parser.add_argument('--value-size', default=1024, type=int,
+        help='size in bytes of the published values')
+    arg_parser.add_argument('--latency', default=0.05, type=float,
+        help='one way latency in seconds')
+    arg_parser.add_argument('--jitter', default=0, type=float,
+        help='maximum random latency added in seconds')
+    arg_parser.add_argument('--loss', default=0, type=float,
+        help='probability of a datagram being lost')
+    arg_parser.add_argument('--bandwidth', type=int,
+        help='uplink bytes per second of each node')
+    arg_parser.add_argument('--parallelism', default=16, type=int,
+        help='number of operations run at the same time')
+    arg_parser.add_argument('--seed', type=int,
+        help='random seed')
+    arg_parser.add_argument('--json', default=False, action='store_true',
+        help='print the reports as JSON')
+
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    with Simulation(latency=args.latency, jitter=args.jitter,
+    loss=args.loss, bandwidth=args.bandwidth, seed=args.seed) as simulation:
+        simulation.add_nodes(args.nodes)
+        simulation.bootstrap(parallelism=args.parallelism * 2)
+
+        if args.lookups:
+            simulation.run_lookups(args.lookups,
+                parallelism=args.parallelism)
+
+        if args.values:
+            simulation.publish(args.values, size=args.value_size,
+                parallelism=args.parallelism)
+            simulation.run_value_lookups(args.values,
+                parallelism=args.parallelism)
+
+        if args.json:
+            print(json.dumps([report.to_dict()
+                for report in simulation.reports], indent=2))
+        else:
+            print(simulation.format_report())
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ This software is currently under development.
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-import distutils.version
+import re
 
 __docformat__ = 'restructuredtext en'
 short_version = '0.2'  # N.N
@@ -19,4 +19,5 @@ __version__ = '0.3a1'  # N.N[.N]+[{a|b|c|rc}N[.N]+][.postN][.devN]
 description, long_description = __doc__.split('\n', 1)
 long_description = long_description.lstrip()
 
-distutils.version.StrictVersion(__version__)
+if not re.match(r'^\d+\.\d+(\.\d+)?([ab]\d+)?$', __version__):
+    raise ValueError('Invalid version {}'.format(__version__))
@@ -0,0 +1,304 @@
+'''Bandwidth rate limiting'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+import collections
+import logging
+import threading
+import time
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+
+class TrafficClasses(object):
+    '''Classes of transfers that can be limited separately'''
+
+    PUBLISH = 'publish'
+    REPLICATE = 'replicate'
+    DOWNLOAD = 'download'
+
+
+class RateMeter(object):
+    '''Measures the recent rate of bytes transferred.'''
+
+    def __init__(self, window=5, clock=time.monotonic):
+        '''
+        :param window: The number of seconds averaged.
+        '''
+
+        self._window = window
+        self._clock = clock
+        self._counts = collections.deque()
+        self._total = 0
+
+    def add(self, amount):
+        second = int(self._clock())
+
+        if self._counts and self._counts[-1][0] == second:
+            self._counts[-1][1] += amount
+        else:
+            self._counts.append([second, amount])
+
+        self._total += amount
+        self._expire(second)
+
+    def _expire(self, second):
+        while self._counts and self._counts[0][0] <= second - self._window:
+            self._total -= self._counts.popleft()[1]
+
+    @property
+    def rate(self):
+        '''The average bytes per second over the window.'''
+
+        self._expire(int(self._clock()))
+
+        return self._total / self._window
+
+
+class TokenBucket(object):
+    '''A token bucket.
+
+    Transfers reserve tokens and may put the bucket into debt. The debt is
+    returned as the time to wait before the transfer should proceed so
+    several buckets can be combined by waiting for the largest delay.
+    '''
+
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        '''
+        :param rate: The bytes per second allowed. If ``None``, the bucket
+            is unlimited.
+        :param burst: The size of the bucket in bytes. The default is one
+            second of `rate`.
+        '''
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._meter = RateMeter(clock=clock)
+        self._rate = None
+        self._burst = None
+        self._tokens = 0
+        self._last_time = clock()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        '''The bytes per second allowed or ``None`` if unlimited.'''
+
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        self.set_rate(rate)
+
+    @property
+    def current_rate(self):
+        '''The bytes per second recently transferred.'''
+
+        with self._lock:
+            return self._meter.rate
+
+    @property
+    def is_idle(self):
+        '''Whether the bucket is full and nothing was transferred recently.
+        '''
+
+        with self._lock:
+            self._refill()
+
+            return not self._meter.rate and (not self._rate
+                or self._tokens >= self._burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            was_limited = self._rate
+            self._rate = rate
+            self._burst = burst or rate
+
+            if rate and was_limited:
+                self._tokens = min(self._tokens, self._burst)
+            elif rate:
+                self._tokens = self._burst
+            else:
+                self._tokens = 0
+
+    def _refill(self):
+        now = self._clock()
+
+        if self._rate:
+            self._tokens = min(self._burst,
+                self._tokens + (now - self._last_time) * self._rate)
+
+        self._last_time = now
+
+    def reserve(self, amount):
+        '''Take tokens for a transfer.
+
+        :returns: The seconds to wait before the transfer.
+        '''
+
+        with self._lock:
+            self._meter.add(amount)
+
+            if not self._rate:
+                return 0
+
+            self._refill()
+            self._tokens -= amount
+
+            if self._tokens >= 0:
+                return 0
+
+            return -self._tokens / self._rate
+
+
+class BandwidthLimiter(object):
+    '''Limits the bandwidth of one direction of transfers.
+
+    Each transfer is counted against a global bucket, a bucket for the
+    peer address, and a bucket for the :class:`TrafficClasses`.
+    '''
+
+    MAX_PEERS = 1024
+
+    def __init__(self, rate=None, peer_rate=None, class_rates=None,
+    clock=time.monotonic):
+        '''
+        :param rate: The total bytes per second or ``None``.
+        :param peer_rate: The bytes per second of each peer or ``None``.
+        :param class_rates: A ``dict`` mapping traffic classes to bytes
+            per second.
+        '''
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(rate, clock=clock)
+        self._peer_rate = peer_rate
+        self._peer_buckets = collections.OrderedDict()
+        self._class_buckets = {}
+
+        for traffic_class, class_rate in (class_rates or {}).items():
+            self.set_class_rate(traffic_class, class_rate)
+
+    @property
+    def rate(self):
+        '''The total bytes per second allowed or ``None``.'''
+
+        return self._bucket.rate
+
+    @rate.setter
+    def rate(self, rate):
+        self._bucket.rate = rate
+
+    @property
+    def peer_rate(self):
+        '''The bytes per second allowed for each peer or ``None``.'''
+
+        return self._peer_rate
+
+    @peer_rate.setter
+    def peer_rate(self, rate):
+        with self._lock:
+            self._peer_rate = rate
+
+            for bucket in self._peer_buckets.values():
+                bucket.rate = rate
+
+    def class_rate(self, traffic_class):
+        '''Return the bytes per second allowed for a traffic class.'''
+
+        bucket = self._class_buckets.get(traffic_class)
+
+        if bucket:
+            return bucket.rate
+
+    def set_class_rate(self, traffic_class, rate):
+        '''Set the bytes per second allowed for a traffic class.'''
+
+        with self._lock:
+            if traffic_class in self._class_buckets:
+                self._class_buckets[traffic_class].rate = rate
+            else:
+                self._class_buckets[traffic_class] = TokenBucket(rate,
+                    clock=self._clock)
+
+    def _get_peer_bucket(self, address):
+        with self._lock:
+            bucket = self._peer_buckets.get(address)
+
+            if bucket:
+                self._peer_buckets.move_to_end(address)
+                return bucket
+
+            while len(self._peer_buckets) >= BandwidthLimiter.MAX_PEERS:
+                old_address, old_bucket = next(iter(
+                    self._peer_buckets.items()))
+
+                if not old_bucket.is_idle:
+                    break
+
+                del self._peer_buckets[old_address]
+
+            bucket = TokenBucket(self._peer_rate, clock=self._clock)
+            self._peer_buckets[address] = bucket
+
+            return bucket
+
+    def _get_class_bucket(self, traffic_class):
+        with self._lock:
+            bucket = self._class_buckets.get(traffic_class)
+
+            if not bucket:
+                bucket = TokenBucket(clock=self._clock)
+                self._class_buckets[traffic_class] = bucket
+
+            return bucket
+
+    def reserve(self, amount, address=None, traffic_class=None):
+        '''Count a transfer against the limits.
+
+        :returns: The seconds to wait before the transfer.
+        '''
+
+        delay = self._bucket.reserve(amount)
+
+        if address:
+            delay = max(delay, self._get_peer_bucket(address).reserve(amount))
+
+        if traffic_class:
+            delay = max(delay,
+                self._get_class_bucket(traffic_class).reserve(amount))
+
+        return delay
+
+    def throttle(self, amount, address=None, traffic_class=None):
+        '''Count a transfer and sleep until it may proceed.'''
+
+        delay = self.reserve(amount, address, traffic_class)
+
+        if delay:
+            _logger.debug('Throttle %s %s delay=%s', address, traffic_class,
+                delay)
+            time.sleep(delay)
+
+    def stats(self):
+        '''Return the limits and current utilisation.
+
+        :rtype: :obj:`dict`
+        '''
+
+        with self._lock:
+            class_buckets = dict(self._class_buckets)
+            num_peers = len(self._peer_buckets)
+
+        return {
+            'rate': self._bucket.rate,
+            'current_rate': self._bucket.current_rate,
+            'peer_rate': self._peer_rate,
+            'num_peers': num_peers,
+            'classes': dict((traffic_class, {
+                'rate': bucket.rate,
+                'current_rate': bucket.current_rate,
+            }) for traffic_class, bucket in class_buckets.items()),
+        }
@@ -0,0 +1,84 @@
+from bytestag.bandwidth import TokenBucket, BandwidthLimiter, RateMeter
+import unittest
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        '''It should never delay without a rate'''
+
+        bucket = TokenBucket()
+
+        self.assertEqual(0, bucket.reserve(10 ** 9))
+
+    def test_rate(self):
+        '''It should delay transfers above the rate'''
+
+        clock = Clock()
+        bucket = TokenBucket(1000, clock=clock)
+
+        self.assertEqual(0, bucket.reserve(1000))
+        self.assertAlmostEqual(0.5, bucket.reserve(500))
+
+        clock.now += 1.5
+
+        self.assertEqual(0, bucket.reserve(1000))
+
+    def test_set_rate(self):
+        '''It should change the rate at runtime'''
+
+        clock = Clock()
+        bucket = TokenBucket(1000, clock=clock)
+        bucket.reserve(1000)
+        bucket.rate = None
+
+        self.assertEqual(0, bucket.reserve(1000))
+
+
+class TestRateMeter(unittest.TestCase):
+    def test_rate(self):
+        '''It should average over the window'''
+
+        clock = Clock()
+        meter = RateMeter(window=5, clock=clock)
+
+        meter.add(1000)
+        clock.now += 1
+        meter.add(4000)
+
+        self.assertEqual(1000, meter.rate)
+
+        clock.now += 10
+
+        self.assertEqual(0, meter.rate)
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+    def test_limits(self):
+        '''It should apply the largest delay of global, peer and class'''
+
+        clock = Clock()
+        limiter = BandwidthLimiter(rate=10000, peer_rate=1000,
+            class_rates={'replicate': 100}, clock=clock)
+
+        self.assertEqual(0, limiter.reserve(100, ('127.0.0.1', 1)))
+        self.assertAlmostEqual(1, limiter.reserve(200, ('127.0.0.1', 2),
+            'replicate'))
+        self.assertAlmostEqual(0.1, limiter.reserve(1000, ('127.0.0.1', 1)))
+        self.assertEqual(0, limiter.reserve(100, ('127.0.0.1', 3),
+            'download'))
+
+        stats = limiter.stats()
+
+        self.assertEqual(10000, stats['rate'])
+        self.assertEqual(3, stats['num_peers'])
+        self.assertEqual(100, stats['classes']['replicate']['rate'])
+        self.assertEqual(200 / 5,
+            stats['classes']['replicate']['current_rate'])
@@ -8,8 +8,10 @@ from bytestag.dht.network import DHTNetwork
 from bytestag.dht.publishing import Publisher, Replicator
 from bytestag.events import EventReactor, FnTaskSlot
 from bytestag.keys import KeyBytes
+from bytestag.metrics import default_registry, MetricsFileWriter
 from bytestag.network import Network
-from bytestag.storage import DatabaseKVPTable, SharedFilesKVPTable
+from bytestag.storage import (DatabaseKVPTable, SharedFilesKVPTable,
+    LogStructuredKVPTable, DistanceEvictionPolicy)
 from bytestag.tables import AggregatedKVPTable
 import atexit
 import logging
@@ -17,19 +19,106 @@ import os.path
 import threading
 import warnings
 
-try:
-    import miniupnpc
-except ImportError as e:
-    warnings.warn(e)
-
-    miniupnpc = None
-
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
 
 
-class Client(threading.Thread):
+def _import_miniupnpc():
+    '''Return the optional miniupnpc module or ``None``.
+
+    The module is imported only when port forwarding is used.
+    '''
+
+    try:
+        import miniupnpc
+    except ImportError as e:
+        warnings.warn(e)
+
+        return None
+
+    return miniupnpc
+
+
+class CacheBackends(object):
+    '''Storage backends for the cache table'''
+
+    DATABASE = 'database'
+    LOG = 'log'
+
+
+class ManagementMixin(object):
+    '''Bandwidth limits and metrics of a running node or host.
+
+    Classes using this mixin provide the ``upload_limiter`` and
+    ``download_limiter`` properties.
+    '''
+
+    _metrics_file_writer = None
+
+    def set_bandwidth_limits(self, upload_rate=None, download_rate=None,
+    peer_upload_rate=None, peer_download_rate=None, class_rates=None):
+        '''Set the bandwidth limits in bytes per second.
+
+        ``None`` means unlimited.
+
+        :param class_rates: A ``dict`` mapping :class:`.TrafficClasses` to
+            a ``tuple`` of the upload and download rates.
+        '''
+
+        self.upload_limiter.rate = upload_rate
+        self.upload_limiter.peer_rate = peer_upload_rate
+        self.download_limiter.rate = download_rate
+        self.download_limiter.peer_rate = peer_download_rate
+
+        for traffic_class, rates in (class_rates or {}).items():
+            self.upload_limiter.set_class_rate(traffic_class, rates[0])
+            self.download_limiter.set_class_rate(traffic_class, rates[1])
+
+    def bandwidth_usage(self):
+        '''Return the bandwidth limits and current utilisation.
+
+        :rtype: :obj:`dict`
+        :see: :func:`.BandwidthLimiter.stats`
+        '''
+
+        return {
+            'upload': self.upload_limiter.stats(),
+            'download': self.download_limiter.stats(),
+        }
+
+    def metrics(self):
+        '''Return a snapshot of the runtime metrics.
+
+        Metrics are process-wide so clients in the same process share them.
+
+        :rtype: :obj:`dict`
+        :see: :func:`.MetricsRegistry.snapshot`
+        '''
+
+        snapshot = default_registry().snapshot()
+        snapshot['bandwidth'] = self.bandwidth_usage()
+
+        return snapshot
+
+    def write_metrics_file(self, path, interval=60):
+        '''Periodically write the metrics in the Prometheus text format.
+
+        :see: :class:`.MetricsFileWriter`
+        '''
+
+        if self._metrics_file_writer:
+            self._metrics_file_writer.stop()
+
+        self._metrics_file_writer = MetricsFileWriter(path, interval)
+        self._metrics_file_writer.start()
+
+    def _stop_metrics_file_writer(self):
+        if self._metrics_file_writer:
+            self._metrics_file_writer.stop()
+
+
+class Client(threading.Thread, ManagementMixin):
     '''Client interface.
 
     :warning: this class is under development.
@@ -37,15 +126,25 @@ class Client(threading.Thread):
 
     def __init__(self, cache_dir, address=('0.0.0.0', 0), node_id=None,
     known_node_address=None, initial_scan=False, config_dir=None,
-    use_port_forwarding=False):
+    use_port_forwarding=False, cache_backend=CacheBackends.DATABASE):
         threading.Thread.__init__(self)
         self.daemon = True
         self.name = '{}.{}'.format(__name__, Client.__name__)
         self._event_reactor = EventReactor()
         self._node_id = node_id or KeyBytes()
         self._network = Network(self._event_reactor, address=address)
-        self._cache_table = DatabaseKVPTable(
-            os.path.join(cache_dir, 'cache.db'))
+
+        eviction_policy = DistanceEvictionPolicy(self._node_id)
+
+        if cache_backend == CacheBackends.LOG:
+            self._cache_table = LogStructuredKVPTable(
+                os.path.join(cache_dir, 'cache_log.db'),
+                eviction_policy=eviction_policy)
+        else:
+            self._cache_table = DatabaseKVPTable(
+                os.path.join(cache_dir, 'cache.db'),
+                eviction_policy=eviction_policy)
+
         self._shared_files_table = SharedFilesKVPTable(
             os.path.join(cache_dir, 'shared_files.db'))
         self._aggregated_kvp_table = AggregatedKVPTable(self._cache_table,
@@ -56,20 +155,22 @@ class Client(threading.Thread):
         self._initial_scan = initial_scan
         self._config_dir = config_dir or basedir.config_dir
         self._upnp_client = None
-        
+
         if use_port_forwarding:
+            miniupnpc = _import_miniupnpc()
+
             if not miniupnpc:
                 warnings.warn(
                     'miniupnpc not found. Port forwarding is unavailable!')
             else:
-                self._init_port_forwarding()
+                self._init_port_forwarding(miniupnpc)
                 self._hook_port_forwarding_cleanup()
 
         self._init()
 
     @property
     def cache_table(self):
-        '''The :class:`DatabaseKVPTable`'''
+        '''The :class:`DatabaseKVPTable` or :class:`LogStructuredKVPTable`'''
         return self._cache_table
 
     @property
@@ -93,15 +194,42 @@ class Client(threading.Thread):
 
         return self._download_slot
 
+    @property
+    def event_reactor(self):
+        '''The :class:`.EventReactor`.
+
+        :see: :func:`.EventReactor.enable_profiling`
+        '''
+
+        return self._event_reactor
+
     @property
     def dht_network(self):
         return self._dht_network
 
+    @property
+    def upload_limiter(self):
+        '''The :class:`.BandwidthLimiter` of uploads.
+
+        Limits can be changed while the client is running.
+        '''
+
+        return self._network.upload_limiter
+
+    @property
+    def download_limiter(self):
+        '''The :class:`.BandwidthLimiter` of downloads.
+
+        Limits can be changed while the client is running.
+        '''
+
+        return self._network.download_limiter
+
     @property
     def network(self):
         return self._network
 
-    def _init_port_forwarding(self):
+    def _init_port_forwarding(self, miniupnpc):
         upnp_client = miniupnpc.UPnP()
         self._upnp_client = upnp_client
         upnp_client.discoverdelay = 200
@@ -143,7 +271,7 @@ class Client(threading.Thread):
 
     def run(self):
         if self._known_node_address:
-            self._dht_network.join_network(self._known_node_address)
+            self._dht_network.bootstrap([self._known_node_address])
             # TODO: put warning if join fails, but don't check on
             # the same thread as the event_reactor
 
@@ -154,6 +282,7 @@ class Client(threading.Thread):
 
     def stop(self):
         self._event_reactor.put(EventReactor.STOP_ID)
+        self._stop_metrics_file_writer()
 
         if self._upnp_client:
             self._cleanup_port_forwarding()
@@ -5,6 +5,7 @@ This module includes classes help download files and collections.
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.dht.hashtree import HashTreeVerifier
 from bytestag.storage import SQLite3Mixin
 from bytestag.events import EventReactorMixin
 
@@ -12,3 +13,18 @@ from bytestag.events import EventReactorMixin
 class Downloader(EventReactorMixin, SQLite3Mixin):
     def __init__(self, event_reactor, config_dir, dht_network, download_slot):
         EventReactorMixin.__init__(self, event_reactor)
+        self._dht_network = dht_network
+
+    def hash_tree_verifier(self, tree_file_info):
+        '''Return a verifier that fetches hash tree nodes from the network.
+
+        Use :func:`.HashTreeVerifier.verify_part` on each part as it is
+        downloaded.
+
+        :rtype: :class:`.HashTreeVerifier`
+        '''
+
+        def fetch_fn(key):
+            return self._dht_network.get_value(key, key).result()
+
+        return HashTreeVerifier(tree_file_info, fetch_fn)
@@ -0,0 +1,208 @@
+'''File hash trees
+
+A hash tree allows a file with many parts to be described by a single root
+hash. The interior nodes are :class:`.HashTreeNode` values which are
+published and fetched like file parts.
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.dht.models import HashTreeNode, TreeFileInfo
+from bytestag.keys import KeyBytes
+import hashlib
+import logging
+import threading
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+DEFAULT_FANOUT = 1024
+
+
+class HashTreeError(Exception):
+    '''A hash tree node is missing or does not match its hash.'''
+    pass
+
+
+class HashTreeBuilder(object):
+    '''Builds a hash tree incrementally from part hashes.
+
+    Part hashes are added in order as the file is read. A node is emitted
+    as soon as it is full so only one partial node per level is held in
+    memory.
+    '''
+
+    def __init__(self, fanout=DEFAULT_FANOUT, node_callback=None):
+        '''
+        :param fanout: The maximum number of children of a node.
+        :param node_callback: A function called with each finished
+            :class:`.HashTreeNode`.
+        '''
+
+        assert fanout >= 2
+
+        self._fanout = fanout
+        self._node_callback = node_callback
+        self._levels = []
+        self._num_parts = 0
+
+    @property
+    def fanout(self):
+        return self._fanout
+
+    @property
+    def num_parts(self):
+        '''The number of part hashes added so far.'''
+
+        return self._num_parts
+
+    def add_part_hash(self, hash_bytes):
+        '''Add the hash of the next part.'''
+
+        self._num_parts += 1
+        self._add(0, hash_bytes)
+
+    def _add(self, level, hash_bytes):
+        if len(self._levels) <= level:
+            self._levels.append([])
+
+        self._levels[level].append(hash_bytes)
+
+        if len(self._levels[level]) == self._fanout:
+            self._emit(level)
+
+    def _emit(self, level):
+        node = HashTreeNode(level, self._levels[level])
+        self._levels[level] = []
+
+        if self._node_callback:
+            self._node_callback(node)
+
+        self._add(level + 1, node.key)
+
+    def finish(self, file_hash, size=None, filename=None):
+        '''Flush the partial nodes and return the file info.
+
+        :rtype: :class:`.TreeFileInfo`
+        '''
+
+        if not self._num_parts:
+            raise HashTreeError('No parts added')
+
+        level = 0
+
+        while True:
+            children = self._levels[level]
+            is_top = level == len(self._levels) - 1
+
+            if is_top and level > 0 and len(children) == 1:
+                return TreeFileInfo(file_hash, children[0], level,
+                    self._fanout, self._num_parts, size, filename)
+
+            if children:
+                self._emit(level)
+
+            level += 1
+
+
+class HashTreeVerifier(object):
+    '''Verifies file parts against a hash tree.
+
+    Nodes are fetched on demand and cached so that verifying consecutive
+    parts only fetches a new leaf node every ``fanout`` parts.
+    '''
+
+    def __init__(self, tree_file_info, fetch_fn):
+        '''
+        :param tree_file_info: The :class:`.TreeFileInfo`.
+        :param fetch_fn: A function that accepts a :class:`.KeyBytes` and
+            returns the ``bytes`` of the node or ``None``.
+        '''
+
+        self._info = tree_file_info
+        self._fetch_fn = fetch_fn
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def tree_file_info(self):
+        return self._info
+
+    def _get_node(self, key, level):
+        with self._lock:
+            node = self._nodes.get(key)
+
+        if node:
+            return node
+
+        _logger.debug('Fetch hash tree node %s', key)
+
+        data = self._fetch_fn(key)
+
+        if not data:
+            raise HashTreeError('Node {} not available'.format(key))
+
+        if not KeyBytes.validate_hash_value(key, data):
+            raise HashTreeError('Node {} hash mismatch'.format(key))
+
+        try:
+            node = HashTreeNode.from_bytes(data)
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            raise HashTreeError('Node {} parse error {}'.format(key, e))
+
+        if node.level != level:
+            raise HashTreeError('Node {} has unexpected level'.format(key))
+
+        with self._lock:
+            self._nodes[key] = node
+
+        return node
+
+    def node_path(self, part_number):
+        '''Return the keys of the nodes from the root to the leaf of a part.
+
+        :rtype: :obj:`list`
+        '''
+
+        if not 0 <= part_number < self._info.num_parts:
+            raise IndexError('Part number out of range')
+
+        fanout = self._info.fanout
+        key = self._info.root_hash
+        keys = [key]
+
+        for level in range(self._info.depth - 1, 0, -1):
+            node = self._get_node(key, level)
+            child_index = (part_number // fanout ** level) % fanout
+
+            try:
+                key = node.children[child_index]
+            except IndexError:
+                raise HashTreeError('Node {} is too short'.format(key))
+
+            keys.append(key)
+
+        return keys
+
+    def part_hash(self, part_number):
+        '''Return the verified hash of a part.
+
+        :rtype: :class:`.KeyBytes`
+        :raise HashTreeError: A node could not be fetched or is invalid.
+        '''
+
+        leaf_key = self.node_path(part_number)[-1]
+        leaf_node = self._get_node(leaf_key, 0)
+
+        try:
+            return leaf_node.children[part_number % self._info.fanout]
+        except IndexError:
+            raise HashTreeError('Node {} is too short'.format(leaf_key))
+
+    def verify_part(self, part_number, data):
+        '''Return whether the data of a part matches the tree.
+
+        :rtype: :obj:`bool`
+        '''
+
+        return hashlib.sha1(data).digest() == self.part_hash(part_number)
@@ -0,0 +1,84 @@
+from bytestag.dht.hashtree import (HashTreeBuilder, HashTreeVerifier,
+    HashTreeError)
+from bytestag.dht.models import HashTreeNode, TreeFileInfo
+from bytestag.keys import KeyBytes
+import hashlib
+import unittest
+
+
+class TestHashTree(unittest.TestCase):
+    def build(self, num_parts, fanout):
+        parts = [str(i).encode() for i in range(num_parts)]
+        nodes = {}
+
+        def node_callback(node):
+            nodes[node.key] = node.to_bytes()
+
+        builder = HashTreeBuilder(fanout, node_callback)
+
+        for part in parts:
+            builder.add_part_hash(hashlib.sha1(part).digest())
+
+        info = builder.finish(KeyBytes())
+
+        return parts, nodes, info
+
+    def test_single_part(self):
+        '''It should build a tree with a single node'''
+
+        parts, nodes, info = self.build(1, 4)
+
+        self.assertEqual(1, info.depth)
+        self.assertEqual(1, len(nodes))
+        self.assertIn(info.root_hash, nodes)
+
+    def test_verify_parts(self):
+        '''It should verify every part of a multi-level tree'''
+
+        for num_parts in (4, 5, 16, 17, 63, 64, 65):
+            parts, nodes, info = self.build(num_parts, 4)
+            verifier = HashTreeVerifier(info, nodes.get)
+
+            self.assertEqual(num_parts, info.num_parts)
+
+            for part_number, part in enumerate(parts):
+                self.assertTrue(verifier.verify_part(part_number, part))
+                self.assertFalse(verifier.verify_part(part_number, b'bad'))
+
+    def test_depth(self):
+        '''It should add a level when a node overflows'''
+
+        self.assertEqual(2, self.build(5, 4)[2].depth)
+        self.assertEqual(2, self.build(16, 4)[2].depth)
+        self.assertEqual(3, self.build(17, 4)[2].depth)
+
+    def test_tampered_node(self):
+        '''It should raise error on a node that does not match its hash'''
+
+        parts, nodes, info = self.build(10, 4)
+        fake_node = HashTreeNode(0, [KeyBytes()]).to_bytes()
+
+        verifier = HashTreeVerifier(info, lambda key: fake_node)
+
+        self.assertRaises(HashTreeError, verifier.part_hash, 0)
+
+    def test_missing_node(self):
+        '''It should raise error when a node is not available'''
+
+        parts, nodes, info = self.build(10, 4)
+        verifier = HashTreeVerifier(info, lambda key: None)
+
+        self.assertRaises(HashTreeError, verifier.part_hash, 0)
+        self.assertRaises(IndexError, verifier.part_hash, 10)
+
+    def test_round_trip(self):
+        '''It should serialize the file info and nodes'''
+
+        parts, nodes, info = self.build(10, 4)
+
+        self.assertEqual(info.to_bytes(),
+            TreeFileInfo.from_bytes(info.to_bytes()).to_bytes())
+
+        for key, data in nodes.items():
+            self.assertTrue(HashTreeNode.is_valid_signature(data))
+            self.assertEqual(key, HashTreeNode.from_bytes(data).key)
@@ -7,6 +7,7 @@ from bytestag.keys import KeyBytes
 from bytestag.lib import bencode
 import abc
 import collections
+import collections.abc
 import hashlib
 import json
 import logging
@@ -29,6 +30,11 @@ class JSONKeys(object):
     TRANSFER_ID = 'xferid'
     VALUE_OFFSET = 'valofs'
     TIMESTAMP = 'timestmp'
+    INDEX_COUNT = 'numidx'
+    CONTINUATION = 'cont'
+    NEWEST = 'newest'
+    MIN_SIZE = 'minsize'
+    MAX_SIZE = 'maxsize'
 
     class RPCs(object):
         PING = 'ping'
@@ -48,14 +54,258 @@ class JSONDumpable(metaclass=abc.ABCMeta):
         pass
 
 
+BINARY_MAGIC = b'BTAG'
+BINARY_VERSION = 1
+HASH_SIZE = KeyBytes.BIT_SIZE // 8
+
+
+class BinaryTypes(object):
+    '''Type codes used in the header of the binary format'''
+
+    FILE_INFO = 1
+    COLLECTION_INFO = 2
+    TREE_FILE_INFO = 3
+    HASH_TREE_NODE = 4
+
+
+def encode_varint(number):
+    '''Encode a non-negative integer as a variable length integer.
+
+    The encoding is little-endian base 128 (LEB128).
+
+    :rtype: :obj:`bytes`
+    '''
+
+    if number < 0:
+        raise ValueError('Cannot encode negative number')
+
+    l = bytearray()
+
+    while True:
+        byte = number & 0x7f
+        number >>= 7
+
+        if number:
+            l.append(byte | 0x80)
+        else:
+            l.append(byte)
+            return bytes(l)
+
+
+def decode_varint(buffer, offset=0):
+    '''Decode a variable length integer.
+
+    :rtype: :obj:`tuple`
+    :returns: The integer and the offset of the byte following it.
+    :raise ValueError: The integer is truncated or too long.
+    '''
+
+    number = 0
+    shift = 0
+
+    while True:
+        try:
+            byte = buffer[offset]
+        except IndexError:
+            raise ValueError('Truncated varint')
+
+        offset += 1
+        number |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return number, offset
+
+        shift += 7
+
+        if shift > 63:
+            raise ValueError('Varint too long')
+
+
+def is_binary_signature(data, type_code):
+    '''Return whether the data starts with the binary header of a type.
+
+    :rtype: :obj:`bool`
+    '''
+
+    return len(data) > len(BINARY_MAGIC) \
+        and data[:len(BINARY_MAGIC)] == BINARY_MAGIC \
+        and data[len(BINARY_MAGIC)] == type_code
+
+
+class HashList(collections.abc.Sequence):
+    '''A read-only list of hashes backed by a buffer.
+
+    The hashes are converted to :class:`.KeyBytes` only when accessed so
+    parsing a large value does not create an object per hash.
+    '''
+
+    __slots__ = ('_view',)
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+
+        if len(view) % HASH_SIZE:
+            raise ValueError('Buffer is not a multiple of the hash size')
+
+        self._view = view
+
+    def __len__(self):
+        return len(self._view) // HASH_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('Hash index out of range')
+
+        offset = index * HASH_SIZE
+
+        return KeyBytes(self._view[offset:offset + HASH_SIZE].tobytes())
+
+    def __eq__(self, other):
+        if isinstance(other, HashList):
+            return self._view == other._view
+
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def tobytes(self):
+        '''Return the concatenated hashes.
+
+        :rtype: :obj:`bytes`
+        '''
+
+        return self._view.tobytes()
+
+
+class BinaryReader(object):
+    '''Reads the fields of the binary format without copying.'''
+
+    def __init__(self, data, type_code):
+        '''
+        :raise ValueError: The header is not of the given type or version.
+        '''
+
+        self._view = memoryview(data)
+        header_size = len(BINARY_MAGIC) + 2
+
+        if not is_binary_signature(self._view, type_code) \
+        or len(self._view) < header_size:
+            raise ValueError('Not a binary value of type {}'.format(
+                type_code))
+
+        if self._view[header_size - 1] != BINARY_VERSION:
+            raise ValueError('Unsupported binary version')
+
+        self._offset = header_size
+
+    def read_varint(self):
+        value, self._offset = decode_varint(self._view, self._offset)
+
+        return value
+
+    def read_bytes(self, length):
+        '''Return a :obj:`memoryview` of the next bytes.'''
+
+        end = self._offset + length
+
+        if end > len(self._view):
+            raise ValueError('Truncated data')
+
+        view = self._view[self._offset:end]
+        self._offset = end
+
+        return view
+
+    def read_blob(self):
+        return self.read_bytes(self.read_varint())
+
+    def read_hash(self):
+        return KeyBytes(self.read_bytes(HASH_SIZE).tobytes())
+
+    def read_hashes(self):
+        '''Return a :class:`HashList` of the next hashes.'''
+
+        return HashList(self.read_bytes(self.read_varint() * HASH_SIZE))
+
+    def read_str(self):
+        return self.read_blob().tobytes().decode()
+
+    def finish(self):
+        '''Check that all the data was read.'''
+
+        if self._offset != len(self._view):
+            raise ValueError('Trailing data')
+
+
+class BinaryWriter(object):
+    '''Writes the fields of the binary format.'''
+
+    def __init__(self, type_code):
+        self._buffer = bytearray(BINARY_MAGIC)
+        self._buffer.append(type_code)
+        self._buffer.append(BINARY_VERSION)
+
+    def write_varint(self, number):
+        self._buffer.extend(encode_varint(number))
+
+    def write_blob(self, bytes_):
+        self.write_varint(len(bytes_))
+        self._buffer.extend(bytes_)
+
+    def write_hash(self, hash_bytes):
+        assert len(hash_bytes) == HASH_SIZE
+        self._buffer.extend(hash_bytes)
+
+    def write_hashes(self, hashes):
+        self.write_varint(len(hashes))
+
+        if isinstance(hashes, HashList):
+            self._buffer.extend(hashes.tobytes())
+        else:
+            for hash_bytes in hashes:
+                self.write_hash(hash_bytes)
+
+    def write_str(self, str_):
+        self.write_blob(str_.encode())
+
+    def getvalue(self):
+        return bytes(self._buffer)
+
+
 class Serializable(JSONDumpable):
+    '''A model that can be converted to JSON or binary bytes.
+
+    Models with a binary format set :attr:`BINARY_TYPE` and implement
+    ``from_binary_bytes`` and ``to_binary_bytes``. Other models are read
+    and written as JSON.
+
+    :cvar BINARY_TYPE: The type code of the binary format or ``None`` if
+        the model only supports JSON.
+    '''
+
+    BINARY_TYPE = None
+
     @classmethod
     def from_bytes(cls, bytes_):
-        return cls.from_json_loadable(json.loads(bytes_.decode()))
+        '''Parse either the JSON or the binary format.'''
+
+        if cls.BINARY_TYPE and is_binary_signature(bytes_, cls.BINARY_TYPE):
+            return cls.from_binary_bytes(bytes_)
+
+        return cls.from_json_loadable(json.loads(bytes(bytes_).decode()))
 
     def to_bytes(self):
-        return json.dumps(self.to_json_dumpable(), False, True, True, True,
-            None, None, (',', ':'), None, sort_keys=True).encode()
+        return json.dumps(self.to_json_dumpable(), separators=(',', ':'),
+            sort_keys=True).encode()
 
     @property
     def key(self):
@@ -118,16 +368,20 @@ class NodeList(list, JSONDumpable):
         :rtype: ``list``
         '''
 
-        node_list = []
+        return [NodeList.node_to_json_dumpable(node) for node in self]
+
+    @staticmethod
+    def node_to_json_dumpable(node):
+        '''Return the dict of a node in the list
 
-        for node in self:
-            node_list.append({
-                NodeList.HOST: node.address[0],
-                NodeList.PORT: node.address[1],
-                NodeList.NODE_ID: node.key.base64,
-            })
+        :rtype: ``dict``
+        '''
 
-        return node_list
+        return {
+            NodeList.HOST: node.address[0],
+            NodeList.PORT: node.address[1],
+            NodeList.NODE_ID: node.key.base64,
+        }
 
     def sort_distance(self, key):
         '''Sort inplace the list by distance to given key.
@@ -231,7 +485,12 @@ class KVPExchangeInfoList(list, JSONDumpable):
 
 
 class FileInfo(Serializable):
-    '''Represents the hashes of a file and its parts.'''
+    '''Represents the hashes of a file and its parts.
+
+    :cvar MAX_PART_HASHES: The maximum number of part hashes listed in a
+        file info. Files with more parts should use :class:`TreeFileInfo`
+        so the value stays below :attr:`.DHTNetwork.MAX_VALUE_SIZE`.
+    '''
 
     HEADER = 'BytestagFileInfo'
     HASH = 'hash'
@@ -239,6 +498,10 @@ class FileInfo(Serializable):
     SIZE = 'size'
     FILENAME = 'filename'
     SIGNATURE = b'{"!":"BytestagFileInfo"'
+    MAX_PART_HASHES = 16384
+    BINARY_TYPE = BinaryTypes.FILE_INFO
+    FLAG_SIZE = 0x1
+    FLAG_FILENAME = 0x2
     __slots__ = ('_file_hash', '_part_hashes', '_filename')
 
     def __init__(self, file_hash, part_hashes, size=None, filename=None):
@@ -271,6 +534,10 @@ class FileInfo(Serializable):
     def part_hashes(self, hashes):
         hashes[0]
 
+        if isinstance(hashes, HashList):
+            self._part_hashes = hashes
+            return
+
         for hash_ in hashes:
             if not isinstance(hash_, bytes):
                 raise TypeError('Expected bytes')
@@ -334,9 +601,329 @@ class FileInfo(Serializable):
 
         return d
 
+    @classmethod
+    def from_binary_bytes(cls, bytes_):
+        reader = BinaryReader(bytes_, BinaryTypes.FILE_INFO)
+        flags = reader.read_varint()
+        file_hash = reader.read_hash()
+        part_hashes = reader.read_hashes()
+        size, filename = _read_size_filename(reader, flags)
+
+        reader.finish()
+
+        return FileInfo(file_hash, part_hashes, size, filename)
+
+    def to_binary_bytes(self):
+        writer = BinaryWriter(BinaryTypes.FILE_INFO)
+
+        writer.write_varint(_size_filename_flags(self))
+        writer.write_hash(self._file_hash)
+        writer.write_hashes(self._part_hashes)
+        _write_size_filename(writer, self)
+
+        return writer.getvalue()
+
     @classmethod
     def is_valid_signature(cls, data):
-        return data.startswith(FileInfo.SIGNATURE)
+        return data.startswith(FileInfo.SIGNATURE) \
+            or is_binary_signature(data, BinaryTypes.FILE_INFO)
+
+
+def _size_filename_flags(file_info):
+    flags = 0
+
+    if file_info.size:
+        flags |= FileInfo.FLAG_SIZE
+
+    if file_info.filename:
+        flags |= FileInfo.FLAG_FILENAME
+
+    return flags
+
+
+def _write_size_filename(writer, file_info):
+    if file_info.size:
+        writer.write_varint(file_info.size)
+
+    if file_info.filename:
+        writer.write_varint(len(file_info.filename))
+
+        for name in file_info.filename:
+            writer.write_str(name)
+
+
+def _read_size_filename(reader, flags):
+    size = None
+    filename = None
+
+    if flags & FileInfo.FLAG_SIZE:
+        size = reader.read_varint()
+
+    if flags & FileInfo.FLAG_FILENAME:
+        filename = [reader.read_str() for dummy in range(reader.read_varint())]
+
+    return size, filename
+
+
+class TreeFileInfo(Serializable):
+    '''Represents the hashes of a file using a hash tree.
+
+    Instead of listing every part hash, only the key of the root
+    :class:`HashTreeNode` is stored. The interior nodes are published as
+    their own key-value pairs.
+    '''
+
+    HEADER = 'BytestagTreeFileInfo'
+    HASH = 'hash'
+    ROOT = 'root'
+    DEPTH = 'depth'
+    FANOUT = 'fanout'
+    NUM_PARTS = 'numparts'
+    SIZE = 'size'
+    FILENAME = 'filename'
+    SIGNATURE = b'{"!":"BytestagTreeFileInfo"'
+    BINARY_TYPE = BinaryTypes.TREE_FILE_INFO
+    __slots__ = ('_file_hash', '_root_hash', '_depth', '_fanout',
+        '_num_parts', '_size', '_filename')
+
+    def __init__(self, file_hash, root_hash, depth, fanout, num_parts,
+    size=None, filename=None):
+        self._file_hash = KeyBytes(file_hash)
+        self._root_hash = KeyBytes(root_hash)
+        self._depth = None
+        self._fanout = None
+        self._num_parts = None
+        self._size = None
+        self._filename = None
+
+        self.depth = depth
+        self.fanout = fanout
+        self.num_parts = num_parts
+        self.size = size
+        self.filename = filename
+
+    @property
+    def file_hash(self):
+        return self._file_hash
+
+    @property
+    def root_hash(self):
+        '''The key of the top :class:`HashTreeNode`.'''
+
+        return self._root_hash
+
+    @property
+    def depth(self):
+        '''The number of node levels in the tree.'''
+
+        return self._depth
+
+    @depth.setter
+    def depth(self, o):
+        if not isinstance(o, int):
+            raise TypeError('Expected int')
+        elif o < 1:
+            raise ValueError('Depth must be positive')
+
+        self._depth = o
+
+    @property
+    def fanout(self):
+        '''The maximum number of children of a node.'''
+
+        return self._fanout
+
+    @fanout.setter
+    def fanout(self, o):
+        if not isinstance(o, int):
+            raise TypeError('Expected int')
+        elif o < 2:
+            raise ValueError('Fanout must be at least 2')
+
+        self._fanout = o
+
+    @property
+    def num_parts(self):
+        return self._num_parts
+
+    @num_parts.setter
+    def num_parts(self, o):
+        if not isinstance(o, int):
+            raise TypeError('Expected int')
+        elif o < 1:
+            raise ValueError('Number of parts must be positive')
+
+        self._num_parts = o
+
+    size = FileInfo.size
+    filename = FileInfo.filename
+
+    @classmethod
+    def from_json_loadable(cls, d):
+        return TreeFileInfo(
+            KeyBytes(d[TreeFileInfo.HASH]),
+            KeyBytes(d[TreeFileInfo.ROOT]),
+            d[TreeFileInfo.DEPTH],
+            d[TreeFileInfo.FANOUT],
+            d[TreeFileInfo.NUM_PARTS],
+            d.get(TreeFileInfo.SIZE),
+            d.get(TreeFileInfo.FILENAME),
+        )
+
+    def to_json_dumpable(self):
+        d = {
+            '!': TreeFileInfo.HEADER,
+            TreeFileInfo.HASH: self._file_hash.base64,
+            TreeFileInfo.ROOT: self._root_hash.base64,
+            TreeFileInfo.DEPTH: self._depth,
+            TreeFileInfo.FANOUT: self._fanout,
+            TreeFileInfo.NUM_PARTS: self._num_parts,
+        }
+
+        if self._filename:
+            d[TreeFileInfo.FILENAME] = self._filename
+
+        if self._size:
+            d[TreeFileInfo.SIZE] = self._size
+
+        return d
+
+    @classmethod
+    def from_binary_bytes(cls, bytes_):
+        reader = BinaryReader(bytes_, BinaryTypes.TREE_FILE_INFO)
+        flags = reader.read_varint()
+        file_hash = reader.read_hash()
+        root_hash = reader.read_hash()
+        depth = reader.read_varint()
+        fanout = reader.read_varint()
+        num_parts = reader.read_varint()
+        size, filename = _read_size_filename(reader, flags)
+
+        reader.finish()
+
+        return TreeFileInfo(file_hash, root_hash, depth, fanout, num_parts,
+            size, filename)
+
+    def to_binary_bytes(self):
+        writer = BinaryWriter(BinaryTypes.TREE_FILE_INFO)
+
+        writer.write_varint(_size_filename_flags(self))
+        writer.write_hash(self._file_hash)
+        writer.write_hash(self._root_hash)
+        writer.write_varint(self._depth)
+        writer.write_varint(self._fanout)
+        writer.write_varint(self._num_parts)
+        _write_size_filename(writer, self)
+
+        return writer.getvalue()
+
+    @classmethod
+    def is_valid_signature(cls, data):
+        return data.startswith(TreeFileInfo.SIGNATURE) \
+            or is_binary_signature(data, BinaryTypes.TREE_FILE_INFO)
+
+
+class HashTreeNode(Serializable):
+    '''A node of a file hash tree.
+
+    A node at level 0 lists part hashes. A node at a higher level lists the
+    keys of the nodes one level below. The key of a node is the SHA-1 of
+    its serialized form so it can be published like a file part.
+
+    Nodes are always serialized in the binary format by :func:`to_bytes`.
+    '''
+
+    HEADER = 'BytestagHashTreeNode'
+    LEVEL = 'level'
+    CHILDREN = 'children'
+    SIGNATURE = b'{"!":"BytestagHashTreeNode"'
+    BINARY_TYPE = BinaryTypes.HASH_TREE_NODE
+    __slots__ = ('_level', '_children')
+
+    def __init__(self, level, children):
+        if not isinstance(level, int):
+            raise TypeError('Expected int')
+        elif level < 0:
+            raise ValueError('Level cannot be negative')
+
+        children[0]
+
+        self._level = level
+
+        if isinstance(children, HashList):
+            self._children = children
+            return
+
+        for hash_ in children:
+            if not isinstance(hash_, bytes):
+                raise TypeError('Expected bytes')
+
+        self._children = list(map(KeyBytes, children))
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def children(self):
+        return self._children
+
+    @classmethod
+    def from_json_loadable(cls, d):
+        return HashTreeNode(d[HashTreeNode.LEVEL],
+            list(map(KeyBytes, d[HashTreeNode.CHILDREN])))
+
+    def to_json_dumpable(self):
+        return {
+            '!': HashTreeNode.HEADER,
+            HashTreeNode.LEVEL: self._level,
+            HashTreeNode.CHILDREN: list(b.base64 for b in self._children),
+        }
+
+    @classmethod
+    def from_binary_bytes(cls, bytes_):
+        reader = BinaryReader(bytes_, BinaryTypes.HASH_TREE_NODE)
+        level = reader.read_varint()
+        children = reader.read_hashes()
+
+        reader.finish()
+
+        return HashTreeNode(level, children)
+
+    def to_binary_bytes(self):
+        writer = BinaryWriter(BinaryTypes.HASH_TREE_NODE)
+
+        writer.write_varint(self._level)
+        writer.write_hashes(self._children)
+
+        return writer.getvalue()
+
+    def to_bytes(self):
+        return self.to_binary_bytes()
+
+    @classmethod
+    def is_valid_signature(cls, data):
+        return data.startswith(HashTreeNode.SIGNATURE) \
+            or is_binary_signature(data, BinaryTypes.HASH_TREE_NODE)
+
+
+def file_info_from_bytes(bytes_):
+    '''Return either a :class:`FileInfo` or :class:`TreeFileInfo`.'''
+
+    if is_binary_signature(bytes_, BinaryTypes.TREE_FILE_INFO) \
+    or bytes(bytes_[:len(TreeFileInfo.SIGNATURE)]) == TreeFileInfo.SIGNATURE:
+        return TreeFileInfo.from_bytes(bytes_)
+
+    return FileInfo.from_bytes(bytes_)
+
+
+def file_info_from_json_loadable(d):
+    '''Return either a :class:`FileInfo` or :class:`TreeFileInfo`.'''
+
+    if d.get('!') == TreeFileInfo.HEADER:
+        return TreeFileInfo.from_json_loadable(d)
+
+    return FileInfo.from_json_loadable(d)
 
 
 class CollectionInfo(Serializable):
@@ -349,6 +936,10 @@ class CollectionInfo(Serializable):
     NAME = 'name'
     __slots__ = ('_file_infos', '_comment', '_timestamp', '_name')
     SIGNATURE = b'{"!":"BytestagCollectionInfo"'
+    BINARY_TYPE = BinaryTypes.COLLECTION_INFO
+    FLAG_NAME = 0x1
+    FLAG_COMMENT = 0x2
+    FLAG_TIMESTAMP = 0x4
 
     def __init__(self, file_infos, name=None, comment=None, timestamp=None):
         self._file_infos = None
@@ -370,8 +961,8 @@ class CollectionInfo(Serializable):
         file_infos[0]
 
         for file_info in file_infos:
-            if not isinstance(file_info, FileInfo):
-                raise TypeError('Expected FileInfo')
+            if not isinstance(file_info, (FileInfo, TreeFileInfo)):
+                raise TypeError('Expected FileInfo or TreeFileInfo')
 
         self._file_infos = file_infos
 
@@ -415,7 +1006,7 @@ class CollectionInfo(Serializable):
     @classmethod
     def from_json_loadable(cls, d):
         return CollectionInfo(
-            list(map(FileInfo.from_json_loadable, d[CollectionInfo.FILES])),
+            list(map(file_info_from_json_loadable, d[CollectionInfo.FILES])),
             name=d.get(CollectionInfo.NAME),
             comment=d.get(CollectionInfo.COMMENT),
             timestamp=d.get(CollectionInfo.TIMESTAMP)
@@ -440,12 +1031,69 @@ class CollectionInfo(Serializable):
 
         return d
 
+    @classmethod
+    def from_binary_bytes(cls, bytes_):
+        reader = BinaryReader(bytes_, BinaryTypes.COLLECTION_INFO)
+        flags = reader.read_varint()
+        file_infos = [file_info_from_bytes(reader.read_blob())
+            for dummy in range(reader.read_varint())]
+        name = None
+        comment = None
+        timestamp = None
+
+        if flags & CollectionInfo.FLAG_NAME:
+            name = reader.read_str()
+
+        if flags & CollectionInfo.FLAG_COMMENT:
+            comment = reader.read_str()
+
+        if flags & CollectionInfo.FLAG_TIMESTAMP:
+            timestamp = reader.read_varint()
+
+        reader.finish()
+
+        return CollectionInfo(file_infos, name=name, comment=comment,
+            timestamp=timestamp)
+
+    def to_binary_bytes(self):
+        writer = BinaryWriter(BinaryTypes.COLLECTION_INFO)
+        flags = 0
+
+        if self._name:
+            flags |= CollectionInfo.FLAG_NAME
+
+        if self._comment:
+            flags |= CollectionInfo.FLAG_COMMENT
+
+        if self._timestamp:
+            flags |= CollectionInfo.FLAG_TIMESTAMP
+
+        writer.write_varint(flags)
+        writer.write_varint(len(self._file_infos))
+
+        for file_info in self._file_infos:
+            writer.write_blob(file_info.to_binary_bytes())
+
+        if self._name:
+            writer.write_str(self._name)
+
+        if self._comment:
+            writer.write_str(self._comment)
+
+        if self._timestamp:
+            writer.write_varint(self._timestamp)
+
+        return writer.getvalue()
+
     @classmethod
     def is_valid_signature(cls, data):
-        return data.startswith(CollectionInfo.SIGNATURE)
+        return data.startswith(CollectionInfo.SIGNATURE) \
+            or is_binary_signature(data, BinaryTypes.COLLECTION_INFO)
 
 
 class BitTorrentInfoFile(Serializable, dict):
+    BINARY_TYPE = None
+
     @classmethod
     def from_json_loadable(cls, o):
         return BitTorrentInfoFile(o)
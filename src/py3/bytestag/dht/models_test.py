@@ -1,5 +1,6 @@
 from bytestag.dht.models import (NodeList, KVPExchangeInfoList, KVPExchangeInfo,
-    FileInfo, CollectionInfo)
+    FileInfo, CollectionInfo, TreeFileInfo, file_info_from_bytes, HashList,
+    encode_varint, decode_varint, Serializable)
 from bytestag.dht.tables import Node
 from bytestag.keys import KeyBytes
 import unittest
@@ -82,6 +83,111 @@ class TestFileInfo(unittest.TestCase):
 
         self.assertEqual(s, result_bytes)
 
+    def test_binary(self):
+        '''It should convert to binary and back'''
+
+        part_hashes = [KeyBytes() for dummy in range(100)]
+        info = FileInfo(KeyBytes(), part_hashes, 123456, ['my_file.txt'])
+        data = info.to_binary_bytes()
+
+        self.assertTrue(FileInfo.is_valid_signature(data))
+        self.assertLess(len(data), len(info.to_bytes()) // 1.3)
+
+        info = FileInfo.from_bytes(data)
+
+        self.assertIsInstance(info.part_hashes, HashList)
+        self.assertEqual(info.part_hashes, part_hashes)
+        self.assertEqual(info.size, 123456)
+        self.assertEqual(info.filename, ['my_file.txt'])
+        self.assertEqual(data, info.to_binary_bytes())
+
+    def test_binary_malformed(self):
+        '''It should raise ValueError on malformed binary data'''
+
+        info = FileInfo(KeyBytes(), [KeyBytes()], 123, ['my_file.txt'])
+        data = info.to_binary_bytes()
+
+        for bad_data in (data[:-1], data + b'\x00', data[:5],
+        data[:5] + b'\xff' + data[6:], data[:30] + b'\xff' * 8):
+            self.assertRaises(ValueError, FileInfo.from_bytes, bad_data)
+
+
+class JSONOnlyModel(Serializable, dict):
+    @classmethod
+    def from_json_loadable(cls, o):
+        return JSONOnlyModel(o)
+
+    def to_json_dumpable(self):
+        return self
+
+
+class TestSerializable(unittest.TestCase):
+    def test_json_only(self):
+        '''It should read and write models without a binary format as
+        JSON'''
+
+        model = JSONOnlyModel(name='kitteh')
+
+        self.assertEqual(model, JSONOnlyModel.from_bytes(model.to_bytes()))
+        self.assertFalse(hasattr(model, 'to_binary_bytes'))
+
+
+class TestVarint(unittest.TestCase):
+    def test_round_trip(self):
+        '''It should encode and decode integers'''
+
+        for number in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 62):
+            self.assertEqual((number, len(encode_varint(number))),
+                decode_varint(encode_varint(number)))
+
+
+class TestTreeFileInfo(unittest.TestCase):
+    def test_read_json(self):
+        '''It should read in a json with tree info'''
+
+        s = (b'{'
+            b'"!":"BytestagTreeFileInfo",'
+            b'"depth":2,'
+            b'"fanout":1024,'
+            b'"hash":"jbip9t8iC9lEz3jndkm5I2fTWV0=",'
+            b'"numparts":2000,'
+            b'"root":"jbip9t8iC9lEz3jndkm5I2fTWV0=",'
+            b'"size":524288000'
+        b'}')
+
+        info = file_info_from_bytes(s)
+
+        self.assertIsInstance(info, TreeFileInfo)
+        self.assertEqual(info.root_hash,
+            KeyBytes('jbip9t8iC9lEz3jndkm5I2fTWV0='))
+        self.assertEqual(info.depth, 2)
+        self.assertEqual(info.num_parts, 2000)
+        self.assertEqual(info.size, 524288000)
+        self.assertEqual(s, info.to_bytes())
+
+    def test_in_collection(self):
+        '''It should be accepted in a collection'''
+
+        info = TreeFileInfo(KeyBytes(), KeyBytes(), 1, 1024, 10)
+        collection = CollectionInfo([info])
+
+        collection = CollectionInfo.from_bytes(collection.to_bytes())
+
+        self.assertIsInstance(collection.file_infos[0], TreeFileInfo)
+
+    def test_binary(self):
+        '''It should convert to binary and back'''
+
+        info = TreeFileInfo(KeyBytes(), KeyBytes(), 2, 1024, 2000, 123)
+
+        info = file_info_from_bytes(info.to_binary_bytes())
+
+        self.assertIsInstance(info, TreeFileInfo)
+        self.assertEqual(info.depth, 2)
+        self.assertEqual(info.num_parts, 2000)
+        self.assertEqual(info.size, 123)
+        self.assertEqual(info.filename, None)
+
 
 class TestCollectionInfo(unittest.TestCase):
     def test_read_json(self):
@@ -133,3 +239,25 @@ class TestCollectionInfo(unittest.TestCase):
         result_bytes = info.to_bytes()
 
         self.assertEqual(s, result_bytes)
+
+    def test_binary(self):
+        '''It should convert to binary and back'''
+
+        file_info = FileInfo(KeyBytes(), [KeyBytes(), KeyBytes()])
+        tree_info = TreeFileInfo(KeyBytes(), KeyBytes(), 1, 1024, 10)
+        info = CollectionInfo([file_info, tree_info], name='my video',
+            comment='hello', timestamp=123456789)
+        data = info.to_binary_bytes()
+
+        self.assertTrue(CollectionInfo.is_valid_signature(data))
+
+        info = CollectionInfo.from_bytes(data)
+
+        self.assertIsInstance(info.file_infos[0], FileInfo)
+        self.assertIsInstance(info.file_infos[1], TreeFileInfo)
+        self.assertEqual(info.file_infos[0].part_hashes,
+            file_info.part_hashes)
+        self.assertEqual(info.comment, 'hello')
+        self.assertEqual(info.name, 'my video')
+        self.assertEqual(info.timestamp, 123456789)
+        self.assertEqual(data, info.to_binary_bytes())
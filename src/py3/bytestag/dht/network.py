@@ -2,18 +2,23 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.bandwidth import TrafficClasses
 from bytestag.dht.models import (NodeList, JSONKeys, KVPExchangeInfoList,
     KVPExchangeInfo)
-from bytestag.dht.tables import Bucket, RoutingTable, Node, BucketFullError
+from bytestag.dht.tables import (Bucket, RoutingTable, Node, BucketFullError,
+    default_dead_node_cache)
 from bytestag.events import (EventReactorMixin, EventScheduler, EventID,
-    asynchronous, Task, Observer, FnTaskSlot, WrappedThreadPoolExecutor)
+    asynchronous, Task, Observer, FnTaskSlot, WrappedThreadPoolExecutor,
+    TaskPriorities)
 from bytestag.keys import KeyBytes, compute_bucket_number, random_bucket_key
+from bytestag.metrics import default_registry, COUNT_BUCKETS
 from bytestag.network import Network, DownloadTask
 from bytestag.tables import KVPID
 import collections
 import io
 import logging
 import math
+import queue
 import socket
 import threading
 import time
@@ -21,12 +26,47 @@ import time
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
+_rpcs_received = default_registry().counter('bytestag_rpcs_received_total',
+    'DHT RPC requests received', ('rpc',))
+_rpcs_sent = default_registry().counter('bytestag_rpcs_sent_total',
+    'DHT RPC requests sent', ('rpc',))
+_lookup_hops = default_registry().histogram('bytestag_lookup_hops',
+    'Iterations of node and value lookups', ('lookup',),
+    buckets=COUNT_BUCKETS)
+_hedged_requests = default_registry().counter(
+    'bytestag_hedged_requests_total',
+    'Requests sent to another node because a node was slow')
+_hedge_wins = default_registry().counter('bytestag_hedge_wins_total',
+    'Slow requests beaten by the answer of a hedged request')
+_suspect_nodes_skipped = default_registry().counter(
+    'bytestag_suspect_nodes_skipped_total',
+    'Nodes left out of lookups because they did not respond recently')
+_no_value_hits = default_registry().counter('bytestag_no_value_hits_total',
+    'Downloads skipped because a recent lookup found no value')
+_bootstrap_time = default_registry().histogram('bytestag_bootstrap_seconds',
+    'Time from the start of a bootstrap until the routing table is filled')
+_lookup_latency = default_registry().histogram(
+    'bytestag_lookup_latency_seconds', 'Duration of node and value lookups',
+    ('lookup',))
+
+
+def _non_negative_int(value):
+    '''Return the JSON value if it is a non-negative integer or ``None``.'''
+
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
 
 
 class FindValueFromNodeResult(collections.namedtuple('FindValueFromNodeResult',
-    ['kvp_info_list', 'node_list'])):
+    ['kvp_info_list', 'node_list', 'index_count', 'continuation'],
+    defaults=(None, None))):
     '''A named tuple representing key-value pair information or additional
-    nodes.'''
+    nodes.
+
+    :ivar index_count: The number of indices the node has for the key.
+    :ivar continuation: A token for requesting the next page of values or
+        ``None`` if there are no more values.
+    '''
 
     __slots__ = ()
 
@@ -47,9 +87,15 @@ class DHTNetwork(EventReactorMixin):
     TIME_REPLICATE = 3600  # seconds. interval between replication events
     TIME_REPUBLISH = 86400  # seconds. time after original publisher must
     # republish
+    LIVENESS_CHECK_DELAY = 1  # seconds
+    REFRESH_PARALLELISM = 4  # lookups at the same time when refreshing
+    HEDGE_PERCENTILE = 0.95
+    HEDGE_DEFAULT_DELAY = 1  # seconds. used for nodes without RTT samples
+    HEDGE_MIN_DELAY = 0.05  # seconds
+    FIND_VALUE_PAGE_SIZE = 200  # values in a find value reply
 
     def __init__(self, event_reactor, kvp_table, node_id=None, network=None,
-    download_slot=None):
+    download_slot=None, pool_executor=None, dead_node_cache=None):
         '''Init
 
         :Parameters:
@@ -59,19 +105,41 @@ class DHTNetwork(EventReactorMixin):
                 The storage
             node_id : :class:`.KeyBytes`
                 A key to be used as the node id.
+            pool_executor : :class:`.WrappedThreadPoolExecutor`
+                An executor to share with other instances. If ``None``,
+                a new one is created.
+            dead_node_cache : :class:`.DeadNodeCache`
+                The nodes that did not respond. If ``None``, the
+                process-wide cache is used.
         '''
 
         EventReactorMixin.__init__(self, event_reactor)
         self._network = network or Network(event_reactor)
         self._network.receive_callback = self._receive_callback
-        self._routing_table = RoutingTable()
+        self._dead_node_cache = dead_node_cache if dead_node_cache is not None \
+            else default_dead_node_cache()
         self._key = node_id or KeyBytes()
-        self._pool_executor = WrappedThreadPoolExecutor(
-            Network.DEFAULT_POOL_SIZE / 2, event_reactor)
+        self._routing_table = RoutingTable(self._key,
+            dead_node_cache=self._dead_node_cache)
+        self._pool_executor = pool_executor or WrappedThreadPoolExecutor(
+            Network.DEFAULT_POOL_SIZE // 2, event_reactor)
         self._kvp_table = kvp_table
         self._event_scheduler = EventScheduler(event_reactor)
         self._refresh_timer_id = EventID(self, 'Refresh')
+        self._liveness_timer_id = EventID(self, 'Liveness check')
+        self._full_buckets = set()
+        self._full_buckets_lock = threading.Lock()
         self._download_slot = download_slot or FnTaskSlot()
+        self._hedge_budget = HedgeBudget()
+        self._hedging = True
+        self._no_value_cache = NoValueCache(
+            clock=self._event_scheduler.timer_wheel.clock)
+        self._template = {
+            JSONKeys.NETWORK_ID: DHTNetwork.NETWORK_ID,
+            JSONKeys.NODE_ID: self._key.base64,
+        }
+        self._node_entries = {}
+        self._node_entries_version = self._routing_table.version
 
         self._setup_timers()
 
@@ -80,6 +148,8 @@ class DHTNetwork(EventReactorMixin):
             self._refresh_timer_id)
         self._event_reactor.register_handler(self._refresh_timer_id,
             self._refresh_buckets)
+        self._event_reactor.register_handler(self._liveness_timer_id,
+            self._liveness_timer_callback)
 
     @property
     def routing_table(self):
@@ -125,15 +195,83 @@ class DHTNetwork(EventReactorMixin):
 
         return self._download_slot
 
+    @property
+    def dead_node_cache(self):
+        '''The :class:`.DeadNodeCache` consulted by lookups.'''
+
+        return self._dead_node_cache
+
+    @property
+    def no_value_cache(self):
+        '''The :class:`NoValueCache` of keys not found by downloads.'''
+
+        return self._no_value_cache
+
+    @property
+    def hedging(self):
+        '''Whether lookups and downloads send hedged requests.
+
+        :see: :class:`HedgedRequests`
+        '''
+
+        return self._hedging
+
+    @hedging.setter
+    def hedging(self, enabled):
+        self._hedging = enabled
+
+    @property
+    def hedge_budget(self):
+        '''The :class:`HedgeBudget` limiting hedged requests.'''
+
+        return self._hedge_budget
+
+    def hedge_delay(self, node):
+        '''Return the seconds to wait for a node before hedging.
+
+        The delay is a high percentile of the round trip times of the node.
+        '''
+
+        delay = self._network.rtt_stats.percentile(node.address,
+            DHTNetwork.HEDGE_PERCENTILE)
+
+        if delay is None:
+            return DHTNetwork.HEDGE_DEFAULT_DELAY
+
+        return max(DHTNetwork.HEDGE_MIN_DELAY, delay)
+
     def _template_dict(self):
         '''Return a new dict holding common stuff like network id'''
 
-        d = {
-            JSONKeys.NETWORK_ID: DHTNetwork.NETWORK_ID,
-            JSONKeys.NODE_ID: self._key.base64,
-        }
+        return self._template.copy()
+
+    def _node_list_dumpable(self, nodes):
+        '''Return the JSON form of a :class:`.NodeList` of the nodes.
+
+        The entries of the nodes are encoded once and kept while the nodes
+        are in the routing table.
+        '''
+
+        version = self._routing_table.version
 
-        return d
+        if version != self._node_entries_version:
+            self._node_entries = dict((node, entry) for node, entry
+                in self._node_entries.items() if node in self._routing_table)
+            self._node_entries_version = version
+
+        node_entries = self._node_entries
+        node_list = []
+
+        for node in nodes:
+            entry = node_entries.get(node)
+
+            if entry is None:
+                entry = NodeList.node_to_json_dumpable(node)
+                node_entries[node] = entry
+
+            node_list.append(entry)
+
+        return node_list
 
     def _receive_callback(self, data_packet):
         '''An incoming packet callback'''
@@ -161,9 +299,21 @@ class DHTNetwork(EventReactorMixin):
 
         if fn:
             _logger.debug('Got rpc %s', rpc_name)
+            _rpcs_received.labels(rpc_name).inc()
             fn(data_packet)
         else:
             _logger.debug('Received unknown rpc %s', rpc_name)
+            _rpcs_received.labels('unknown').inc()
+
+    def _send_rpc(self, address, dict_obj, timeout=None):
+        '''Send a RPC request.
+
+        :see: :func:`.Network.send`
+        '''
+
+        _rpcs_sent.labels(dict_obj[JSONKeys.RPC]).inc()
+
+        return self._network.send(address, dict_obj, timeout)
 
     def join_network(self, address):
         '''Join the network
@@ -181,6 +331,37 @@ class DHTNetwork(EventReactorMixin):
 
         return join_network_task
 
+    def bootstrap(self, addresses):
+        '''Join the network through several nodes and fill the routing
+        table.
+
+        :param addresses: A list of addresses of known nodes.
+        :rtype: :class:`BootstrapTask`
+        :return: A future that returns ``bool``. If ``True``, a known node
+            responded.
+        '''
+
+        _logger.debug('Bootstrap %s→%s', self.address, addresses)
+
+        bootstrap_task = BootstrapTask(self, addresses)
+
+        self._pool_executor.submit(bootstrap_task)
+
+        return bootstrap_task
+
+    def refresh_buckets(self, bucket_numbers):
+        '''Look up a random key in each bucket.
+
+        :rtype: :class:`RefreshBucketsTask`
+        :return: A future that returns the number of lookups done.
+        '''
+
+        refresh_buckets_task = RefreshBucketsTask(self, bucket_numbers)
+
+        self._pool_executor.submit(refresh_buckets_task)
+
+        return refresh_buckets_task
+
     def ping_address(self, address):
         '''Ping an address
 
@@ -232,9 +413,13 @@ class DHTNetwork(EventReactorMixin):
 
         return find_nodes_from_node_task
 
-    def find_value_from_node(self, node, key, index=None):
+    def find_value_from_node(self, node, key, index=None, continuation=None,
+    newest=None, min_size=None, max_size=None):
         '''Ask a node about values for a key
 
+        Keys with many indices are replied in pages of at most
+        :attr:`FIND_VALUE_PAGE_SIZE` values in order of index.
+
         :Parameters:
             node: `Node`
                 The node to be contacted
@@ -242,6 +427,15 @@ class DHTNetwork(EventReactorMixin):
                 The key of the value
             index: :class:`.KeyBytes`, ``None``
                 If given, the request will be filtered to that given index.
+            continuation: :obj:`str`, ``None``
+                The continuation token of the previous page.
+            newest: :obj:`int`, ``None``
+                If given, only this number of the newest values are
+                returned.
+            min_size: :obj:`int`, ``None``
+                If given, smaller values are skipped.
+            max_size: :obj:`int`, ``None``
+                If given, larger values are skipped.
 
         :rtype: :class:`FindValueFromNodeTask`
         :return: A future which returns a `FindValueFromNodeResult` or
@@ -252,7 +446,8 @@ class DHTNetwork(EventReactorMixin):
             node)
 
         find_value_from_node_task = FindValueFromNodeTask(self,
-            node, key, index)
+            node, key, index, continuation=continuation, newest=newest,
+            min_size=min_size, max_size=max_size)
 
         self._pool_executor.submit(find_value_from_node_task)
 
@@ -278,7 +473,7 @@ class DHTNetwork(EventReactorMixin):
 
         nodes = self._routing_table.get_close_nodes(key_obj,
             Bucket.MAX_BUCKET_SIZE)
-        node_list = NodeList(nodes).to_json_dumpable()
+        node_list = self._node_list_dumpable(nodes)
         d = self._template_dict()
         d[JSONKeys.NODES] = node_list
 
@@ -315,16 +510,51 @@ class DHTNetwork(EventReactorMixin):
             ]).to_json_dumpable()
 
             self._network.send_answer_reply(data_packet, d)
-        elif self._kvp_table.indices(key):
-            kvp_record_list = self._kvp_table.records_by_key(key)
+        else:
+            index_count = self._kvp_table.count_indices(key)
 
-            d = self._template_dict()
-            d[JSONKeys.VALUES] = KVPExchangeInfoList.from_kvp_record_list(
-                kvp_record_list).to_json_dumpable()
+            if index_count:
+                self._reply_find_value_page(data_packet, key, index_count)
+            else:
+                self._reply_find_node(data_packet, key)
 
-            self._network.send_answer_reply(data_packet, d)
-        else:
-            self._reply_find_node(data_packet, key)
+    def _reply_find_value_page(self, data_packet, key, index_count):
+        '''Reply a page of the values of a key'''
+
+        dict_obj = data_packet.dict_obj
+        newest = _non_negative_int(dict_obj.get(JSONKeys.NEWEST))
+        after_index = None
+        limit = self.FIND_VALUE_PAGE_SIZE
+
+        if newest is not None:
+            limit = min(newest, limit)
+        elif JSONKeys.CONTINUATION in dict_obj:
+            after_index = KeyBytes.new_silent(dict_obj[JSONKeys.CONTINUATION])
+
+            if not after_index:
+                _logger.debug('Find value %s←%s bad continuation',
+                    self.address, data_packet.address)
+                return
+
+        # One more than the page tells whether another page follows.
+        summaries = self._kvp_table.index_range(key,
+            after_index=after_index, limit=limit + 1,
+            min_size=_non_negative_int(dict_obj.get(JSONKeys.MIN_SIZE)),
+            max_size=_non_negative_int(dict_obj.get(JSONKeys.MAX_SIZE)),
+            newest=newest is not None)
+
+        d = self._template_dict()
+        d[JSONKeys.VALUES] = KVPExchangeInfoList.from_kvp_record_list(
+            summaries[:limit]).to_json_dumpable()
+        d[JSONKeys.INDEX_COUNT] = index_count
+
+        if len(summaries) > limit and newest is None:
+            d[JSONKeys.CONTINUATION] = summaries[limit - 1].index.base64
+
+        _logger.debug('Find value reply %s→%s len=%d count=%d',
+            self.address, data_packet.address, len(d[JSONKeys.VALUES]),
+            index_count)
+        self._network.send_answer_reply(data_packet, d)
 
     def find_node_shortlist(self, key):
         '''Return nodes close to a key
@@ -391,31 +621,42 @@ class DHTNetwork(EventReactorMixin):
                 node)
             return
 
+        self._dead_node_cache.mark_alive(node)
+
         try:
             self._routing_table.node_update(node)
         except BucketFullError as e:
-            bucket = e.bucket
-            old_node = e.node
+            self._add_full_bucket(e.bucket)
+
+    def _add_full_bucket(self, bucket):
+        '''Schedule a liveness check of the oldest node of the bucket.
 
-            self._update_full_bucket(bucket, old_node, node)
+        Buckets filling up within `LIVENESS_CHECK_DELAY` are checked
+        together by one :class:`CheckBucketsTask`.
+        '''
 
-    @asynchronous(name='update_full_bucket')
-    def _update_full_bucket(self, bucket, old_node, new_node):
-        '''A full bucket callback that will ping and update the buckets'''
+        with self._full_buckets_lock:
+            is_scheduled = bool(self._full_buckets)
+            self._full_buckets.add(bucket)
 
-        _logger.debug('Update routing table, bucket=%s full', bucket)
+        if not is_scheduled:
+            self._event_scheduler.add_one_shot(
+                DHTNetwork.LIVENESS_CHECK_DELAY, self._liveness_timer_id)
 
-        future = self.ping_node(old_node)
-        has_responded = future.result()
+    def _liveness_timer_callback(self, event_id):
+        with self._full_buckets_lock:
+            buckets = self._full_buckets
+            self._full_buckets = set()
 
-        if not has_responded:
-            _logger.debug('Bucket %s drop %s add %s', bucket, old_node,
-                new_node)
-            bucket.keep_new_node()
-        else:
-            _logger.debug('Bucket %s keep %s ignore %s', bucket, old_node,
-                new_node)
-            bucket.keep_old_node()
+        _logger.debug('Check liveness of %d buckets', len(buckets))
+        self._pool_executor.submit(CheckBucketsTask(self, buckets))
+
+    def _node_failed(self, node):
+        '''Record a node that did not respond and replace it in its bucket
+        if there is a candidate.'''
+
+        self._dead_node_cache.mark_failed(node)
+        self._routing_table.node_failed(node)
 
     def get_value_from_node(self, node, key, index=None, offset=None):
         '''Download, from a node, data value associated to the key
@@ -423,7 +664,7 @@ class DHTNetwork(EventReactorMixin):
         :rtype: :class:`.DownloadTask`
         '''
 
-        transfer_id = self._network.new_sequence_id()
+        transfer_id = self._network.new_transfer_id()
         d = self._template_dict()
         d[JSONKeys.RPC] = JSONKeys.RPCs.GET_VALUE
         d[JSONKeys.KEY] = key.base64
@@ -433,12 +674,13 @@ class DHTNetwork(EventReactorMixin):
         if offset:
             d[JSONKeys.VALUE_OFFSET] = offset
 
-        task = self._network.expect_incoming_transfer(transfer_id)
+        task = self._network.expect_incoming_transfer(transfer_id,
+            traffic_class=TrafficClasses.DOWNLOAD)
 
         _logger.debug('Get value %s→%s transfer_id=%s', self.node, node,
             transfer_id)
 
-        self._network.send(node.address, d)
+        self._send_rpc(node.address, d)
 
         return task
 
@@ -475,21 +717,24 @@ class DHTNetwork(EventReactorMixin):
         data = self._kvp_table[kvpid]
 
         task = self._network.send_bytes(data_packet.address,
-            transfer_id, data[offset:])
+            transfer_id, data[offset:], traffic_class=TrafficClasses.DOWNLOAD)
         bytes_sent = task.result()
 
         _logger.debug('Sent %d bytes', bytes_sent)
 
-    def store_to_node(self, node, key, index, bytes_, timestamp):
+    def store_to_node(self, node, key, index, bytes_, timestamp,
+    traffic_class=None):
         '''Send data to node.
 
+        :param traffic_class: The :class:`.TrafficClasses` used for rate
+            limiting.
         :rtype: :class:`StoreToNodeTask`
         '''
 
         _logger.debug('Store value %s→%s', self.node, node)
 
         store_to_node_task = StoreToNodeTask(self, node, key, index,
-            bytes_, timestamp)
+            bytes_, timestamp, traffic_class)
 
         self._pool_executor.submit(store_to_node_task)
 
@@ -512,13 +757,17 @@ class DHTNetwork(EventReactorMixin):
         d = self._template_dict()
         kvpid = KVPID(key, index)
 
+        self._no_value_cache.discard(key, index)
+
         if self._kvp_table.is_acceptable(kvpid, size, timestamp):
-            transfer_id = self._network.new_sequence_id()
+            transfer_id = self._network.new_transfer_id()
 
             download_task = self._download_slot.add(
                 self._network.expect_incoming_transfer, transfer_id,
                 max_size=DHTNetwork.MAX_VALUE_SIZE,
-                download_task_class=ReadStoreFromNodeTask)
+                download_task_class=ReadStoreFromNodeTask,
+                traffic_class=TrafficClasses.REPLICATE,
+                fairness_key=data_packet.address)
 
             download_task.key = kvpid.key
             download_task.index = kvpid.index
@@ -562,23 +811,40 @@ class DHTNetwork(EventReactorMixin):
             return DHTNetwork.TIME_EXPIRE / math.exp(
                 c / Bucket.MAX_BUCKET_SIZE)
 
-    @asynchronous(name='refresh buckets')
     def _refresh_buckets(self, event_id):
-        for bucket in self._routing_table.buckets:
-            if bucket.last_update + DHTNetwork.TIME_REFRESH < time.time():
-                key = random_bucket_key(self.node.key, bucket.number)
-                task = self.find_node_shortlist(key)
-                task.result()
+        stale_time = time.time() - DHTNetwork.TIME_REFRESH
+        bucket_numbers = [bucket.number for bucket
+            in self._routing_table.buckets[:self._closest_bucket_number() + 1]
+            if bucket.last_update < stale_time]
+
+        if bucket_numbers:
+            self.refresh_buckets(bucket_numbers)
 
-    def store_value(self, key, index):
+    def _closest_bucket_number(self):
+        '''Return the number of the bucket of the closest contact.
+
+        Buckets with larger numbers are empty and looking them up finds no
+        one new.
+        '''
+
+        for bucket in reversed(self._routing_table.buckets):
+            if len(bucket):
+                return bucket.number
+
+        return 0
+
+    def store_value(self, key, index, traffic_class=None):
         '''Publish or replicate value to nodes.
 
+        :param traffic_class: The :class:`.TrafficClasses` used for rate
+            limiting.
         :rtype: :class:`StoreValueTask`
         '''
 
         _logger.debug('Store value %s:%s', key, index)
 
-        store_value_task = StoreValueTask(self, key, index)
+        self._no_value_cache.discard(key, index)
+        store_value_task = StoreValueTask(self, key, index, traffic_class)
 
         self._pool_executor.submit(store_value_task)
 
@@ -592,7 +858,8 @@ class DHTNetwork(EventReactorMixin):
 
             return get_value_task
 
-        self._download_slot.add(f)
+        self._download_slot.submit(f, priority=TaskPriorities.INTERACTIVE,
+            fairness_key=key)
 
         return get_value_task
 
@@ -600,9 +867,16 @@ class DHTNetwork(EventReactorMixin):
 class Shortlist(object):
     '''A shortlist containing close nodes to a key'''
 
-    def __init__(self, key_obj, routing_table, server_node):
+    def __init__(self, key_obj, routing_table, server_node,
+    dead_node_cache=None):
+        '''
+        :param dead_node_cache: A :class:`.DeadNodeCache`. Suspect nodes are
+            not added and nodes that do not respond are recorded.
+        '''
+
         self._key_obj = key_obj
         self._routing_table = routing_table
+        self._dead_node_cache = dead_node_cache
         self._active_nodes = set()
         self._contacted_nodes = set()
         self._uncontacted_nodes = set()
@@ -696,6 +970,27 @@ class Shortlist(object):
 
         return nodes
 
+    def get_node_for_hedging(self):
+        '''Pop the closest uncontacted node off the uncontacted list.
+
+        Unlike `get_nodes_for_contacting`, this does not count as an
+        iteration.
+
+        :rtype: `Node`, ``None``
+        '''
+
+        with self._lock:
+            if not self._uncontacted_nodes:
+                return
+
+            node = min(self._uncontacted_nodes,
+                key=lambda node: node.key.distance_int(self._key_obj))
+
+            self._uncontacted_nodes.remove(node)
+            self._contacted_nodes.add(node)
+
+        return node
+
     def mark_node(self, node, active, useful=False,
     kvp_exchange_info_list=None):
         '''Add or remove the node from the shortlist.
@@ -715,10 +1010,20 @@ class Shortlist(object):
 
         assert node in self._nodes
 
+        if self._dead_node_cache is not None:
+            if active:
+                self._dead_node_cache.mark_alive(node)
+            else:
+                self._dead_node_cache.mark_failed(node)
+
+        if not active:
+            self._routing_table.node_failed(node)
+
         with self._lock:
-            if not active:
-                self._nodes.remove(node)
+            if active:
                 self._active_nodes.add(node)
+            else:
+                self._nodes.remove(node)
 
             if useful:
                 self._useful_nodes.add(node)
@@ -742,6 +1047,14 @@ class Shortlist(object):
         nodes.discard(self._server_node)
         nodes.difference_update(self._contacted_nodes)
 
+        if self._dead_node_cache is not None and len(self._dead_node_cache):
+            suspect_nodes = set(node for node in nodes
+                if self._dead_node_cache.is_suspect(node))
+
+            if suspect_nodes:
+                _suspect_nodes_skipped.inc(len(suspect_nodes))
+                nodes.difference_update(suspect_nodes)
+
         with self._lock:
             self._nodes.update(nodes)
             self._uncontacted_nodes.update(nodes)
@@ -762,20 +1075,233 @@ class Shortlist(object):
         return limit_condition or improvement_condition
 
     def get_common_kvp_exchange_info(self, key, index):
-        size = self._key_to_size_counter_map[(key, index)].most_common(1)[0]
+        size = self._key_to_size_counter_map[(key, index)
+            ].most_common(1)[0][0]
         timestamp = self._key_to_timestamp_counter_map[(key, index)
-            ].most_common(1)[0]
+            ].most_common(1)[0][0]
 
         return KVPExchangeInfo(key, index, size, timestamp)
 
 
+class NoValueCache(object):
+    '''Remembers values that lookups did not find.
+
+    Downloads of a value found missing recently fail without a lookup.
+    Entries expire after `TTL` and are removed when the value is stored.
+
+    This class is thread-safe.
+    '''
+
+    TTL = 30  # seconds
+    MAX_ENTRIES = 4096
+
+    def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES, clock=time.time):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._clock = clock
+        self._entries = collections.OrderedDict()  # (key, index) → expiry
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, index):
+        with self._lock:
+            self._entries.pop((key, index), None)
+            self._entries[(key, index)] = self._clock() + self._ttl
+
+            if len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key, index):
+        if (key, index) in self._entries:
+            with self._lock:
+                self._entries.pop((key, index), None)
+
+    def contains(self, key, index):
+        '''Return whether a lookup recently found no value.'''
+
+        expiry = self._entries.get((key, index))
+
+        if expiry is None:
+            return False
+
+        if self._clock() < expiry:
+            return True
+
+        self.discard(key, index)
+
+        return False
+
+
+class HedgeBudget(object):
+    '''Limits hedged requests to a fraction of all requests.
+
+    Every request adds `ratio` of a token, up to `burst` tokens, and every
+    hedged request takes a whole token.
+
+    This class is thread-safe.
+    '''
+
+    def __init__(self, ratio=0.1, burst=10):
+        self._ratio = ratio
+        self._burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def add_request(self):
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + self._ratio)
+
+    def take(self):
+        '''Take a token for a hedged request.
+
+        :return: ``False`` if the budget is spent.
+        '''
+
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+
+        return False
+
+
+class _HedgeSlot(object):
+    __slots__ = ('requests', 'timer', 'is_done')
+
+    def __init__(self):
+        self.requests = []
+        self.timer = None
+        self.is_done = False
+
+
+class HedgedRequests(object):
+    '''Sends requests to nodes and sends a slow request again to another
+    node.
+
+    Each request added by :func:`add` gets a slot. If it is still waiting
+    after the :func:`DHTNetwork.hedge_delay` of its node, the same request
+    goes to the node returned by `next_node_fn` in the same slot, as long as
+    the :class:`HedgeBudget` allows. The first answer of a slot is used and
+    the other requests of the slot are stopped.
+
+    The delays are counted by the timer wheel so that they follow the
+    wheel's clock.
+    '''
+
+    def __init__(self, controller, request_fn, next_node_fn,
+    is_answer_fn=None, is_waiting_fn=None):
+        '''
+        :param request_fn: A function that accepts a `Node` and returns a
+            :class:`.Task`.
+        :param next_node_fn: A function that returns the `Node` for a
+            hedged request or ``None``.
+        :param is_answer_fn: A function that accepts a finished task and
+            returns whether it was answered. By default, tasks with a
+            result are answered.
+        :param is_waiting_fn: A function that accepts a task and returns
+            whether it has not heard from its node yet. By default, tasks
+            are waiting until they are finished.
+        '''
+
+        self._controller = controller
+        self._request_fn = request_fn
+        self._next_node_fn = next_node_fn
+        self._is_answer_fn = is_answer_fn or \
+            (lambda task: task.result_ is not None)
+        self._is_waiting_fn = is_waiting_fn or \
+            (lambda task: not task.is_finished)
+        self._timer_wheel = controller._event_scheduler.timer_wheel
+        self._queue = queue.Queue()
+        self._slots = []
+
+    def add(self, node):
+        '''Send the request to a node in a new slot.'''
+
+        slot = _HedgeSlot()
+        self._slots.append(slot)
+        self._start(slot, node)
+
+        if self._controller.hedging:
+            self._controller.hedge_budget.add_request()
+
+            slot.timer = self._timer_wheel.add(self._timer_wheel.clock()
+                + self._controller.hedge_delay(node), self._queue.put,
+                (slot, None))
+
+    def _start(self, slot, node):
+        task = self._request_fn(node)
+        request = (node, task)
+
+        slot.requests.append(request)
+        task.observer.register(lambda *args: self._queue.put((slot, request)))
+
+    def results(self):
+        '''Yield the node and task of the finished requests.
+
+        The generator stops when every slot has an answer or has no
+        requests left. Requests that lost to an answer of their slot are
+        stopped and not yielded.
+        '''
+
+        num_open_slots = len(self._slots)
+
+        while num_open_slots:
+            slot, request = self._queue.get()
+
+            if slot.is_done:
+                continue
+
+            if request is None:
+                self._hedge(slot)
+                continue
+
+            node, task = request
+            slot.requests.remove(request)
+
+            yield request
+
+            if self._is_answer_fn(task) or not slot.requests:
+                slot.is_done = True
+                num_open_slots -= 1
+
+                if slot.timer:
+                    slot.timer.cancel()
+
+                for other_node, other_task in slot.requests:
+                    other_task.stop()
+
+                if slot.requests and self._is_answer_fn(task):
+                    _hedge_wins.inc()
+
+    def _hedge(self, slot):
+        if not all(self._is_waiting_fn(task) for node, task in slot.requests):
+            return
+
+        if not self._controller.hedge_budget.take():
+            _logger.debug('Hedge budget spent')
+            return
+
+        node = self._next_node_fn()
+
+        if node:
+            _logger.debug('Hedge request to %s', node)
+            _hedged_requests.inc()
+            self._start(slot, node)
+
+
 class PingTask(Task):
     def run(self, address, controller):
         start_time = time.time()
         d = controller._template_dict()
         d[JSONKeys.RPC] = JSONKeys.RPCs.PING
 
-        task = controller._network.send(address, d, timeout=True)
+        task = controller._send_rpc(address, d, timeout=True)
 
         self.hook_task(task)
 
@@ -800,7 +1326,7 @@ class FindNodesFromNodeTask(Task):
         d[JSONKeys.RPC] = JSONKeys.RPCs.FIND_NODE
         d[JSONKeys.KEY] = key.base64
 
-        task = controller._network.send(node.address, d, timeout=True)
+        task = controller._send_rpc(node.address, d, timeout=True)
 
         self.hook_task(task)
 
@@ -830,7 +1356,8 @@ class FindNodesFromNodeTask(Task):
 
 
 class FindValueFromNodeTask(Task):
-    def run(self, controller, node, key, index):
+    def run(self, controller, node, key, index, continuation=None,
+    newest=None, min_size=None, max_size=None):
         d = controller._template_dict()
         d[JSONKeys.RPC] = JSONKeys.RPCs.FIND_VALUE
         d[JSONKeys.KEY] = key.base64
@@ -838,7 +1365,13 @@ class FindValueFromNodeTask(Task):
         if index:
             d[JSONKeys.INDEX] = index.base64
 
-        future = controller._network.send(node.address, d, timeout=True)
+        for name, value in ((JSONKeys.CONTINUATION, continuation),
+        (JSONKeys.NEWEST, newest), (JSONKeys.MIN_SIZE, min_size),
+        (JSONKeys.MAX_SIZE, max_size)):
+            if value is not None:
+                d[name] = value
+
+        future = controller._send_rpc(node.address, d, timeout=True)
         data_packet = future.result()
 
         if not data_packet:
@@ -853,10 +1386,18 @@ class FindValueFromNodeTask(Task):
             kvp_info_list = KVPExchangeInfoList.from_json_loadable(
                 dict_obj[JSONKeys.VALUES])
 
-            _logger.debug('Find value %s←%s dictlen=%d',
-                controller.node, node, len(kvp_info_list))
+            index_count = _non_negative_int(
+                dict_obj.get(JSONKeys.INDEX_COUNT))
+            continuation = dict_obj.get(JSONKeys.CONTINUATION)
+
+            if not isinstance(continuation, str):
+                continuation = None
 
-            return FindValueFromNodeResult(kvp_info_list, None)
+            _logger.debug('Find value %s←%s dictlen=%d count=%s',
+                controller.node, node, len(kvp_info_list), index_count)
+
+            return FindValueFromNodeResult(kvp_info_list, None, index_count,
+                continuation)
 
         elif JSONKeys.NODES in dict_obj:
             try:
@@ -880,7 +1421,8 @@ class StoreToNodeTask(Task):
         self.index = args[3]
         self.total_size = len(args[4])
 
-    def run(self, controller, node, key, index, bytes_, timestamp):
+    def run(self, controller, node, key, index, bytes_, timestamp,
+    traffic_class=None):
         d = controller._template_dict()
         d[JSONKeys.RPC] = JSONKeys.RPCs.STORE
         d[JSONKeys.KEY] = key.base64
@@ -890,7 +1432,7 @@ class StoreToNodeTask(Task):
 
         _logger.debug('Uploading to %s', node)
 
-        send_task = controller._network.send(node.address, d, timeout=True)
+        send_task = controller._send_rpc(node.address, d, timeout=True)
 
         self.hook_task(send_task)
 
@@ -902,7 +1444,7 @@ class StoreToNodeTask(Task):
         if JSONKeys.TRANSFER_ID in data_packet.dict_obj:
             transfer_id = data_packet.dict_obj[JSONKeys.TRANSFER_ID]
             send_file_task = controller._network.send_bytes(node.address,
-                transfer_id, bytes_)
+                transfer_id, bytes_, traffic_class=traffic_class)
 
             self.hook_task(send_file_task)
 
@@ -912,12 +1454,21 @@ class StoreToNodeTask(Task):
 
 
 class FindShortlistTask(Task):
-    '''Returns `Shortlist`'''
+    '''Returns `Shortlist`
+
+    :ivar num_hops: The number of lookup iterations done.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        Task.__init__(self, *args, **kwargs)
+        self.num_hops = 0
 
     def run(self, controller, key, index=None, find_nodes=True):
         '''find x loop'''
 
-        shortlist = Shortlist(key, controller._routing_table, controller.node)
+        shortlist = Shortlist(key, controller._routing_table, controller.node,
+            controller.dead_node_cache)
+        start_time = time.monotonic()
 
         while True:
             _logger.debug('Find node/value iteration')
@@ -926,11 +1477,17 @@ class FindShortlistTask(Task):
                 _logger.debug('Find node/value iteration finished')
                 break
 
+            self.num_hops += 1
+
             if find_nodes:
                 self._find_node_iteration(controller, shortlist, key)
             else:
                 self._find_value_iteration(controller, shortlist, key, index)
 
+        lookup = 'node' if find_nodes else 'value'
+        _lookup_hops.labels(lookup).observe(self.num_hops)
+        _lookup_latency.labels(lookup).observe(time.monotonic() - start_time)
+
         _logger.debug('Find node/value done len=%d', len(shortlist.nodes))
 
         return shortlist
@@ -938,16 +1495,20 @@ class FindShortlistTask(Task):
     def _find_node_iteration(self, controller, shortlist, key_obj):
         '''An iteration to find nodes to add to shortlist'''
 
-        nodes = shortlist.get_nodes_for_contacting()
-        things = []
-
-        for node in nodes:
+        def request(node):
             task = controller.find_nodes_from_node(node, key_obj)
 
             self.hook_task(task)
-            things.append((node, task))
 
-        for node, task in things:
+            return task
+
+        hedged_requests = HedgedRequests(controller, request,
+            shortlist.get_node_for_hedging)
+
+        for node in shortlist.get_nodes_for_contacting():
+            hedged_requests.add(node)
+
+        for node, task in hedged_requests.results():
             nodes = task.result()
 
             if nodes is not None:
@@ -963,16 +1524,21 @@ class FindShortlistTask(Task):
     def _find_value_iteration(self, controller, shortlist, key, index):
         '''An iteration to find useful nodes to add to shortlist'''
 
-        nodes = shortlist.get_nodes_for_contacting()
-        things = []
-
-        for node in nodes:
+        def request(node):
             task = controller.find_value_from_node(node, key, index)
 
             self.hook_task(task)
-            things.append((node, task))
 
-        for node, task in things:
+            return task
+
+        hedged_requests = HedgedRequests(controller, request,
+            shortlist.get_node_for_hedging,
+            is_answer_fn=lambda task: bool(task.result_))
+
+        for node in shortlist.get_nodes_for_contacting():
+            hedged_requests.add(node)
+
+        for node, task in hedged_requests.results():
             find_value_result = task.result()
 
             if not find_value_result:
@@ -995,6 +1561,132 @@ class FindShortlistTask(Task):
                 shortlist.mark_node(node, True, True, kvp_info_list)
 
 
+class CheckBucketsTask(Task):
+    '''Pings the oldest node of full buckets and replaces the nodes that
+    do not respond with candidates from the replacement caches.'''
+
+    def run(self, controller, buckets):
+        pings = []
+
+        for bucket in buckets:
+            if not bucket.replacements or not bucket.nodes:
+                continue
+
+            node = bucket.nodes[0]
+
+            if controller.dead_node_cache.is_suspect(node):
+                bucket.node_failed(node)
+                continue
+
+            task = controller.ping_node(node)
+
+            self.hook_task(task)
+            pings.append((node, task))
+
+        for node, task in pings:
+            if not task.result() and self.is_running:
+                controller._node_failed(node)
+
+
+class RefreshBucketsTask(Task):
+    '''Looks up a random key in each of the buckets.
+
+    At most :attr:`DHTNetwork.REFRESH_PARALLELISM` lookups run at the same
+    time. Returns the number of lookups done.
+    '''
+
+    def run(self, controller, bucket_numbers):
+        keys = [random_bucket_key(controller.key, bucket_number)
+            for bucket_number in bucket_numbers]
+
+        _logger.debug('Refresh %d buckets', len(keys))
+
+        return self._find_nodes(controller, keys)
+
+    def _find_nodes(self, controller, keys):
+        keys = collections.deque(keys)
+        done_queue = queue.Queue()
+        num_running = 0
+        num_done = 0
+
+        while (keys or num_running) and self.is_running:
+            while keys and num_running < DHTNetwork.REFRESH_PARALLELISM:
+                task = controller.find_node_shortlist(keys.popleft())
+
+                self.hook_task(task)
+                task.observer.register(done_queue.put)
+                num_running += 1
+
+            done_queue.get()
+            num_running -= 1
+            num_done += 1
+
+        return num_done
+
+
+class BootstrapTask(RefreshBucketsTask):
+    '''Joins the network through several nodes and fills the routing table.
+
+    The known nodes are pinged and asked for nodes close to this node at
+    the same time. Then this node looks up its own key to fill the near
+    buckets and refreshes the buckets farther than its closest contact.
+
+    Returns ``bool``.
+
+    :ivar time_to_ready: The seconds until the routing table was filled or
+        ``None``.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        RefreshBucketsTask.__init__(self, *args, **kwargs)
+        self.time_to_ready = None
+
+    def run(self, controller, addresses):
+        clock = controller._event_scheduler.timer_wheel.clock
+        start_time = clock()
+        nodes = self._ping_addresses(controller, addresses)
+
+        if not nodes:
+            _logger.info('Bootstrap failed. No known node responded.')
+            return False
+
+        find_nodes_tasks = []
+
+        for node in nodes:
+            task = controller.find_nodes_from_node(node, controller.key)
+
+            self.hook_task(task)
+            find_nodes_tasks.append(task)
+
+        for task in find_nodes_tasks:
+            for node in task.result() or ():
+                controller._update_routing_table(node)
+
+        self._find_nodes(controller, [controller.key])
+        self._find_nodes(controller, [random_bucket_key(controller.key,
+            bucket_number) for bucket_number
+            in range(controller._closest_bucket_number())])
+
+        self.time_to_ready = clock() - start_time
+        _bootstrap_time.observe(self.time_to_ready)
+        _logger.info('Routing table ready in %.1fs with %d contacts',
+            self.time_to_ready, controller.routing_table.num_contacts)
+
+        return True
+
+    def _ping_addresses(self, controller, addresses):
+        ping_tasks = []
+
+        for address in addresses:
+            address = (socket.gethostbyname(address[0]),) + address[1:]
+            task = controller.ping_address(address)
+
+            self.hook_task(task)
+            ping_tasks.append(task)
+
+        return [task.result()[1] for task in ping_tasks if task.result()]
+
+
 class JoinNetworkTask(Task):
     def run(self, controller, address):
         _logger.info('Joining network')
@@ -1047,7 +1739,7 @@ class StoreValueTask(Task):
 
         return self._store_to_node_task_observer
 
-    def run(self, controller, key, index):
+    def run(self, controller, key, index, traffic_class=None):
         kvpid = KVPID(key, index)
         kvp_record = controller._kvp_table.record(kvpid)
 
@@ -1065,6 +1757,7 @@ class StoreValueTask(Task):
 
         _logger.debug('Uploading value %s', kvpid)
 
+        value = controller._kvp_table[kvpid]
         store_count = 0
 
         if not nodes and not shortlist.useful_nodes:
@@ -1079,10 +1772,8 @@ class StoreValueTask(Task):
                 except IndexError:
                     break
 
-                value = controller._kvp_table[kvpid]
-
                 task = controller.store_to_node(node, key, index, value,
-                    kvp_record.timestamp)
+                    kvp_record.timestamp, traffic_class)
 
                 self.hook_task(task)
                 self._store_to_node_task_observer(True, task)
@@ -1107,6 +1798,13 @@ class GetValueTask(Task):
         self._controller = controller
         self._key = key
         self._index = index
+
+        if controller.no_value_cache.contains(key, index):
+            _logger.debug('Value recently not found %s:%s', key.base16,
+                index.base16)
+            _no_value_hits.inc()
+            return None
+
         find_value_task = controller.find_value_shortlist(key, index)
 
         self.hook_task(find_value_task)
@@ -1115,11 +1813,15 @@ class GetValueTask(Task):
         self._useful_node_list = NodeList(self._shortlist.useful_nodes)
 
         if not self._useful_node_list:
+            if self.is_running:
+                controller.no_value_cache.add(key, index)
+
             return None
 
         self._useful_node_list.sort_distance(key)
         self._kvp_exchange_info = self._shortlist.get_common_kvp_exchange_info(
             key, index)
+        self._data_size = self._kvp_exchange_info.size
 
         for dummy in range(3):
             self._file = io.BytesIO()
@@ -1129,32 +1831,47 @@ class GetValueTask(Task):
             else:
                 self._file = None
 
-            if self.is_running:
+            if not self.is_running:
                 return
 
-        if self.file:
+        if self._file:
             self._replicate_value()
 
-            return self._file.value()
+            return self._file.getvalue()
 
     def _download_round(self):
         _logger.debug('Download round')
 
-        for node in self._useful_node_list:
+        nodes = iter(self._useful_node_list)
+
+        def request(node):
             download_task = self._controller.get_value_from_node(node,
                 self._key, self._index, offset=self._file.tell())
 
             self.hook_task(download_task)
 
-            transfered_file = download_task.result()
-            data = transfered_file.read()
+            return download_task
+
+        for node in nodes:
+            # A download stalled before its first bytes is retried on the
+            # next node and the first one sending data is kept
+            hedged_requests = HedgedRequests(self._controller, request,
+                lambda: next(nodes, None),
+                is_answer_fn=lambda task: task.progress,
+                is_waiting_fn=lambda task: task.progress is None)
+
+            hedged_requests.add(node)
+
+            for node, download_task in hedged_requests.results():
+                transfered_file = download_task.result()
+                data = transfered_file.read()
 
-            self._file.write(data)
+                self._file.write(data)
 
             if self._file.tell() >= self._data_size:
                 break
 
-        return self._index.validate_value(data)
+        return self._index.validate_value(self._file.getvalue())
 
     def _replicate_value(self):
         node_list = self._shortlist.sorted_nodes
@@ -1166,7 +1883,7 @@ class GetValueTask(Task):
                 _logger.debug('Replicating value')
 
                 self._controller.store_to_node(node, self._key, self._index,
-                    self._file.value(), self._kvp_exchange_info.timestamp)
+                    self._file.getvalue(), self._kvp_exchange_info.timestamp)
 
 
 class ReadStoreFromNodeTask(DownloadTask):
@@ -1,5 +1,9 @@
-from bytestag.dht.network import DHTNetwork, FindValueFromNodeResult
-from bytestag.events import EventReactor, EventScheduler
+from bytestag.dht.models import NodeList
+from bytestag.dht.network import (DHTNetwork, FindValueFromNodeResult,
+    HedgeBudget, HedgedRequests, NoValueCache, Shortlist, CheckBucketsTask)
+from bytestag.dht.tables import (Node, RoutingTable, DeadNodeCache, Bucket,
+    BucketFullError)
+from bytestag.events import EventReactor, EventScheduler, Task
 from bytestag.keys import KeyBytes
 from bytestag.storage import MemoryKVPTable
 from bytestag.tables import KVPID
@@ -120,6 +124,32 @@ class TestNetworkControllerMultiNode(unittest.TestCase):
         self.assertTrue(self.stuff['contacts'])
         self.assertGreaterEqual(len(self.stuff['contacts']), num_nodes / 2)
 
+    def test_bootstrap(self):
+        '''It should join through several nodes and fill the routing table'''
+
+        num_nodes = 6
+        self.setup_nodes(num_nodes)
+
+        for i in range(2, num_nodes):
+            self.assertTrue(self.nc[i].join_network(
+                self.nc[i % 2].address).result())
+
+        task = self.nc[0].bootstrap([self.nc[1].address,
+            self.nc[2].address])
+
+        self.assertTrue(task.result())
+        self.assertIsNotNone(task.time_to_ready)
+
+        task = self.nc[1].refresh_buckets([0, 1])
+
+        self.assertEqual(2, task.result())
+
+        self.stop_event_reactors()
+        self.join_event_reactors()
+
+        for i in range(1, num_nodes):
+            self.assertIn(self.nc[i].node, self.nc[0].routing_table)
+
     def test_find_binary_value_size_from_node(self):
         '''It should get the size of the data from the node'''
 
@@ -143,6 +173,58 @@ class TestNetworkControllerMultiNode(unittest.TestCase):
 
         self.assertIsInstance(find_value_result, FindValueFromNodeResult)
         self.assertEqual(len(data), find_value_result.kvp_info_list[0].size)
+        self.assertEqual(1, find_value_result.index_count)
+        self.assertIsNone(find_value_result.continuation)
+
+    def test_find_value_pages(self):
+        '''It should reply the values of a key in pages'''
+
+        self.setup_nodes(2)
+
+        key = KeyBytes()
+        kvp_table = MemoryKVPTable()
+        self.nc[1]._kvp_table = kvp_table
+        self.nc[1].FIND_VALUE_PAGE_SIZE = 4
+
+        for size in range(1, 11):
+            value = b'x' * size
+            kvpid = KVPID(key, KeyBytes.new_hash(value))
+            kvp_table[kvpid] = value
+            kvp_table.record(kvpid).timestamp = 1000 + size
+
+        future = self.nc[0].join_network(self.nc[1].address)
+
+        self.assertTrue(future.result())
+
+        sizes = []
+        continuation = None
+
+        for dummy in range(3):
+            result = self.nc[0].find_value_from_node(self.nc[1].node, key,
+                continuation=continuation).result()
+            continuation = result.continuation
+
+            self.assertEqual(10, result.index_count)
+            sizes.extend(kvp_info.size for kvp_info in result.kvp_info_list)
+
+        self.assertIsNone(continuation)
+        self.assertEqual(list(range(1, 11)), sorted(sizes))
+
+        result = self.nc[0].find_value_from_node(self.nc[1].node, key,
+            newest=2).result()
+
+        self.assertEqual([10, 9],
+            [kvp_info.size for kvp_info in result.kvp_info_list])
+        self.assertIsNone(result.continuation)
+
+        result = self.nc[0].find_value_from_node(self.nc[1].node, key,
+            min_size=3, max_size=5).result()
+
+        self.assertEqual([3, 4, 5],
+            sorted(kvp_info.size for kvp_info in result.kvp_info_list))
+
+        self.stop_event_reactors()
+        self.join_event_reactors()
 
     def test_get_value_from_other_node(self):
         '''It should download the value from the other node'''
@@ -204,3 +286,260 @@ class TestNetworkControllerMultiNode(unittest.TestCase):
 
         self.stop_event_reactors()
         self.join_event_reactors()
+
+
+class TestHedgeBudget(unittest.TestCase):
+    def test_budget(self):
+        '''It should allow a hedged request for every few requests'''
+
+        budget = HedgeBudget(ratio=0.5, burst=2)
+
+        self.assertTrue(budget.take())
+        self.assertTrue(budget.take())
+        self.assertFalse(budget.take())
+
+        budget.add_request()
+
+        self.assertFalse(budget.take())
+
+        budget.add_request()
+
+        self.assertTrue(budget.take())
+
+        for dummy in range(10):
+            budget.add_request()
+
+        self.assertEqual(2, budget.tokens)
+
+
+class ReplyTask(Task):
+    def run(self, event, reply):
+        event.wait()
+
+        return reply
+
+
+class MockHedgeController(object):
+    def __init__(self, hedging=True):
+        self._event_scheduler = EventScheduler(EventReactor())
+        self.hedging = hedging
+        self.hedge_budget = HedgeBudget()
+
+    def hedge_delay(self, node):
+        return 0.1
+
+
+class TestHedgedRequests(unittest.TestCase):
+    TIMEOUT = 5
+
+    def setUp(self):
+        self.events = {}
+        self.tasks = {}
+        self.nodes = [Node(KeyBytes(), ('127.0.0.1', port))
+            for port in range(1, 4)]
+        self.next_nodes = list(self.nodes[1:])
+        self.slow_nodes = {self.nodes[0]}
+
+    def tearDown(self):
+        for event in self.events.values():
+            event.set()
+
+    def request(self, node):
+        event = threading.Event()
+        task = ReplyTask(event, node.address[1])
+        thread = threading.Thread(target=task)
+        thread.daemon = True
+        thread.start()
+
+        self.events[node] = event
+        self.tasks[node] = task
+
+        if node not in self.slow_nodes:
+            event.set()
+
+        return task
+
+    def next_node(self):
+        if self.next_nodes:
+            return self.next_nodes.pop(0)
+
+    def test_hedge(self):
+        '''It should send the request to the next node when a node is slow
+        and use the first reply'''
+
+        hedged_requests = HedgedRequests(MockHedgeController(), self.request,
+            self.next_node)
+
+        hedged_requests.add(self.nodes[0])
+
+        self.assertEqual([(self.nodes[1], 2)],
+            [(node, task.result(self.TIMEOUT))
+                for node, task in hedged_requests.results()])
+        self.assertFalse(self.tasks[self.nodes[0]].is_running)
+
+    def test_no_hedge(self):
+        '''It should wait for the node if hedging is off'''
+
+        hedged_requests = HedgedRequests(MockHedgeController(False),
+            self.request, self.next_node)
+
+        hedged_requests.add(self.nodes[0])
+        time.sleep(0.3)
+        self.events[self.nodes[0]].set()
+
+        self.assertEqual([(self.nodes[0], 1)],
+            [(node, task.result(self.TIMEOUT))
+                for node, task in hedged_requests.results()])
+        self.assertEqual([self.nodes[0]], list(self.events))
+
+    def test_budget_spent(self):
+        '''It should not hedge when the budget is spent'''
+
+        controller = MockHedgeController()
+        controller.hedge_budget = HedgeBudget(burst=0)
+        hedged_requests = HedgedRequests(controller, self.request,
+            self.next_node)
+
+        hedged_requests.add(self.nodes[0])
+        time.sleep(0.3)
+        self.events[self.nodes[0]].set()
+
+        self.assertEqual([self.nodes[0]],
+            [node for node, task in hedged_requests.results()])
+        self.assertEqual([self.nodes[0]], list(self.events))
+
+
+class TestNoValueCache(unittest.TestCase):
+    def test_expire(self):
+        '''It should remember a missing value for a while'''
+
+        now = 0
+        no_value_cache = NoValueCache(ttl=30, clock=lambda: now)
+        key = KeyBytes()
+        index = KeyBytes()
+
+        no_value_cache.add(key, index)
+
+        self.assertTrue(no_value_cache.contains(key, index))
+        self.assertFalse(no_value_cache.contains(key, key))
+
+        now = 30
+
+        self.assertFalse(no_value_cache.contains(key, index))
+        self.assertEqual(0, len(no_value_cache))
+
+    def test_discard(self):
+        '''It should forget a missing value that is stored'''
+
+        no_value_cache = NoValueCache()
+        key = KeyBytes()
+
+        no_value_cache.add(key, key)
+        no_value_cache.discard(key, key)
+
+        self.assertFalse(no_value_cache.contains(key, key))
+
+    def test_get_value_skips_lookup(self):
+        '''It should not look up a value that was not found recently'''
+
+        event_reactor = EventReactor()
+        thread = threading.Thread(target=event_reactor.start)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            dht_network = DHTNetwork(event_reactor, MemoryKVPTable())
+            key = KeyBytes()
+
+            lookups = []
+
+            dht_network.find_value_shortlist = lambda *args: \
+                lookups.append(args)
+            dht_network.no_value_cache.add(key, key)
+
+            self.assertIsNone(dht_network.get_value(key, key).result(5))
+            self.assertFalse(lookups)
+        finally:
+            event_reactor.put(EventReactor.STOP_ID)
+
+
+class TestShortlist(unittest.TestCase):
+    def test_dead_nodes(self):
+        '''It should record nodes that do not respond and not add them to
+        later shortlists'''
+
+        dead_node_cache = DeadNodeCache()
+        key = KeyBytes()
+        server_node = Node(KeyBytes(), ('127.0.0.1', 1))
+        nodes = [Node(KeyBytes(), ('127.0.0.1', port))
+            for port in range(2, 6)]
+        shortlist = Shortlist(key, RoutingTable(), server_node,
+            dead_node_cache)
+
+        shortlist.add_nodes(nodes)
+
+        for node in shortlist.get_nodes_for_contacting(len(nodes)):
+            shortlist.mark_node(node, node != nodes[0])
+
+        self.assertTrue(dead_node_cache.is_suspect(nodes[0]))
+        self.assertFalse(dead_node_cache.is_suspect(nodes[1]))
+        self.assertEqual(set(nodes[1:]), shortlist.nodes)
+
+        shortlist = Shortlist(key, RoutingTable(), server_node,
+            dead_node_cache)
+
+        shortlist.add_nodes(nodes)
+
+        self.assertEqual(set(nodes[1:]), shortlist.nodes)
+
+
+class TestCheckBucketsTask(unittest.TestCase):
+    def test_replace_dead_node(self):
+        '''It should replace the oldest node of a full bucket if it is
+        known to be dead'''
+
+        dead_node_cache = DeadNodeCache()
+        dht_network = DHTNetwork(EventReactor(), MemoryKVPTable(),
+            dead_node_cache=dead_node_cache)
+        bucket = Bucket(0)
+        nodes = [Node(KeyBytes(), ('127.0.0.1', port))
+            for port in range(1, Bucket.MAX_BUCKET_SIZE + 2)]
+
+        for node in nodes[:-1]:
+            bucket.node_update(node)
+
+        self.assertRaises(BucketFullError, bucket.node_update, nodes[-1])
+
+        dead_node_cache.mark_failed(nodes[0])
+        CheckBucketsTask(dht_network, [bucket])()
+
+        self.assertNotIn(nodes[0], bucket)
+        self.assertIn(nodes[-1], bucket)
+
+
+class TestNodeListEncoding(unittest.TestCase):
+    def test_cache(self):
+        '''It should encode each node of the routing table once'''
+
+        dht_network = DHTNetwork(EventReactor(), MemoryKVPTable(),
+            dead_node_cache=DeadNodeCache())
+        nodes = [Node(KeyBytes(), ('127.0.0.1', port))
+            for port in range(1, 4)]
+
+        for node in nodes[:2]:
+            dht_network.routing_table.node_update(node)
+
+        node_list = dht_network._node_list_dumpable(nodes[:2])
+
+        self.assertEqual(NodeList(nodes[:2]).to_json_dumpable(), node_list)
+        self.assertIs(node_list[0],
+            dht_network._node_list_dumpable(nodes[:1])[0])
+
+        dht_network.routing_table.node_update(nodes[2])
+
+        self.assertEqual(NodeList(nodes).to_json_dumpable(),
+            dht_network._node_list_dumpable(nodes))
+        self.assertEqual(dht_network._template_dict(),
+            dht_network._template_dict())
+        self.assertIsNot(dht_network._template_dict(),
+            dht_network._template_dict())
@@ -6,11 +6,13 @@ or replicate.
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.bandwidth import TrafficClasses
 from bytestag.dht.network import DHTNetwork
 from bytestag.events import (EventReactorMixin, EventScheduler, EventID,
-    asynchronous)
-from bytestag.queue import BigDiskQueue
+    asynchronous, TaskPriorities)
+from bytestag.queue import BigDiskQueue, KVPIDCodec
 import logging
+import queue
 import threading
 import time
 
@@ -37,23 +39,51 @@ class Replicator(EventReactorMixin):
         self._timer_id = EventID(self, 'Replicate')
         self._thread_event = threading.Event()
         self._fn_task_slot = fn_task_slot
+        self._loop_lock = threading.Lock()
+        self._loop_thread = None
+        self._running = True
 
         self._event_reactor.register_handler(self._timer_id, self._timer_cb)
         self._event_scheduler.add_periodic(DHTNetwork.TIME_REPLICATE,
             self._timer_id)
-        self._loop()
+
+    def stop(self, timeout=None):
+        '''Stop replicating and wait for the replication loop to end.'''
+
+        with self._loop_lock:
+            self._running = False
+            loop_thread = self._loop_thread
+
+        self._thread_event.set()
+
+        if loop_thread:
+            loop_thread.join(timeout)
 
     def _timer_cb(self, event_id):
+        with self._loop_lock:
+            if not self._running:
+                return
+
+            if not self._loop_thread:
+                self._loop_thread = self._loop()
+
         self._thread_event.set()
 
     @asynchronous(name='Replicate Values')
     def _loop(self):
-        while True:
+        while self._running:
             self._thread_event.wait()
-            _logger.debug('Replicating values')
             self._thread_event.clear()
 
+            if not self._running:
+                break
+
+            _logger.debug('Replicating values')
+
             for kvpid in self._kvp_table.keys():
+                if not self._running:
+                    return
+
                 kvp_record = self._kvp_table.record(kvpid)
 
                 if kvp_record.is_original:
@@ -65,7 +95,10 @@ class Replicator(EventReactorMixin):
 
                 _logger.debug('Replicating value %s', kvpid)
                 self._fn_task_slot.add(self._dht_network.store_value,
-                    kvpid.key, kvpid.index)
+                    kvpid.key, kvpid.index,
+                    traffic_class=TrafficClasses.REPLICATE,
+                    priority=TaskPriorities.BACKGROUND,
+                    fairness_key=kvpid.key)
 
             _logger.debug('Value replication finished')
 
@@ -84,6 +117,7 @@ class Publisher(EventReactorMixin):
     '''Publishes values typically created by the client.'''
 
     REPUBLISH_CHECK_INTERVAL = 3600
+    STOP_CHECK_INTERVAL = 0.5  # seconds
 
     def __init__(self, event_reactor, dht_network, kvp_table, fn_task_slot):
         '''
@@ -103,8 +137,13 @@ class Publisher(EventReactorMixin):
         self._scheduled_kvpids = set()
         self._schedule_lock = threading.Lock()
         self._scan_event = threading.Event()
-        self._publish_queue = BigDiskQueue()
+        self._publish_queue = BigDiskQueue(memory_size=1000,
+            codec=KVPIDCodec)
         self._fn_task_slot = fn_task_slot
+        self._loops_lock = threading.Lock()
+        self._scan_loop_thread = None
+        self._publish_loop_thread = None
+        self._running = True
 
         self._event_reactor.register_handler(self._schedule_id,
             self._publish_cb)
@@ -112,20 +151,36 @@ class Publisher(EventReactorMixin):
         self._kvp_table.value_changed_observer.register(self._table_change_cb)
 
         self._event_scheduler.add_periodic(Publisher.REPUBLISH_CHECK_INTERVAL,
-            self._timer_cb)
+            self._timer_id)
 
-        self._scan_loop()
-        self._publish_loop()
+    def stop(self, timeout=None):
+        '''Stop publishing and wait for the loops to end.'''
+
+        with self._loops_lock:
+            self._running = False
+            loop_threads = (self._scan_loop_thread, self._publish_loop_thread)
+
+        self._scan_event.set()
+
+        for loop_thread in loop_threads:
+            if loop_thread:
+                loop_thread.join(timeout)
 
     @asynchronous(name='Publish loop')
     def _publish_loop(self):
-        while True:
-            kvpid = self._publish_queue.get()
+        while self._running:
+            try:
+                kvpid = self._publish_queue.get(
+                    timeout=Publisher.STOP_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
 
             _logger.debug('Publishing %s', kvpid)
 
             self._fn_task_slot.add(self._dht_network.store_value, kvpid.key,
-                kvpid.index)
+                kvpid.index, traffic_class=TrafficClasses.PUBLISH,
+                priority=TaskPriorities.BACKGROUND,
+                fairness_key=kvpid.key)
 
     def _schedule_for_publish(self, abs_time, kvpid):
         with self._schedule_lock:
@@ -137,24 +192,48 @@ class Publisher(EventReactorMixin):
         self._event_scheduler.add_absolute(abs_time, self._schedule_id, kvpid)
 
     def _publish_cb(self, event_id, kvpid):
+        with self._loops_lock:
+            if not self._running:
+                return
+
+            if not self._publish_loop_thread:
+                self._publish_loop_thread = self._publish_loop()
+
         self._publish_queue.put(kvpid)
 
     def _table_change_cb(self, *args):
-        self._scan_event.set()
+        self._wake_scan_loop()
 
     def _timer_cb(self, event_id):
+        self._wake_scan_loop()
+
+    def _wake_scan_loop(self):
+        with self._loops_lock:
+            if not self._running:
+                return
+
+            if not self._scan_loop_thread:
+                self._scan_loop_thread = self._scan_loop()
+
         self._scan_event.set()
 
     @asynchronous(name='Publish scan loop')
     def _scan_loop(self):
-        while True:
+        while self._running:
             self._scan_event.wait()
-            _logger.debug('Scanning database for publishing')
             self._scan_event.clear()
 
+            if not self._running:
+                break
+
+            _logger.debug('Scanning database for publishing')
+
             current_time = time.time()
 
             for kvpid in self._kvp_table.keys():
+                if not self._running:
+                    return
+
                 kvp_record = self._kvp_table.record(kvpid)
 
                 if not kvp_record.is_original:
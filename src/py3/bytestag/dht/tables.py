@@ -3,6 +3,7 @@
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
 from bytestag.keys import KeyBytes, compute_bucket_number
+import collections
 import io
 import logging
 import random
@@ -89,17 +90,21 @@ class Bucket(object):
     '''A bucket of nodes.
 
     This class supports container methods with :class:`Node`.
+
+    Once the bucket is full, new nodes go to a replacement cache holding
+    the most recently seen candidates. A candidate takes the place of a
+    node that fails.
     '''
 
     MAX_BUCKET_SIZE = 20  # constant k
+    MAX_REPLACEMENTS = 20
 
     def __init__(self, number):
         self._number = number
         self._lock = threading.Lock()
         self._nodes = []
+        self._replacements = collections.OrderedDict()
         self._last_update = 0
-        self._full = False
-        self._new_node = None
 
     @property
     def number(self):
@@ -120,6 +125,15 @@ class Bucket(object):
 
         return self._nodes
 
+    @property
+    def replacements(self):
+        '''The replacement candidates, most recently seen last
+
+        :rtype: ``list``
+        '''
+
+        return list(self._replacements)
+
     @property
     def last_update(self):
         '''Return the time the bucket was last updated'''
@@ -150,75 +164,174 @@ class Bucket(object):
     def node_update(self, node):
         '''Add or move the node to end of list
 
-        Once the bucket is full, the bucket is locked and any other nodes
-        are ignored. To unlock the bucket, call either `keep_old_node` or
-        `keep_new_node`.
+        If the bucket is full, the node is added to the replacement cache
+        instead. The oldest node should then be checked and passed to
+        `node_failed` if it does not respond.
 
-        :raise BucketFullError: bucket is full
+        :raise BucketFullError: bucket is full. The exception holds the
+            oldest node.
         '''
 
         _logger.debug('Bucket %s node update %s', self, node)
 
         with self._lock:
-            if self._full:
-                # The paper doesn't say what happens now, so we are ignoring
-                # new nodes
-                _logger.debug('Bucket %s full, ignored node update %s, ',
-                    self, node)
+            if node in self._nodes:
+                self._nodes.remove(node)
+                self._nodes.append(node)
+                self._last_update = time.time()
                 return
 
             if len(self._nodes) < Bucket.MAX_BUCKET_SIZE:
-                if node in self._nodes:
-                    self._nodes.remove(node)
-
+                self._replacements.pop(node, None)
                 self._nodes.append(node)
                 self._last_update = time.time()
-            else:
-                self._full = True
-                self._new_node = node
+                return
 
-                raise BucketFullError(node=self._nodes[0], bucket=self)
+            self._replacements.pop(node, None)
+            self._replacements[node] = None
 
-    def keep_old_node(self):
-        '''Keep the old node
+            if len(self._replacements) > Bucket.MAX_REPLACEMENTS:
+                self._replacements.popitem(last=False)
 
-        The old node has responded
-        '''
+            oldest_node = self._nodes[0]
+
+        raise BucketFullError(node=oldest_node, bucket=self)
+
+    def node_failed(self, node):
+        '''Replace a node that did not respond
 
-        assert self._full
+        The node is replaced by the most recently seen candidate. If there
+        are no candidates, the node is kept.
+
+        :return: The replacement `Node` or ``None``.
+        '''
 
         with self._lock:
-            self._full = False
+            self._replacements.pop(node, None)
+
+            if node not in self._nodes or not self._replacements:
+                return
+
+            new_node = self._replacements.popitem()[0]
+
+            self._nodes.remove(node)
+            self._nodes.append(new_node)
             self._last_update = time.time()
 
-    def keep_new_node(self):
-        '''Keep the new node
+        _logger.debug('Bucket %s drop %s add %s', self._number, node,
+            new_node)
+
+        return new_node
+
+
+class DeadNodeCache(object):
+    '''Remembers nodes that did not respond.
+
+    A node that fails is suspect until its backoff time passes. The backoff
+    doubles with each failure in a row, up to `MAX_BACKOFF`. Once the
+    backoff passes, the node may be contacted again and a reply clears it.
+
+    This class is thread-safe.
+    '''
+
+    INITIAL_BACKOFF = 30  # seconds
+    MAX_BACKOFF = 3600  # seconds
+    MAX_NODES = 16384
 
-        The old node has *not* responded
+    def __init__(self, initial_backoff=INITIAL_BACKOFF,
+    max_backoff=MAX_BACKOFF, max_nodes=MAX_NODES, clock=time.time):
         '''
+        :param max_nodes: The maximum number of nodes remembered. The
+            oldest failures are forgotten first.
+        :param clock: A function returning the current time in seconds.
+        '''
+
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._max_nodes = max_nodes
+        self._clock = clock
+        self._nodes = collections.OrderedDict()  # node → (failures, until)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
 
-        assert self._full
+    def mark_failed(self, node):
+        '''Record that the node did not respond.'''
 
         with self._lock:
-            self._full = False
+            num_failures = self._nodes.pop(node, (0, None))[0] + 1
+            backoff = min(self._max_backoff,
+                self._initial_backoff * 2 ** (num_failures - 1))
+            self._nodes[node] = (num_failures, self._clock() + backoff)
 
-            self._nodes.pop(0)
-            self._nodes.append(self._new_node)
-            self._last_update = time.time()
+            if len(self._nodes) > self._max_nodes:
+                self._nodes.popitem(last=False)
+
+    def mark_alive(self, node):
+        '''Record that the node responded.'''
+
+        if node in self._nodes:
+            with self._lock:
+                self._nodes.pop(node, None)
+
+    def is_suspect(self, node):
+        '''Return whether the node should not be contacted yet.'''
+
+        entry = self._nodes.get(node)
+
+        return entry is not None and self._clock() < entry[1]
+
+    def num_failures(self, node):
+        '''Return the number of failures in a row of the node.'''
+
+        return self._nodes.get(node, (0, None))[0]
+
+
+_default_dead_node_cache = None
+_default_dead_node_cache_lock = threading.Lock()
+
+
+def default_dead_node_cache():
+    '''Return the process-wide :class:`DeadNodeCache`.'''
+
+    global _default_dead_node_cache
+
+    with _default_dead_node_cache_lock:
+        if _default_dead_node_cache is None:
+            _default_dead_node_cache = DeadNodeCache()
+
+    return _default_dead_node_cache
 
 
 class RoutingTable(object):
     '''A list of buckets'''
 
-    def __init__(self, key=None):
+    def __init__(self, key=None, dead_node_cache=None):
+        '''
+        :param dead_node_cache: A :class:`DeadNodeCache`. Suspect nodes are
+            not returned by :func:`get_close_nodes`.
+        '''
+
         self._buckets = tuple(Bucket(i) for i in range(KeyBytes.BIT_SIZE))
         self._key = key or KeyBytes()
+        self._dead_node_cache = dead_node_cache
+        self._version = 0
 
     @property
     def buckets(self):
         '''The buckets'''
         return self._buckets
 
+    @property
+    def version(self):
+        '''A number that changes whenever a node is added or removed
+
+        Use it to tell whether things computed from the nodes are stale.
+        '''
+
+        return self._version
+
     @property
     def num_contacts(self):
         '''Return number of contacts'''
@@ -279,9 +392,29 @@ class RoutingTable(object):
             raise ValueError('Cannot add node that has our node id')
 
         bucket = self.get_bucket(node)
+        is_new = node not in bucket
 
         bucket.node_update(node)
 
+        if is_new:
+            self._version += 1
+
+    def node_failed(self, node):
+        '''Call the appropriate bucket failure
+
+        :see: :func:`Bucket.node_failed`
+        '''
+
+        bucket = self.get_bucket(node)
+
+        if bucket:
+            new_node = bucket.node_failed(node)
+
+            if new_node:
+                self._version += 1
+
+            return new_node
+
     def get_close_nodes(self, key, count=3):
         '''Return the closest nodes to a key
 
@@ -295,22 +428,25 @@ class RoutingTable(object):
         :rtype: ``list``
         '''
 
-        bucket_number = compute_bucket_number(self._key, key)
-        bucket = self._buckets[bucket_number]
+        # Our own key has no bucket, so use the closest one
+        bucket_number = min(compute_bucket_number(self._key, key),
+            KeyBytes.BIT_SIZE - 1)
+        bucket_nodes = self._live_nodes(self._buckets[bucket_number])
 
-        if len(bucket) >= count:
-            return random.sample(bucket.nodes, count)
+        if len(bucket_nodes) >= count:
+            return random.sample(bucket_nodes, count)
 
         # Pick nodes from random buckets
-        nodes = set(bucket.nodes)
+        nodes = set(bucket_nodes)
         buckets = list(self._buckets)
 
         random.shuffle(buckets)
 
         for bucket in buckets:
-            num_needed = min(len(bucket), count - len(nodes))
+            bucket_nodes = self._live_nodes(bucket)
+            num_needed = min(len(bucket_nodes), count - len(nodes))
 
-            for contact in random.sample(bucket.nodes, num_needed):
+            for contact in random.sample(bucket_nodes, num_needed):
                 nodes.add(contact)
 
             if len(nodes) == count:
@@ -322,6 +458,15 @@ class RoutingTable(object):
 
         return list(nodes)
 
+    def _live_nodes(self, bucket):
+        '''Return the nodes of the bucket that are not suspect.'''
+
+        if self._dead_node_cache is None or not len(self._dead_node_cache):
+            return bucket.nodes
+
+        return [node for node in bucket.nodes
+            if not self._dead_node_cache.is_suspect(node)]
+
     def count_close(self, key):
         '''Return the number of node closer than the given key'''
 
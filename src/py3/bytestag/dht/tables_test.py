@@ -1,5 +1,6 @@
 '''Tables test'''
-from bytestag.dht.tables import Node, RoutingTable, Bucket, BucketFullError
+from bytestag.dht.tables import (Node, RoutingTable, Bucket, BucketFullError,
+    DeadNodeCache)
 from bytestag.keys import KeyBytes
 import logging
 import os
@@ -61,6 +62,54 @@ class TestRoutingTable(unittest.TestCase):
             else:
                 rt.node_update(node)
 
+    def test_replacement_cache(self):
+        '''It should keep new nodes of a full bucket as candidates to replace
+        nodes that fail'''
+
+        bucket = Bucket(0)
+        nodes = [Node(KeyBytes(), ('10.0.0.0', port))
+            for port in range(Bucket.MAX_BUCKET_SIZE + 2)]
+
+        for node in nodes[:Bucket.MAX_BUCKET_SIZE]:
+            bucket.node_update(node)
+
+        self.assertIsNone(bucket.node_failed(nodes[0]))
+        self.assertIn(nodes[0], bucket)
+
+        for node in nodes[Bucket.MAX_BUCKET_SIZE:]:
+            with self.assertRaises(BucketFullError) as context:
+                bucket.node_update(node)
+
+            self.assertEqual(nodes[0], context.exception.node)
+
+        self.assertEqual(nodes[Bucket.MAX_BUCKET_SIZE:], bucket.replacements)
+        self.assertEqual(nodes[-1], bucket.node_failed(nodes[0]))
+        self.assertNotIn(nodes[0], bucket)
+        self.assertEqual(nodes[-1], bucket.nodes[-1])
+        self.assertEqual([nodes[-2]], bucket.replacements)
+
+        bucket.node_update(nodes[1])
+
+        self.assertEqual(nodes[1], bucket.nodes[-1])
+
+    def test_version(self):
+        '''It should change the version when nodes are added or replaced'''
+
+        rt = RoutingTable()
+        node = Node(KeyBytes(), ('10.0.0.0', 8000))
+        version = rt.version
+
+        rt.node_update(node)
+
+        self.assertNotEqual(version, rt.version)
+
+        version = rt.version
+
+        rt.node_update(node)
+        rt.node_failed(node)
+
+        self.assertEqual(version, rt.version)
+
     def test_add_self(self):
         '''It should not add a Node with a KeyBytes that is ours'''
 
@@ -70,3 +119,81 @@ class TestRoutingTable(unittest.TestCase):
 
         self.assertRaises(ValueError, rt.node_update, node)
         self.assertFalse(node in rt)
+
+    def test_close_nodes_to_self(self):
+        '''It should return the nodes close to our own key'''
+
+        key = KeyBytes()
+        rt = RoutingTable(key=key)
+        node = Node(KeyBytes(), ('10.0.0.0', 1234))
+
+        rt.node_update(node)
+
+        self.assertEqual([node], rt.get_close_nodes(key))
+
+    def test_close_nodes_skip_suspect(self):
+        '''It should not return nodes that did not respond recently'''
+
+        dead_node_cache = DeadNodeCache()
+        routing_table = RoutingTable(dead_node_cache=dead_node_cache)
+        nodes = [Node(KeyBytes(), ('10.0.0.0', port))
+            for port in range(1, 11)]
+
+        for node in nodes:
+            routing_table.node_update(node)
+
+        for node in nodes[:5]:
+            dead_node_cache.mark_failed(node)
+
+        close_nodes = routing_table.get_close_nodes(KeyBytes(), 10)
+
+        self.assertEqual(set(nodes[5:]), set(close_nodes))
+
+
+class TestDeadNodeCache(unittest.TestCase):
+    def test_backoff(self):
+        '''It should double the time a node is suspect after each failure'''
+
+        now = 0
+        dead_node_cache = DeadNodeCache(initial_backoff=10, max_backoff=30,
+            clock=lambda: now)
+        node = Node(KeyBytes(), ('10.0.0.0', 8000))
+
+        self.assertFalse(dead_node_cache.is_suspect(node))
+
+        dead_node_cache.mark_failed(node)
+        now = 9
+        self.assertTrue(dead_node_cache.is_suspect(node))
+        now = 10
+        self.assertFalse(dead_node_cache.is_suspect(node))
+
+        dead_node_cache.mark_failed(node)
+        now = 29
+        self.assertTrue(dead_node_cache.is_suspect(node))
+        now = 30
+
+        dead_node_cache.mark_failed(node)
+        now = 59
+        self.assertTrue(dead_node_cache.is_suspect(node))
+        now = 60
+        self.assertFalse(dead_node_cache.is_suspect(node))
+        self.assertEqual(3, dead_node_cache.num_failures(node))
+
+        dead_node_cache.mark_failed(node)
+        dead_node_cache.mark_alive(node)
+
+        self.assertFalse(dead_node_cache.is_suspect(node))
+        self.assertEqual(0, dead_node_cache.num_failures(node))
+
+    def test_max_nodes(self):
+        '''It should forget the oldest failures'''
+
+        dead_node_cache = DeadNodeCache(max_nodes=2)
+        nodes = [Node(KeyBytes(), ('10.0.0.0', port)) for port in range(3)]
+
+        for node in nodes:
+            dead_node_cache.mark_failed(node)
+
+        self.assertEqual(2, len(dead_node_cache))
+        self.assertFalse(dead_node_cache.is_suspect(nodes[0]))
+        self.assertTrue(dead_node_cache.is_suspect(nodes[2]))
@@ -2,21 +2,34 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.metrics import default_registry
 from concurrent.futures.thread import ThreadPoolExecutor
 from queue import Queue
 from threading import Lock
 from weakref import WeakValueDictionary
+import collections
 import functools
-import heapq
 import inspect
 import itertools
 import logging
+import math
 import queue
+import sys
 import threading
 import time
+import traceback
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
+_queue_depth = default_registry().gauge('bytestag_event_queue_depth',
+    'Events waiting in all event reactors')
+_dispatch_latency = default_registry().histogram(
+    'bytestag_event_dispatch_latency_seconds',
+    'Time events wait in the event reactor queue')
+_slot_running = default_registry().gauge('bytestag_task_slot_running',
+    'Tasks running in all FnTaskSlots')
+_slot_queued = default_registry().gauge('bytestag_task_slot_queued',
+    'Functions waiting in all FnTaskSlots')
 
 
 class EventID(object):
@@ -51,6 +64,234 @@ class EventID(object):
         return self._args != other
 
 
+def handler_name(handler_callback):
+    '''Return a readable name of a callback function.'''
+
+    name = getattr(handler_callback, '__qualname__', None)
+
+    if not name:
+        return repr(handler_callback)
+
+    return '{}.{}'.format(getattr(handler_callback, '__module__', '?'), name)
+
+
+def event_type_name(event_id):
+    '''Return a name grouping event IDs of the same kind.
+
+    Event IDs of the same class, and :class:`EventID` with the same owner
+    class and description, share a name.
+    '''
+
+    if isinstance(event_id, EventID):
+        owner = event_id.args[0]
+
+        if not isinstance(owner, type):
+            owner = type(owner)
+
+        return ' '.join([owner.__name__] + [str(arg)
+            for arg in event_id.args[1:]])
+
+    if isinstance(event_id, type):
+        return event_id.__name__
+
+    return type(event_id).__name__
+
+
+class HandlerStats(object):
+    '''Accumulated wall time of a handler or event type.'''
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+            'mean': self.mean}
+
+
+class SlowCall(collections.namedtuple('SlowCall', ['handler', 'event_type',
+'duration', 'stack'])):
+    '''A handler call that exceeded the threshold.
+
+    :var handler: The handler name.
+    :var event_type: The event type name.
+    :var duration: The wall time in seconds.
+    :var stack: The formatted stack sampled while the handler was running
+        or ``None``.
+    '''
+
+    __slots__ = ()
+
+
+class HandlerProfiler(object):
+    '''Records the wall time of event reactor handlers.
+
+    Calls taking longer than `slow_threshold` are logged and kept in
+    :attr:`slow_calls`. If stack sampling is enabled, a watchdog thread
+    captures the stack of the reactor thread while a handler is over the
+    threshold, which shows where the handler is blocked.
+    '''
+
+    MAX_SLOW_CALLS = 100
+
+    def __init__(self, slow_threshold=0.1, sample_stacks=True,
+    clock=time.monotonic):
+        '''
+        :param slow_threshold: The seconds after which a call is slow.
+        :param sample_stacks: Whether to start the watchdog thread.
+        '''
+
+        self._slow_threshold = slow_threshold
+        self._sample_stacks = sample_stacks
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._handler_stats = collections.defaultdict(HandlerStats)
+        self._event_stats = collections.defaultdict(HandlerStats)
+        self._slow_calls = collections.deque(
+            maxlen=HandlerProfiler.MAX_SLOW_CALLS)
+        self._call_number = 0
+        self._current_call = None
+        self._thread_id = None
+        self._stacks = {}
+        self._stop_event = threading.Event()
+
+        if sample_stacks:
+            thread = threading.Thread(target=self._watchdog)
+            thread.name = 'HandlerProfiler watchdog'
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def slow_threshold(self):
+        return self._slow_threshold
+
+    @property
+    def slow_calls(self):
+        '''The most recent :class:`SlowCall` instances.'''
+
+        with self._lock:
+            return list(self._slow_calls)
+
+    def handler_stats(self):
+        '''Return the stats of each handler.
+
+        :rtype: :obj:`dict`
+        '''
+
+        with self._lock:
+            return dict((name, stats.to_dict())
+                for name, stats in self._handler_stats.items())
+
+    def event_stats(self):
+        '''Return the stats of each event type.
+
+        :rtype: :obj:`dict`
+        '''
+
+        with self._lock:
+            return dict((name, stats.to_dict())
+                for name, stats in self._event_stats.items())
+
+    def begin(self, handler_callback, event_id):
+        '''Record the start of a call on the reactor thread.'''
+
+        self._thread_id = threading.get_ident()
+        self._call_number += 1
+        start_time = self._clock()
+        self._current_call = (self._call_number, handler_callback, event_id,
+            start_time)
+
+        return start_time
+
+    def end(self, handler_callback, event_id, start_time):
+        '''Record the end of a call started by :func:`begin`.'''
+
+        duration = self._clock() - start_time
+        call_number = self._current_call[0]
+        self._current_call = None
+        name = handler_name(handler_callback)
+        event_type = event_type_name(event_id)
+
+        with self._lock:
+            self._handler_stats[name].add(duration)
+            self._event_stats[event_type].add(duration)
+            stack = self._stacks.pop(call_number, None)
+
+            if duration < self._slow_threshold:
+                return
+
+            self._slow_calls.append(SlowCall(name, event_type, duration,
+                stack))
+
+        _logger.warning('Slow handler %s event=%s duration=%.3f', name,
+            event_type, duration)
+
+    def _watchdog(self):
+        while not self._stop_event.wait(self._slow_threshold / 2):
+            current_call = self._current_call
+
+            if not current_call:
+                continue
+
+            call_number, handler_callback, event_id, start_time = \
+                current_call
+
+            if self._clock() - start_time < self._slow_threshold \
+            or call_number in self._stacks:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+
+            if not frame:
+                continue
+
+            stack = ''.join(traceback.format_stack(frame))
+
+            with self._lock:
+                self._stacks[call_number] = stack
+
+            _logger.warning('Handler %s event=%s still running:\n%s',
+                handler_name(handler_callback), event_type_name(event_id),
+                stack)
+
+    def stop(self):
+        '''Stop the watchdog thread.'''
+
+        self._stop_event.set()
+
+    def format_report(self, limit=20):
+        '''Return a text table of the handlers with the most time.'''
+
+        lines = ['{:>8} {:>10} {:>10} {:>10}  {}'.format('calls', 'total',
+            'mean', 'max', 'handler')]
+
+        for name, stats in sorted(self.handler_stats().items(),
+        key=lambda item: item[1]['total'], reverse=True)[:limit]:
+            lines.append('{count:8d} {total:10.4f} {mean:10.4f} {max:10.4f}  '
+                '{name}'.format(name=name, **stats))
+
+        return '\n'.join(lines)
+
+
+class _EventBatch(collections.namedtuple('_EventBatch',
+['event_data_list', 'done_callback'])):
+    '''Events queued by :func:`EventReactor.put_many`'''
+
+    __slots__ = ()
+
+
 class EventReactor(object):
     '''A reactor that demultiplexs events from other threads'''
 
@@ -63,6 +304,34 @@ class EventReactor(object):
         self._callback_table = {}
         self._callback_table_lock = Lock()
         self._max_queue_size = max_queue_size
+        self._profiler = None
+
+    @property
+    def profiler(self):
+        '''The :class:`HandlerProfiler` or ``None`` if profiling is off.'''
+
+        return self._profiler
+
+    def enable_profiling(self, slow_threshold=0.1, sample_stacks=True):
+        '''Record the wall time of every handler call.
+
+        Profiling can be enabled while the reactor is running.
+
+        :see: :class:`HandlerProfiler`
+        :rtype: :class:`HandlerProfiler`
+        '''
+
+        self.disable_profiling()
+        self._profiler = HandlerProfiler(slow_threshold, sample_stacks)
+
+        return self._profiler
+
+    def disable_profiling(self):
+        profiler = self._profiler
+        self._profiler = None
+
+        if profiler:
+            profiler.stop()
 
     @property
     def queue_size(self):
@@ -93,11 +362,48 @@ class EventReactor(object):
                 'current=%d, max=%d', cur_queue_size, self._max_queue_size)
 
         try:
-            self._queue.put((event_id, event_data), block=False)
+            self._queue.put((event_id, event_data, time.monotonic()),
+                block=False)
         except queue.Full as e:
             _logger.exception('Event queue full')
             raise e
 
+        _queue_depth.inc()
+
+    def put_many(self, event_id, event_data_list, done_callback=None):
+        '''Add several events with the same ID in one queue operation
+
+        :Parameters:
+            event_id
+                Any value that can be used as an index
+            event_data_list
+                A list of tuples of data to be passed to the callback
+                function, one tuple for each event
+            done_callback
+                A function called without arguments on the reactor thread
+                after all the events were dispatched, such as one that
+                reuses buffers given to the handlers
+        '''
+
+        cur_queue_size = self._queue.qsize()
+
+        _logger.debug('Event put %s count=%d queue_size=%d', event_id,
+            len(event_data_list), cur_queue_size)
+
+        if cur_queue_size > self._max_queue_size * 0.90:
+            _logger.warning('Event queue is approaching limits: '
+                'current=%d, max=%d', cur_queue_size, self._max_queue_size)
+
+        try:
+            self._queue.put((event_id,
+                _EventBatch(event_data_list, done_callback),
+                time.monotonic()), block=False)
+        except queue.Full as e:
+            _logger.exception('Event queue full')
+            raise e
+
+        _queue_depth.inc()
+
     def register_handler(self, event_id, handler_callback):
         '''Add a callback function to handle events
 
@@ -128,29 +434,83 @@ class EventReactor(object):
         _logger.debug('Event reactor started')
 
         while True:
-            event_id, event_data = self._queue.get()
-            if event_id in self._callback_table:
-                for handler_callback in self._callback_table[event_id]:
-                    try:
-                        _logger.debug('Call handler=%s event_id=%s',
-                            handler_callback, event_id)
-                        handler_callback(event_id, *event_data)
-                        _logger.debug('Call finished handler=%s event_id=%s',
-                            handler_callback, event_id)
-                    except Exception as e:
-                        try:
-                            _logger.exception(
-                                'Handler exception at callback %s',
-                                inspect.getsourcelines(handler_callback))
-                        except IOError:
-                            pass
-                        raise e
+            event_id, event_data, put_time = self._queue.get()
+
+            self._dispatch(event_id, event_data, put_time)
 
             if event_id == EventReactor.STOP_ID:
                 break
 
+        if self._profiler:
+            self._profiler.stop()
+
         _logger.debug('Event reactor finished')
 
+    def dispatch_pending(self):
+        '''Dispatch the queued events on the calling thread.
+
+        This function does not block. It is used by simulations which drive
+        the reactor from their own loop instead of calling :func:`start`.
+
+        :returns: The number of events dispatched.
+        '''
+
+        count = 0
+
+        while True:
+            try:
+                event_id, event_data, put_time = self._queue.get_nowait()
+            except queue.Empty:
+                return count
+
+            self._dispatch(event_id, event_data, put_time)
+            count += 1
+
+    def _dispatch(self, event_id, event_data, put_time):
+        '''Call the handlers of an event or a batch of events'''
+
+        _queue_depth.dec()
+        _dispatch_latency.observe(time.monotonic() - put_time)
+
+        if isinstance(event_data, _EventBatch):
+            try:
+                for batch_event_data in event_data.event_data_list:
+                    self._call_handlers(event_id, batch_event_data)
+            finally:
+                if event_data.done_callback:
+                    event_data.done_callback()
+        else:
+            self._call_handlers(event_id, event_data)
+
+    def _call_handlers(self, event_id, event_data):
+        if event_id not in self._callback_table:
+            return
+
+        for handler_callback in self._callback_table[event_id]:
+            profiler = self._profiler
+
+            try:
+                _logger.debug('Call handler=%s event_id=%s',
+                    handler_callback, event_id)
+
+                if profiler:
+                    start_time = profiler.begin(handler_callback, event_id)
+
+                handler_callback(event_id, *event_data)
+
+                if profiler:
+                    profiler.end(handler_callback, event_id, start_time)
+
+                _logger.debug('Call finished handler=%s event_id=%s',
+                    handler_callback, event_id)
+            except Exception as e:
+                try:
+                    _logger.exception('Handler exception at callback %s',
+                        inspect.getsourcelines(handler_callback))
+                except IOError:
+                    pass
+                raise e
+
 
 class EventReactorMixin(object):
     '''A mix in to provide an ``event_reactor`` property'''
@@ -168,48 +528,336 @@ class EventReactorMixin(object):
         return self._event_reactor
 
 
-@functools.total_ordering
-class EventSchedulerEntry(object):
-    '''An event scheduler entry.'''
+class TimerHandle(object):
+    '''A timer added to a :class:`TimerWheel`.
+
+    :ivar expire_time: The time the timer fires next.
+    :ivar interval: The period of a periodic timer or ``None``.
+    '''
 
-    def __init__(self, abs_time, event_id, *event_data,
-    periodic_interval=None):
-        self.abs_time = abs_time
-        self.event_id = event_id
-        self.event_data = event_data
-        self.periodic_interval = periodic_interval
+    __slots__ = ('_wheel', 'expire_time', 'interval', 'callback', 'args',
+        'cancelled', '_slot')
+
+    def __init__(self, wheel, expire_time, callback, args, interval=None):
+        self._wheel = wheel
+        self.expire_time = expire_time
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._slot = None
 
     def __str__(self):
-        return '<EventSchedulerEntry t={} event={} perodic={}>'.format(
-            self.abs_time, self.event_id, self.periodic_interval)
+        return '<TimerHandle t={} callback={} periodic={}>'.format(
+            self.expire_time, self.callback, self.interval)
 
-    def __lt__(self, other):
-        return self.abs_time < other.abs_time
+    def cancel(self):
+        '''Cancel the timer.
 
-    def __eq__(self, other):
-        return self.abs_time == other.abs_time
+        Cancelling a timer that already fired or was cancelled does nothing.
+        '''
 
+        self._wheel.cancel(self)
 
-class EventScheduler(threading.Thread, EventReactorMixin):
-    '''Schedules events to be added to event reactors'''
 
-    def __init__(self, event_reactor):
-        threading.Thread.__init__(self)
+class TimerWheel(object):
+    '''A hierarchical timer wheel.
+
+    Timers are hashed into slots by their expiry tick. Level 0 has one slot
+    per tick and each higher level has slots spanning a whole rotation of
+    the level below. When a level wraps, the next slot of the level above
+    is cascaded down. Adding and cancelling a timer is O(1).
+
+    Callbacks are called on the wheel's thread and should return quickly.
+    '''
+
+    DEFAULT_TICK = 0.1
+    SLOT_BITS = 8
+
+    def __init__(self, tick=DEFAULT_TICK, levels=4, clock=time.time):
+        '''
+        :param tick: The resolution in seconds.
+        :param levels: The number of levels.
+        :param clock: A function returning the current time in seconds.
+        '''
+
+        self._tick = tick
+        self._num_slots = 2 ** TimerWheel.SLOT_BITS
+        self._slot_mask = self._num_slots - 1
+        self._levels = [[{} for dummy in range(self._num_slots)]
+            for dummy in range(levels)]
+        self._clock = clock
+        self._current_tick = self._time_to_tick(clock())
+        self._count = 0
+        self._condition = threading.Condition()
+        self._wake_tick = None
+        self._thread = None
+
+    @property
+    def clock(self):
+        '''The function returning the current time.'''
+
+        return self._clock
+
+    def __len__(self):
+        return self._count
+
+    def _time_to_tick(self, seconds):
+        return int(seconds // self._tick)
+
+    def _expire_tick(self, seconds):
+        return int(math.ceil(seconds / self._tick))
+
+    def start(self):
+        '''Start a thread that advances the wheel by the clock.'''
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.name = 'TimerWheel'
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, expire_time, callback, *args, interval=None):
+        '''Add a timer.
+
+        :param expire_time: The absolute time of the clock.
+        :param callback: A function called with `args` when the timer fires.
+        :param interval: If given, the timer is added again with this
+            period after it fires.
+
+        :rtype: :class:`TimerHandle`
+        '''
+
+        handle = TimerHandle(self, expire_time, callback, args, interval)
+
+        with self._condition:
+            self._insert(handle)
+
+            if self._wake_tick is None \
+            or self._expire_tick(expire_time) < self._wake_tick:
+                self._condition.notify()
+
+        return handle
+
+    def _insert(self, handle):
+        expire_tick = max(self._expire_tick(handle.expire_time),
+            self._current_tick + 1)
+        delta = expire_tick - self._current_tick
+
+        for level_num, level in enumerate(self._levels):
+            shift = TimerWheel.SLOT_BITS * level_num
+
+            if delta < self._num_slots << shift \
+            or level_num == len(self._levels) - 1:
+                break
+
+        if delta >= self._num_slots << shift:
+            # Beyond the range of the wheel: park it in the farthest slot
+            # and it will be inserted again when that slot is cascaded.
+            expire_tick = self._current_tick + \
+                ((self._num_slots - 1) << shift)
+
+        slot = level[(expire_tick >> shift) & self._slot_mask]
+        slot[handle] = None
+        handle._slot = slot
+        self._count += 1
+
+    def cancel(self, handle):
+        '''Cancel a timer.
+
+        :see: :func:`TimerHandle.cancel`
+        '''
+
+        with self._condition:
+            handle.cancelled = True
+
+            if handle._slot is not None:
+                del handle._slot[handle]
+                handle._slot = None
+                self._count -= 1
+
+    def _pop_slot(self, slot):
+        handles = list(slot)
+
+        slot.clear()
+        self._count -= len(handles)
+
+        for handle in handles:
+            handle._slot = None
+
+        return handles
+
+    def advance(self, now=None):
+        '''Fire the timers that expired up to the given time.
+
+        :param now: The current time. If ``None``, the clock is used.
+        :returns: The number of timers fired.
+        '''
+
+        if now is None:
+            now = self._clock()
+
+        target_tick = self._time_to_tick(now)
+        due = []
+
+        with self._condition:
+            while self._current_tick < target_tick:
+                if not self._count:
+                    self._current_tick = target_tick
+                    break
+
+                self._current_tick += 1
+                due.extend(self._process_tick())
+
+        for handle in due:
+            self._fire(handle)
+
+        return len(due)
+
+    def _process_tick(self):
+        tick = self._current_tick
+
+        for level_num in range(1, len(self._levels)):
+            if (tick >> (TimerWheel.SLOT_BITS * (level_num - 1))) \
+            & self._slot_mask:
+                break
+
+            shift = TimerWheel.SLOT_BITS * level_num
+            slot = self._levels[level_num][(tick >> shift) & self._slot_mask]
+
+            for handle in self._pop_slot(slot):
+                self._insert(handle)
+
+        return self._pop_slot(self._levels[0][tick & self._slot_mask])
+
+    def _fire(self, handle):
+        if handle.cancelled:
+            return
+
+        if handle.interval:
+            with self._condition:
+                if not handle.cancelled:
+                    handle.expire_time += handle.interval
+                    self._insert(handle)
+
+        try:
+            handle.callback(*handle.args)
+        except Exception:
+            _logger.exception('Timer callback error %s', handle)
+
+    def next_expire_time(self):
+        '''Return the time the wheel next has work or ``None``.
+
+        The work may be cascading timers from a higher level so the time
+        is not always the expiry time of a timer. The time returned is in
+        the middle of the tick so that advancing to it always reaches the
+        tick.
+        '''
+
+        with self._condition:
+            tick = self._next_tick()
+
+        if tick is not None:
+            return (tick + 0.5) * self._tick
+
+    def _next_tick(self):
+        '''Return the next tick that has work or ``None``.'''
+
+        if not self._count:
+            return
+
+        level_0 = self._levels[0]
+
+        for i in range(1, self._num_slots + 1):
+            tick = self._current_tick + i
+
+            if level_0[tick & self._slot_mask]:
+                return tick
+
+            if not tick & self._slot_mask:
+                return tick
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._wake_tick = self._next_tick()
+
+                if self._wake_tick is None:
+                    timeout = None
+                else:
+                    timeout = max(0,
+                        self._wake_tick * self._tick - self._clock())
+
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+
+                self._wake_tick = None
+
+            self.advance()
+
+
+_default_timer_wheel = None
+_default_timer_wheel_lock = threading.Lock()
+
+
+def default_timer_wheel():
+    '''Return the process-wide :class:`TimerWheel`.
+
+    The wheel and its thread are created on first use.
+    '''
+
+    global _default_timer_wheel
+
+    with _default_timer_wheel_lock:
+        if _default_timer_wheel is None:
+            _default_timer_wheel = TimerWheel()
+            _default_timer_wheel.start()
+
+    return _default_timer_wheel
+
+
+def set_default_timer_wheel(timer_wheel):
+    '''Replace the process-wide :class:`TimerWheel`.
+
+    Schedulers created afterwards use the given wheel. Simulations use
+    this to drive timeouts from a virtual clock.
+
+    :returns: The previous wheel or ``None``.
+    '''
+
+    global _default_timer_wheel
+
+    with _default_timer_wheel_lock:
+        old_timer_wheel = _default_timer_wheel
+        _default_timer_wheel = timer_wheel
+
+    return old_timer_wheel
+
+
+class EventScheduler(EventReactorMixin):
+    '''Schedules events to be added to event reactors
+
+    The scheduler does not have its own thread. Timers are added to a
+    shared :class:`TimerWheel`.
+    '''
+
+    def __init__(self, event_reactor, timer_wheel=None):
+        '''
+        :param timer_wheel: A :class:`TimerWheel`. If ``None``, the
+            process-wide wheel is used.
+        '''
+
         EventReactorMixin.__init__(self, event_reactor)
-        self.name = 'Scheduler'
-        self.daemon = True
-        self._lock = threading.Lock()
-        self._heap = []
-        self._event = threading.Event()
-        self._reschedule_id = EventID(self, 'EventReschedule')
+        self._timer_wheel = timer_wheel or default_timer_wheel()
 
-        self.event_reactor.register_handler(self._reschedule_id,
-            self._resched_callback)
-        self.start()
+    @property
+    def timer_wheel(self):
+        return self._timer_wheel
 
-    def _resched_callback(self, event_id, seconds, target_event_id,
-    event_data):
-        self.add_periodic(seconds, target_event_id, *event_data)
+    def _put_event(self, event_id, *event_data):
+        try:
+            self.event_reactor.put(event_id, *event_data)
+        except queue.Full:
+            _logger.warning('Scheduled event dropped %s', event_id)
 
     def add_absolute(self, time, event_id, *event_data):
         '''Add an event to be scheduled at given time
@@ -221,15 +869,14 @@ class EventScheduler(threading.Thread, EventReactorMixin):
                 The indexable value to be used as an event ID
             event_data
                 Any extra data to be passed
+
+        :rtype: :class:`TimerHandle`
         '''
 
         _logger.debug('Add absolute %s %s', time, event_id)
 
-        with self._lock:
-            entry = EventSchedulerEntry(time, event_id, *event_data)
-            heapq.heappush(self._heap, entry)
-
-        self._event.set()
+        return self._timer_wheel.add(time, self._put_event, event_id,
+            *event_data)
 
     def add_periodic(self, seconds, event_id, *event_data):
         '''Add an event to be scheduled periodically.
@@ -241,16 +888,14 @@ class EventScheduler(threading.Thread, EventReactorMixin):
                 The indexable value to be used as an event ID
             event_data
                 Any extra data to be passed
+
+        :rtype: :class:`TimerHandle`
         '''
 
         _logger.debug('Add periodic %s %s', seconds, event_id)
 
-        with self._lock:
-            entry = EventSchedulerEntry(time.time() + seconds,
-                event_id, *event_data, periodic_interval=seconds)
-            heapq.heappush(self._heap, entry)
-
-        self._event.set()
+        return self._timer_wheel.add(self._timer_wheel.clock() + seconds,
+            self._put_event, event_id, *event_data, interval=seconds)
 
     def add_one_shot(self, seconds, event_id, *event_data):
         '''Add an event to be scheduled once.
@@ -262,50 +907,14 @@ class EventScheduler(threading.Thread, EventReactorMixin):
                 The indexable value to be used as an event ID
             event_data
                 Any extra data to be passed
+
+        :rtype: :class:`TimerHandle`
         '''
 
         _logger.debug('Add one shot %s %s', seconds, event_id)
 
-        with self._lock:
-            entry = EventSchedulerEntry(time.time() + seconds,
-                event_id, *event_data)
-            heapq.heappush(self._heap, entry)
-
-        self._event.set()
-
-    def run(self):
-        wait_time = None
-        wait_time_skew = 0.1
-
-        while True:
-            _logger.debug('Sched wait')
-            self._event.wait(timeout=wait_time)
-            self._event.clear()
-            _logger.debug('Sched run')
-
-            entry = None
-
-            with self._lock:
-                if self._heap and self._heap[0].abs_time <= time.time():
-                    entry = heapq.heappop(self._heap)
-
-                if self._heap:
-                    wait_time = self._heap[0].abs_time - time.time()
-                    wait_time += wait_time_skew
-                else:
-                    wait_time = None
-
-            if entry:
-#                if self._attempt_put(entry):
-#                    wait_time = 1
-                self.event_reactor.put(entry.event_id, *entry.event_data)
-
-                if entry.periodic_interval:
-                    self.event_reactor.put(self._reschedule_id,
-                        entry.periodic_interval, entry.event_id,
-                        entry.event_data)
-
-            _logger.debug('Sched fin')
+        return self._timer_wheel.add(self._timer_wheel.clock() + seconds,
+            self._put_event, event_id, *event_data)
 
 
 class Observer(object):
@@ -503,42 +1112,147 @@ class Task(object):
         return self._run_all()
 
 
-class FnTaskSlot(threading.Thread):
-    '''Limit task execution'''
+class TaskPriorities(object):
+    '''Priority classes of :class:`FnTaskSlot`, highest first'''
+
+    INTERACTIVE, NORMAL, BACKGROUND = range(3)
+
+
+class PendingTask(Task):
+    '''A handle to a function waiting in a :class:`FnTaskSlot`.
+
+    Once the slot starts the function, this task follows the :class:`Task`
+    the function returned: the progress is forwarded and the result is the
+    result of that task.
+    '''
+
+    def __init__(self, slot, fn, args, kwargs):
+        Task.__init__(self)
+        self._slot = slot
+        self._fn = fn
+        self._fn_args = args
+        self._fn_kwargs = kwargs
+        self._task = None
+        self._started_event = threading.Event()
+        self._is_running = True
+
+    @property
+    def task(self):
+        '''The started :class:`Task` or ``None``.'''
+
+        return self._task
+
+    @property
+    def is_started(self):
+        return self._started_event.is_set()
+
+    def wait_started(self, timeout=None):
+        '''Block until the slot starts the task.
+
+        :returns: The started :class:`Task` or ``None``.
+        '''
+
+        self._started_event.wait(timeout)
+
+        return self._task
+
+    def _start(self):
+        task = self._fn(*self._fn_args, **self._fn_kwargs)
+
+        assert isinstance(task, Task), 'got {}'.format(task)
+
+        self._task = task
+
+        self.hook_task(task)
+        self._started_event.set()
+        task.observer.register(self._finish)
+
+        return task
+
+    def _finish(self, result):
+        self._result = result
+        self._is_finished = True
+        self._is_running = False
+        self._event.set()
+        self._started_event.set()
+        self._observer(result)
+
+    def stop(self):
+        '''Remove the task from the slot or stop the started task.'''
+
+        if not self.is_started and self._slot._cancel(self):
+            self._finish(None)
+        else:
+            Task.stop(self)
+
+
+class FnTaskSlot(object):
+    '''Limit task execution
+
+    Functions returning a :class:`Task` are queued by priority. Within a
+    priority, functions of different fairness keys take turns. A slot is
+    freed as soon as its task finishes through :attr:`Task.observer`.
+    '''
 
     def __init__(self, max_size=3):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.name = FnTaskSlot.__name__
-        self._queue = queue.Queue(max_size)
-        self._current_tasks = set()
-        self._running = False
         self._max_size = max_size
+        self._queues = [collections.OrderedDict()
+            for dummy in range(TaskPriorities.BACKGROUND + 1)]
+        self._current_tasks = set()
+        self._num_starting = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
         self._observer = Observer()
 
-        self.start()
+    def submit(self, fn, *args, priority=TaskPriorities.NORMAL,
+    fairness_key=None, **kwargs):
+        '''Queue a function with given arguments.
+
+        This function does not block.
+
+        :param priority: A value from :class:`TaskPriorities`.
+        :param fairness_key: Functions sharing a key are started in turns
+            with functions of other keys.
+        :rtype: :class:`PendingTask`
+        '''
+
+        pending_task = PendingTask(self, fn, args, kwargs)
+
+        with self._lock:
+            queue_ = self._queues[priority]
+
+            if fairness_key not in queue_:
+                queue_[fairness_key] = collections.deque()
+
+            queue_[fairness_key].append(pending_task)
+
+        _slot_queued.inc()
+        self._start_tasks()
+
+        return pending_task
 
     def add(self, fn, *args, **kwargs):
         '''Executes function with given arguments.
 
-        This function blocks until the slot is not full.
+        This function blocks until the slot is not full. Keyword arguments
+        of :func:`submit` are accepted.
 
         :rtype: :class:`Task`
         :returns: The Task that given ``fn`` returns.
         '''
 
-        event = threading.Event()
-        self._queue.put((event, fn, args, kwargs))
-        event.wait()
-
-        return event.task
+        return self.submit(fn, *args, **kwargs).wait_started()
 
     def add_no_block(self, fn, *args, **kwargs):
-        self._queue.put_nowait((fn, args, kwargs))
+        self.submit(fn, *args, **kwargs)
 
     @property
-    def queue(self):
-        return self._queue
+    def queue_size(self):
+        '''The number of functions waiting.'''
+
+        with self._lock:
+            return sum(len(deque) for queue_ in self._queues
+                for deque in queue_.values())
 
     @property
     def current_tasks(self):
@@ -557,44 +1271,103 @@ class FnTaskSlot(threading.Thread):
 
         return self._observer
 
-    def run(self):
-        self._running = True
+    def _pop(self):
+        for queue_ in self._queues:
+            if not queue_:
+                continue
 
-        while self._running:
-            if len(self._current_tasks) < self._max_size:
+            fairness_key, deque = next(iter(queue_.items()))
+            pending_task = deque.popleft()
 
-                if self._current_tasks:
-                    timeout = 1
-                else:
-                    timeout = None
+            if deque:
+                queue_.move_to_end(fairness_key)
+            else:
+                del queue_[fairness_key]
+
+            _slot_queued.dec()
+
+            return pending_task
+
+    def _cancel(self, pending_task):
+        with self._lock:
+            for queue_ in self._queues:
+                for fairness_key, deque in queue_.items():
+                    if pending_task in deque:
+                        deque.remove(pending_task)
+
+                        if not deque:
+                            del queue_[fairness_key]
+
+                        _slot_queued.dec()
+
+                        return True
+
+        return False
+
+    def _start_tasks(self):
+        # Tasks that finish immediately call back into this function.
+        # The outer call keeps looping instead of recursing.
+        if getattr(self._local, 'starting', False):
+            return
+
+        self._local.starting = True
+
+        try:
+            while True:
+                with self._lock:
+                    if len(self._current_tasks) + self._num_starting \
+                    >= self._max_size:
+                        return
+
+                    pending_task = self._pop()
+
+                    if not pending_task:
+                        return
+
+                    self._num_starting += 1
+
+                _logger.debug('Fn task slot execute')
 
                 try:
-                    event, fn, args, kwargs = self._queue.get(timeout=timeout)
-                except queue.Empty:
-                    pass
-                else:
-                    _logger.debug('Fn task slot execute')
-                    task = fn(*args, **kwargs)
+                    task = pending_task._start()
+                except Exception:
+                    _logger.exception('Fn task slot function error')
 
-                    assert isinstance(task, Task), 'got {}'.format(task)
+                    with self._lock:
+                        self._num_starting -= 1
 
-                    event.task = task
-                    event.set()
+                    pending_task._finish(None)
+                    continue
 
+                with self._lock:
+                    self._num_starting -= 1
                     self._current_tasks.add(task)
-                    self._observer(True, task)
 
-            for task in frozenset(self._current_tasks):
-                task.result(timeout=1)
+                _slot_running.inc()
+                self._observer(True, task)
+                task.observer.register(
+                    functools.partial(self._task_finished, task))
+        finally:
+            self._local.starting = False
+
+    def _task_finished(self, task, *args):
+        with self._lock:
+            self._current_tasks.discard(task)
 
-                if task.is_finished:
-                    self._current_tasks.remove(task)
-                    self._observer(False, task)
+        _slot_running.dec()
+        self._observer(False, task)
+        self._start_tasks()
 
     def stop(self):
-        self._running = False
+        with self._lock:
+            pending_tasks = [pending_task for queue_ in self._queues
+                for deque in queue_.values() for pending_task in deque]
+            tasks = list(self._current_tasks)
+
+        for pending_task in pending_tasks:
+            pending_task.stop()
 
-        for task in self._current_tasks:
+        for task in tasks:
             task.stop()
 
 
@@ -1,5 +1,7 @@
-from bytestag.events import EventReactor, Observer, EventID, asynchronous
+from bytestag.events import (EventReactor, Observer, EventID, asynchronous,
+    TimerWheel, EventScheduler, FnTaskSlot, Task, TaskPriorities)
 import threading
+import time
 import unittest
 
 
@@ -21,6 +23,263 @@ class TestEventReactor(unittest.TestCase):
         event_reactor.start()
         self.assertTrue(self.test_value)
 
+    def test_put_many(self):
+        '''It should dispatch a batch of events with one queue item'''
+
+        my_id = EventID('my_id')
+        values = []
+        done = []
+
+        def my_callback(event_id, value):
+            values.append(value)
+
+        event_reactor = EventReactor()
+        event_reactor.register_handler(my_id, my_callback)
+        event_reactor.put_many(my_id, [(1,), (2,), (3,)],
+            lambda: done.append(list(values)))
+
+        self.assertEqual(1, event_reactor.queue_size)
+
+        event_reactor.put(EventReactor.STOP_ID)
+        event_reactor.start()
+
+        self.assertEqual([1, 2, 3], values)
+        self.assertEqual([[1, 2, 3]], done)
+
+    def test_profiling(self):
+        '''It should time handlers and sample the stack of slow handlers'''
+
+        fast_id = EventID(self, 'fast')
+        slow_id = EventID(self, 'slow')
+
+        def fast_callback(event_id):
+            pass
+
+        def slow_callback(event_id):
+            time.sleep(0.2)
+
+        event_reactor = EventReactor()
+        profiler = event_reactor.enable_profiling(slow_threshold=0.05)
+        event_reactor.register_handler(fast_id, fast_callback)
+        event_reactor.register_handler(slow_id, slow_callback)
+        event_reactor.put(fast_id)
+        event_reactor.put(fast_id)
+        event_reactor.put(slow_id)
+        event_reactor.put(EventReactor.STOP_ID)
+        event_reactor.start()
+
+        handler_stats = profiler.handler_stats()
+        fast_stats = [stats for name, stats in handler_stats.items()
+            if name.endswith('fast_callback')][0]
+
+        self.assertEqual(2, fast_stats['count'])
+        self.assertEqual(2, profiler.event_stats()['TestEventReactor fast'][
+            'count'])
+
+        slow_calls = profiler.slow_calls
+
+        self.assertEqual(1, len(slow_calls))
+        self.assertTrue(slow_calls[0].handler.endswith('slow_callback'))
+        self.assertEqual('TestEventReactor slow', slow_calls[0].event_type)
+        self.assertGreaterEqual(slow_calls[0].duration, 0.2)
+        self.assertIn('slow_callback', slow_calls[0].stack)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.timer_wheel = TimerWheel(tick=1, levels=2,
+            clock=lambda: self.now)
+        self.fired = []
+
+    def advance(self, seconds):
+        for dummy in range(int(seconds)):
+            self.now += 1
+            self.timer_wheel.advance()
+
+    def test_one_shot(self):
+        '''It should fire timers in order and not early'''
+
+        for delay in (300, 5, 70000, 1, 256):
+            self.timer_wheel.add(self.now + delay, self.fired.append, delay)
+
+        self.advance(4)
+        self.assertEqual([1], self.fired)
+        self.advance(300)
+        self.assertEqual([1, 5, 256, 300], self.fired)
+        self.advance(70000)
+        self.assertEqual([1, 5, 256, 300, 70000], self.fired)
+        self.assertEqual(0, len(self.timer_wheel))
+
+    def test_cancel(self):
+        '''It should not fire cancelled timers'''
+
+        handle_1 = self.timer_wheel.add(self.now + 10, self.fired.append, 1)
+        handle_2 = self.timer_wheel.add(self.now + 1000, self.fired.append, 2)
+        self.timer_wheel.add(self.now + 20, self.fired.append, 3)
+
+        handle_1.cancel()
+        handle_2.cancel()
+        handle_2.cancel()
+
+        self.assertEqual(1, len(self.timer_wheel))
+        self.advance(2000)
+        self.assertEqual([3], self.fired)
+
+    def test_periodic(self):
+        '''It should fire periodic timers until cancelled'''
+
+        handle = self.timer_wheel.add(self.now + 10, self.fired.append, 1,
+            interval=10)
+
+        self.advance(35)
+        self.assertEqual([1, 1, 1], self.fired)
+
+        handle.cancel()
+        self.advance(35)
+        self.assertEqual([1, 1, 1], self.fired)
+
+    def test_thread(self):
+        '''It should fire timers from its own thread'''
+
+        timer_wheel = TimerWheel(tick=0.01)
+        event = threading.Event()
+
+        timer_wheel.start()
+        timer_wheel.add(timer_wheel.clock() + 0.05, event.set)
+
+        self.assertTrue(event.wait(timeout=2))
+
+
+class TestEventScheduler(unittest.TestCase):
+    def test_one_shot(self):
+        '''It should put events on the reactor'''
+
+        my_id = EventID('my_id')
+        event_reactor = EventReactor()
+        event_scheduler = EventScheduler(event_reactor)
+        self.count = 0
+
+        def my_callback(event_id, arg):
+            self.assertEqual('kitteh', arg)
+            self.count += 1
+
+        event_reactor.register_handler(my_id, my_callback)
+        event_scheduler.add_one_shot(0.1, my_id, 'kitteh')
+        event_scheduler.add_one_shot(0.2, my_id, 'kitteh').cancel()
+        event_scheduler.add_one_shot(0.3, EventReactor.STOP_ID)
+        event_reactor.start()
+
+        self.assertEqual(1, self.count)
+
+
+class WaitTask(Task):
+    def run(self, name, event):
+        event.wait(timeout=2)
+
+        return name
+
+
+class TestFnTaskSlot(unittest.TestCase):
+    def test_free_slot(self):
+        '''It should start the next task as soon as one finishes'''
+
+        slot = FnTaskSlot(max_size=1)
+        event_1 = threading.Event()
+        event_2 = threading.Event()
+        task_1 = slot.submit(self.run_task, 'a', event_1)
+        task_2 = slot.submit(self.run_task, 'b', event_2)
+
+        self.assertTrue(task_1.is_started)
+        self.assertFalse(task_2.is_started)
+
+        event_1.set()
+
+        self.assertEqual('a', task_1.result(timeout=2))
+        self.assertTrue(task_2.wait_started(timeout=0.5))
+
+        event_2.set()
+
+        self.assertEqual('b', task_2.result(timeout=2))
+
+    def run_task(self, name, event):
+        task = WaitTask(name, event)
+        thread = threading.Thread(target=task)
+        thread.daemon = True
+        thread.start()
+
+        return task
+
+    def test_priority_fairness(self):
+        '''It should start by priority and alternate between keys'''
+
+        slot = FnTaskSlot(max_size=1)
+        event = threading.Event()
+        started = []
+
+        def fn(name):
+            started.append(name)
+
+            return self.run_task(name, event)
+
+        blocker = slot.submit(fn, 'blocker')
+
+        for name in ('a1', 'a2', 'a3'):
+            slot.submit(fn, name, priority=TaskPriorities.BACKGROUND,
+                fairness_key='a')
+
+        for name in ('b1', 'b2'):
+            slot.submit(fn, name, priority=TaskPriorities.BACKGROUND,
+                fairness_key='b')
+
+        slot.submit(fn, 'i1', priority=TaskPriorities.INTERACTIVE)
+
+        self.assertEqual(6, slot.queue_size)
+
+        event.set()
+        blocker.result(timeout=2)
+
+        for dummy in range(100):
+            if len(started) == 7:
+                break
+
+            time.sleep(0.02)
+
+        self.assertEqual(['blocker', 'i1', 'a1', 'b1', 'a2', 'b2', 'a3'],
+            started)
+
+    def test_cancel_pending(self):
+        '''It should not start a stopped pending task'''
+
+        slot = FnTaskSlot(max_size=1)
+        event = threading.Event()
+        slot.submit(self.run_task, 'a', event)
+        pending_task = slot.submit(self.run_task, 'b', event)
+
+        pending_task.stop()
+
+        self.assertTrue(pending_task.is_finished)
+        self.assertEqual(0, slot.queue_size)
+        event.set()
+
+    def test_observer(self):
+        '''It should notify when tasks are added and removed'''
+
+        slot = FnTaskSlot()
+        event = threading.Event()
+        changes = []
+
+        slot.observer.register(lambda added, task: changes.append(added))
+
+        task = slot.add(self.run_task, 'a', event)
+
+        self.assertIsInstance(task, WaitTask)
+
+        event.set()
+        task.result(timeout=2)
+
+        self.assertEqual([True, False], changes)
+
 
 class TestObserver(unittest.TestCase):
     # TODO: test one shot
@@ -0,0 +1,251 @@
+'''Running many DHT identities in one process
+
+A :class:`NodeHost` runs several :class:`.DHTNetwork` instances with their
+own node IDs and ports. They share one event reactor, the process-wide
+timer wheel, the thread pools, the bandwidth limiters, the transfer slots,
+and one cache database. The database is partitioned into a table per node.
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.bandwidth import BandwidthLimiter
+from bytestag.client import CacheBackends, ManagementMixin
+from bytestag.dht.network import DHTNetwork
+from bytestag.dht.publishing import Publisher, Replicator
+from bytestag.events import EventReactor, FnTaskSlot, WrappedThreadPoolExecutor
+from bytestag.files import file_overwriter
+from bytestag.keys import KeyBytes
+from bytestag.metrics import default_registry
+from bytestag.network import Network
+from bytestag.storage import (DatabaseKVPTable, LogStructuredKVPTable,
+    DistanceEvictionPolicy)
+import collections
+import logging
+import os.path
+import threading
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+_num_hosted_nodes = default_registry().gauge('bytestag_host_nodes',
+    'Number of DHT nodes run by hosts in this process')
+
+
+class HostedNode(collections.namedtuple('HostedNode',
+['dht_network', 'kvp_table', 'publisher', 'replicator'])):
+    '''A DHT node run by a :class:`NodeHost`.'''
+
+    __slots__ = ()
+
+
+class NodeHost(threading.Thread, ManagementMixin):
+    '''Runs many DHT nodes in one process.
+
+    The node IDs are kept in a file in the cache directory so each node
+    keeps its place in the key space and its cache partition across
+    restarts.
+    '''
+
+    NODE_IDS_FILENAME = 'host_node_ids.txt'
+    CACHE_FILENAME = 'host_cache.db'
+
+    def __init__(self, cache_dir, num_nodes, host='0.0.0.0', port=0,
+    node_ids=None, known_node_address=None,
+    cache_backend=CacheBackends.DATABASE, cache_size=2 ** 36):
+        '''
+        :param cache_dir: The directory of the cache database.
+        :param num_nodes: The number of nodes.
+        :param port: The port of the first node. The other nodes use the
+            following ports. If ``0``, the ports are chosen by the system.
+        :param node_ids: A list of :class:`.KeyBytes` to use instead of
+            the saved node IDs.
+        :param known_node_address: The address of a node used for joining
+            the network. If ``None``, the other nodes join the first node.
+        :param cache_size: The maximum size of the values of all nodes. It
+            is divided equally among the nodes.
+        '''
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = '{}.{}'.format(__name__, NodeHost.__name__)
+        self._cache_dir = cache_dir
+        self._known_node_address = known_node_address
+        self._event_reactor = EventReactor()
+        self._network_pool = WrappedThreadPoolExecutor(
+            Network.DEFAULT_POOL_SIZE, self._event_reactor)
+        self._dht_pool = WrappedThreadPoolExecutor(
+            Network.DEFAULT_POOL_SIZE, self._event_reactor)
+        self._upload_limiter = BandwidthLimiter()
+        self._download_limiter = BandwidthLimiter()
+        self._upload_slot = FnTaskSlot()
+        self._download_slot = FnTaskSlot()
+        self._nodes = []
+        self._stopped = False
+
+        node_ids = node_ids or self._load_node_ids(num_nodes)
+
+        for node_number, node_id in enumerate(node_ids[:num_nodes]):
+            address = (host, port + node_number if port else 0)
+
+            self._nodes.append(self._create_node(node_id, address,
+                cache_backend, cache_size // num_nodes))
+
+        _num_hosted_nodes.inc(len(self._nodes))
+
+    @property
+    def nodes(self):
+        '''A list of :class:`HostedNode`.'''
+
+        return self._nodes
+
+    @property
+    def event_reactor(self):
+        return self._event_reactor
+
+    @property
+    def upload_limiter(self):
+        '''The :class:`.BandwidthLimiter` of uploads of all nodes.'''
+
+        return self._upload_limiter
+
+    @property
+    def download_limiter(self):
+        '''The :class:`.BandwidthLimiter` of downloads of all nodes.'''
+
+        return self._download_limiter
+
+    @property
+    def upload_slot(self):
+        return self._upload_slot
+
+    @property
+    def download_slot(self):
+        return self._download_slot
+
+    def _load_node_ids(self, num_nodes):
+        '''Read the saved node IDs and add new ones as needed.'''
+
+        path = os.path.join(self._cache_dir, NodeHost.NODE_IDS_FILENAME)
+        node_ids = []
+
+        if os.path.exists(path):
+            with open(path) as f:
+                node_ids.extend(KeyBytes(line.strip()) for line in f
+                    if line.strip())
+
+        if len(node_ids) < num_nodes:
+            node_ids.extend(KeyBytes()
+                for dummy in range(num_nodes - len(node_ids)))
+
+            with file_overwriter(path, 'w') as f:
+                for node_id in node_ids:
+                    f.write(node_id.base16)
+                    f.write('\n')
+
+        return node_ids
+
+    def _create_node(self, node_id, address, cache_backend, cache_size):
+        network = Network(self._event_reactor, address,
+            pool_executor=self._network_pool,
+            upload_limiter=self._upload_limiter,
+            download_limiter=self._download_limiter)
+        path = os.path.join(self._cache_dir, NodeHost.CACHE_FILENAME)
+        table_name = 'node_' + node_id.base16.lower()
+        eviction_policy = DistanceEvictionPolicy(node_id)
+
+        if cache_backend == CacheBackends.LOG:
+            kvp_table = LogStructuredKVPTable(path, cache_size,
+                eviction_policy=eviction_policy, table_name=table_name)
+        else:
+            kvp_table = DatabaseKVPTable(path, cache_size,
+                eviction_policy=eviction_policy, table_name=table_name)
+
+        dht_network = DHTNetwork(self._event_reactor, kvp_table, node_id,
+            network, self._download_slot, pool_executor=self._dht_pool)
+        publisher = Publisher(self._event_reactor, dht_network, kvp_table,
+            self._upload_slot)
+        replicator = Replicator(self._event_reactor, dht_network, kvp_table,
+            self._upload_slot)
+
+        return HostedNode(dht_network, kvp_table, publisher, replicator)
+
+    def stats(self):
+        '''Return the address, contacts and cache size of each node and
+        their totals.
+
+        :rtype: :obj:`dict`
+        '''
+
+        node_stats = []
+
+        for node in self._nodes:
+            node_stats.append({
+                'node_id': node.dht_network.key.base16,
+                'address': node.dht_network.address,
+                'contacts': node.dht_network.routing_table.num_contacts,
+                'used_size': node.kvp_table.used_size,
+            })
+
+        return {
+            'num_nodes': len(node_stats),
+            'contacts': sum(stats['contacts'] for stats in node_stats),
+            'used_size': sum(stats['used_size'] for stats in node_stats),
+            'nodes': node_stats,
+        }
+
+    def metrics(self):
+        '''Return a snapshot of the runtime metrics and the host stats.
+
+        :see: :func:`.ManagementMixin.metrics`
+        '''
+
+        snapshot = ManagementMixin.metrics(self)
+        snapshot['host'] = self.stats()
+
+        return snapshot
+
+    def run(self):
+        if self._known_node_address:
+            join_nodes = self._nodes
+            join_address = self._known_node_address
+        else:
+            join_nodes = self._nodes[1:]
+            join_address = self._nodes[0].dht_network.address \
+                if self._nodes else None
+
+        for node in join_nodes:
+            node.dht_network.bootstrap([join_address])
+
+        self._event_reactor.start()
+
+    def stop(self, timeout=5):
+        '''Stop the nodes and close their tables.
+
+        The publishers and replicators are stopped first so no thread
+        uses the cache database afterwards.
+        '''
+
+        if self._stopped:
+            return
+
+        self._stopped = True
+
+        for node in self._nodes:
+            node.publisher.stop(timeout)
+            node.replicator.stop(timeout)
+
+        self._event_reactor.put(EventReactor.STOP_ID)
+
+        if self.is_alive():
+            if threading.current_thread() is not self:
+                self.join(timeout)
+        else:
+            # Run the reactor until the networks have handled the stop.
+            self._event_reactor.start()
+
+        self._stop_metrics_file_writer()
+
+        for node in self._nodes:
+            if hasattr(node.kvp_table, 'close'):
+                node.kvp_table.close()
+
+        _num_hosted_nodes.dec(len(self._nodes))
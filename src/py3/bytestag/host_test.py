@@ -0,0 +1,104 @@
+from bytestag.host import NodeHost
+from bytestag.keys import KeyBytes
+from bytestag.tables import KVPID
+import os.path
+import tempfile
+import time
+import unittest
+
+
+class TestNodeHost(unittest.TestCase):
+    TIMEOUT = 10
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def new_host(self, num_nodes):
+        host = NodeHost(self.temp_dir.name, num_nodes, host='127.0.0.1')
+
+        # Cleanups run last in first out, so before the directory removal.
+        self.addCleanup(host.stop, self.TIMEOUT)
+
+        return host
+
+    def test_join(self):
+        '''It should run nodes sharing one reactor that join each other'''
+
+        host = self.new_host(3)
+
+        self.assertEqual(3, len(host.nodes))
+
+        for node in host.nodes:
+            self.assertIs(host.event_reactor,
+                node.dht_network.event_reactor)
+
+        host.start()
+
+        try:
+            deadline = time.time() + self.TIMEOUT
+
+            while time.time() < deadline:
+                stats = host.stats()
+
+                if all(node_stats['contacts'] for node_stats
+                in stats['nodes']):
+                    break
+
+                time.sleep(0.1)
+
+            self.assertEqual(3, stats['num_nodes'])
+            self.assertTrue(all(node_stats['contacts'] for node_stats
+                in stats['nodes']))
+            self.assertEqual(sum(node_stats['contacts'] for node_stats
+                in stats['nodes']), stats['contacts'])
+            self.assertIn('host', host.metrics())
+        finally:
+            host.stop(self.TIMEOUT)
+
+        self.assertFalse(host.is_alive())
+
+    def test_partitions(self):
+        '''It should keep the values of each node in its own table'''
+
+        host = self.new_host(2)
+        kvp_table_1 = host.nodes[0].kvp_table
+        kvp_table_2 = host.nodes[1].kvp_table
+        key = KeyBytes()
+        value = b'kitteh' * 10
+
+        kvp_table_1[KVPID(key, KeyBytes.new_hash(value))] = value
+
+        self.assertEqual(len(value), kvp_table_1.used_size)
+        self.assertEqual(0, kvp_table_2.used_size)
+        self.assertEqual(len(value), host.stats()['used_size'])
+        self.assertEqual([NodeHost.CACHE_FILENAME],
+            [name for name in os.listdir(self.temp_dir.name)
+                if name.endswith('.db')])
+
+    def test_node_ids_saved(self):
+        '''It should reuse the saved node IDs'''
+
+        host_1 = self.new_host(2)
+        host_2 = self.new_host(3)
+
+        self.assertEqual([node.dht_network.key for node in host_1.nodes],
+            [node.dht_network.key for node in host_2.nodes[:2]])
+
+    def test_stop(self):
+        '''It should stop the publishers and replicators of the nodes'''
+
+        host = self.new_host(2)
+        kvp_table = host.nodes[0].kvp_table
+        value = b'kitteh' * 10
+
+        # Wakes the publisher
+        kvp_table[KVPID(KeyBytes(), KeyBytes.new_hash(value))] = value
+
+        host.stop(self.TIMEOUT)
+
+        for node in host.nodes:
+            for loop_thread in (node.publisher._scan_loop_thread,
+            node.publisher._publish_loop_thread,
+            node.replicator._loop_thread):
+                self.assertFalse(loop_thread and loop_thread.is_alive())
@@ -2,7 +2,6 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-from bytestag.lib.bitstring import Bits, BitArray
 import base64
 import binascii
 import functools
@@ -18,15 +17,7 @@ def leading_zero_bits(bytes_):
     :rtype: `int`
     '''
 
-    count = 0
-
-    for char in Bits(bytes_).bin:
-        if char == '0':
-            count += 1
-        else:
-            break
-
-    return count
+    return len(bytes_) * 8 - int.from_bytes(bytes_, 'big').bit_length()
 
 
 def compute_bucket_number(key_1, key_2):
@@ -41,7 +32,9 @@ def compute_bucket_number(key_1, key_2):
     :rtype: `int`
     '''
 
-    return leading_zero_bits(key_1.distance(key_2))
+    distance = int.from_bytes(key_1, 'big') ^ int.from_bytes(key_2, 'big')
+
+    return len(key_1) * 8 - distance.bit_length()
 
 
 def random_bucket_key(node_key, bucket_number, bit_size=160):
@@ -49,13 +42,15 @@ def random_bucket_key(node_key, bucket_number, bit_size=160):
 
     assert bucket_number < bit_size
 
-    node_bits = Bits(node_key)
-    bit_array = BitArray(os.urandom(bit_size // 8))
-
-    bit_array.overwrite(node_bits[0:bucket_number + 1], 0)
-    bit_array.invert(range(bucket_number, bucket_number + 1))
+    # Keep the node's first bits, flip the bit of the bucket and randomize
+    # the rest.
+    shift = bit_size - bucket_number - 1
+    prefix_mask = (2 ** (bucket_number + 1) - 1) << shift
+    random_int = int.from_bytes(os.urandom(bit_size // 8), 'big')
+    key_int = int.from_bytes(node_key, 'big') & prefix_mask \
+        | random_int & ~prefix_mask
 
-    return KeyBytes(bit_array.bytes)
+    return KeyBytes((key_int ^ 1 << shift).to_bytes(bit_size // 8, 'big'))
 
 
 def bytes_to_b64(b):
@@ -137,6 +132,7 @@ class KeyBytes(bytes):
 
         i = bytes.__new__(cls, b)
         i.validate()
+        i._integer = int.from_bytes(b, 'big')
 
         return i
 
@@ -213,7 +209,7 @@ class KeyBytes(bytes):
         :rtype: ``str``
         '''
 
-        return Bits(self).bin
+        return format(self._integer, '0{}b'.format(len(self) * 8))
 
     @property
     def integer(self):
@@ -222,7 +218,7 @@ class KeyBytes(bytes):
         :rtype: ``int``
         '''
 
-        return Bits(self).uintbe
+        return self._integer
 
     def __str__(self):
         return self.base16
@@ -260,7 +256,7 @@ class KeyBytes(bytes):
         :rtype: ``bytes``
         '''
 
-        return (Bits(self) ^ Bits(other.binary)).bytes
+        return self.distance_int(other).to_bytes(len(self), 'big')
 
     def distance_int(self, other):
         '''Return the distance from another `Key`.
@@ -268,10 +264,10 @@ class KeyBytes(bytes):
         :rtype: ``int``
         '''
 
-        return Bits(self.distance(other)).uintbe
+        return self._integer ^ other.integer
 
     def __lt__(self, other):
-        return self.integer < other.integer
+        return self._integer < other.integer
 
     def validate_value(self, value):
         return self == hashlib.sha1(value).digest()
@@ -0,0 +1,451 @@
+'''Load generator for driving a node
+
+Many lightweight client identities send RPCs to a target node at a fixed
+rate. Each identity is a :class:`.DHTNetwork` with its own UDP port and
+node ID. All identities share one event reactor and thread pools.
+
+The rate is open loop: operations are started on schedule whether or
+not earlier operations finished. Operations beyond the maximum number
+outstanding are shed and counted.
+
+Example usage::
+
+    python3 -m bytestag.loadgen 127.0.0.1:38664 --clients 50 --rate 500 \\
+        --mix ping=1,find_node=4,store=1
+
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.dht.network import DHTNetwork
+from bytestag.dht.tables import Node
+from bytestag.events import EventReactor, WrappedThreadPoolExecutor
+from bytestag.keys import KeyBytes
+from bytestag.network import Network
+from bytestag.simulation import summarize
+from bytestag.storage import MemoryKVPTable
+from bytestag.tables import KVPID
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+
+class Operations(object):
+    '''Names of the operations'''
+
+    PING = 'ping'
+    FIND_NODE = 'find_node'
+    FIND_VALUE = 'find_value'
+    STORE = 'store'
+    GET_VALUE = 'get_value'
+    ALL = (PING, FIND_NODE, FIND_VALUE, STORE, GET_VALUE)
+
+
+class Outcomes(object):
+    '''Results of an operation
+
+    ``TIMEOUT`` means no valid reply arrived in time. ``ERROR`` means the
+    operation could not be started, such as when the event queue is full.
+    '''
+
+    OK = 'ok'
+    TIMEOUT = 'timeout'
+    ERROR = 'error'
+
+
+DEFAULT_MIX = {
+    Operations.PING: 1,
+    Operations.FIND_NODE: 4,
+    Operations.FIND_VALUE: 3,
+    Operations.STORE: 1,
+    Operations.GET_VALUE: 1,
+}
+
+
+def parse_mix(text):
+    '''Parse a mix such as ``ping=1,find_node=4``.
+
+    :rtype: :obj:`dict`
+    :raises ValueError: The text is not valid.
+    '''
+
+    mix = {}
+
+    for item in text.split(','):
+        name, weight = item.split('=', 1)
+        name = name.strip().lower()
+
+        if name not in Operations.ALL:
+            raise ValueError('Unknown operation {}'.format(name))
+
+        mix[name] = float(weight)
+
+        if mix[name] < 0:
+            raise ValueError('Weight of {} is negative'.format(name))
+
+    if not sum(mix.values()):
+        raise ValueError('No operations')
+
+    return mix
+
+
+class LoadReport(object):
+    '''Results of a load run.
+
+    :ivar duration: The seconds from the first operation to the last
+        result.
+    :ivar num_offered: The number of operations scheduled.
+    :ivar num_shed: The number of operations not started because too many
+        were outstanding.
+    '''
+
+    def __init__(self):
+        self.duration = 0
+        self.num_offered = 0
+        self.num_shed = 0
+        self._results = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, operation, outcome, latency):
+        with self._lock:
+            self._results[operation].append((outcome, latency))
+
+    def operation_stats(self, operation):
+        '''Return the counts of outcomes, throughput and latencies.
+
+        Latencies are of successful operations only.
+
+        :rtype: :obj:`dict`
+        '''
+
+        with self._lock:
+            results = list(self._results[operation])
+
+        counts = collections.Counter(outcome for outcome, dummy in results)
+        num_results = len(results)
+
+        return {
+            'count': num_results,
+            'ok': counts[Outcomes.OK],
+            'timeout': counts[Outcomes.TIMEOUT],
+            'error': counts[Outcomes.ERROR],
+            'timeout_rate': counts[Outcomes.TIMEOUT] / num_results
+                if num_results else 0,
+            'error_rate': counts[Outcomes.ERROR] / num_results
+                if num_results else 0,
+            'throughput': counts[Outcomes.OK] / self.duration
+                if self.duration else 0,
+            'latency': summarize([latency for outcome, latency in results
+                if outcome == Outcomes.OK]),
+        }
+
+    def to_dict(self):
+        with self._lock:
+            operations = sorted(self._results)
+
+        num_ok = 0
+        num_results = 0
+        operation_stats = {}
+
+        for operation in operations:
+            stats = self.operation_stats(operation)
+            operation_stats[operation] = stats
+            num_ok += stats['ok']
+            num_results += stats['count']
+
+        return {
+            'duration': self.duration,
+            'offered': self.num_offered,
+            'shed': self.num_shed,
+            'completed': num_results,
+            'throughput': num_ok / self.duration if self.duration else 0,
+            'operations': operation_stats,
+        }
+
+    def format(self):
+        '''Return the report as text.'''
+
+        report_dict = self.to_dict()
+        lines = ['{offered} offered, {shed} shed, {completed} completed in '
+            '{duration:.1f}s, {throughput:.1f} ok/s'.format(**report_dict)]
+
+        lines.append('{:12} {:>7} {:>7} {:>8} {:>7} {:>9} {:>9} {:>9} '
+            '{:>9}'.format('operation', 'ok', 'timeout', 'error', 'ok/s',
+            'p50', 'p90', 'p99', 'max'))
+
+        for operation, stats in sorted(report_dict['operations'].items()):
+            latency = stats['latency']
+            lines.append('{:12} {:7} {:6.1%} {:7.1%} {:7.1f} {:8.1f}ms '
+                '{:7.1f}ms {:7.1f}ms {:7.1f}ms'.format(operation, stats['ok'],
+                stats['timeout_rate'], stats['error_rate'],
+                stats['throughput'], latency['p50'] * 1000,
+                latency['p90'] * 1000, latency['p99'] * 1000,
+                latency['max'] * 1000))
+
+        return '\n'.join(lines)
+
+
+class LoadGenerator(object):
+    '''Sends a mix of RPCs to a target node at a rate.
+
+    Call :func:`start` before :func:`run` and :func:`stop` when done.
+    '''
+
+    def __init__(self, target_address, num_clients=10, mix=None,
+    value_size=1024, timeout=10, max_outstanding=256, host='0.0.0.0',
+    seed=None):
+        '''
+        :param target_address: The address of the node.
+        :param num_clients: The number of client identities.
+        :param mix: A ``dict`` of operation names to weights.
+        :param value_size: The size in bytes of stored values.
+        :param timeout: The seconds to wait for an operation to finish.
+        :param max_outstanding: The maximum number of operations running.
+        :param host: The address the clients listen on.
+        '''
+
+        self._target_address = target_address
+        self._num_clients = num_clients
+        self._mix = mix or DEFAULT_MIX
+        self._value_size = value_size
+        self._timeout = timeout
+        self._max_outstanding = max_outstanding
+        self._host = host
+        self._random = random.Random(seed)
+        self._event_reactor = EventReactor()
+        self._clients = []
+        self._target_node = None
+        self._stored_values = []
+        self._lock = threading.Lock()
+        self._num_outstanding = 0
+        self._reactor_thread = None
+        self._executor = None
+
+    @property
+    def target_node(self):
+        '''The :class:`.Node` learned by pinging the target.'''
+
+        return self._target_node
+
+    def start(self):
+        '''Create the clients and ping the target.
+
+        :raises IOError: The target did not reply.
+        '''
+
+        self._reactor_thread = threading.Thread(
+            target=self._event_reactor.start, name='loadgen-event-reactor')
+        self._reactor_thread.daemon = True
+        self._reactor_thread.start()
+
+        pool_size = max(self._max_outstanding, Network.DEFAULT_POOL_SIZE)
+        network_pool = WrappedThreadPoolExecutor(pool_size,
+            self._event_reactor)
+        dht_pool = WrappedThreadPoolExecutor(pool_size, self._event_reactor)
+
+        for dummy in range(self._num_clients):
+            network = Network(self._event_reactor, (self._host, 0),
+                pool_executor=network_pool)
+            dht_network = DHTNetwork(self._event_reactor, MemoryKVPTable(),
+                KeyBytes(), network, pool_executor=dht_pool)
+
+            self._clients.append(dht_network)
+
+        result = self._clients[0].ping_address(self._target_address).result(
+            self._timeout)
+
+        if not result:
+            raise IOError('Target {} did not reply'.format(
+                self._target_address))
+
+        self._target_node = Node(result[1].key, self._target_address)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            self._max_outstanding)
+
+        _logger.info('Target node %s', self._target_node)
+
+    def stop(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+        self._event_reactor.put(EventReactor.STOP_ID)
+
+    def run(self, duration, rate):
+        '''Send operations for a duration.
+
+        :param duration: The seconds to send operations.
+        :param rate: The operations per second.
+        :rtype: :class:`LoadReport`
+        '''
+
+        report = LoadReport()
+        operations = list(self._mix)
+        weights = [self._mix[operation] for operation in operations]
+        futures = []
+        start_time = time.monotonic()
+
+        # Multiply instead of adding up intervals so rounding errors do
+        # not send an extra operation.
+        for operation_number in range(int(duration * rate)):
+            sleep_time = start_time + operation_number / rate \
+                - time.monotonic()
+
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+            report.num_offered += 1
+
+            with self._lock:
+                if self._num_outstanding >= self._max_outstanding:
+                    report.num_shed += 1
+                    continue
+
+                self._num_outstanding += 1
+
+            operation = self._random.choices(operations, weights)[0]
+            futures.append(self._executor.submit(self._run_operation,
+                operation, report))
+
+        concurrent.futures.wait(futures, self._timeout * 2)
+
+        report.duration = time.monotonic() - start_time
+
+        return report
+
+    def _run_operation(self, operation, report):
+        client = self._random.choice(self._clients)
+        start_time = time.monotonic()
+
+        try:
+            fn = getattr(self, '_run_' + operation)
+            outcome = Outcomes.OK if fn(client) else Outcomes.TIMEOUT
+        except Exception:
+            _logger.debug('Operation %s error', operation, exc_info=True)
+            outcome = Outcomes.ERROR
+        finally:
+            with self._lock:
+                self._num_outstanding -= 1
+
+        report.record(operation, outcome, time.monotonic() - start_time)
+
+    def _wait(self, task):
+        result = task.result(self._timeout)
+
+        if not task.is_finished:
+            task.stop()
+
+        return result
+
+    def _random_kvpid(self):
+        with self._lock:
+            if self._stored_values:
+                return self._random.choice(self._stored_values)[0]
+
+        return KVPID(KeyBytes(), KeyBytes())
+
+    def _run_ping(self, client):
+        return self._wait(client.ping_address(self._target_address))
+
+    def _run_find_node(self, client):
+        return self._wait(client.find_nodes_from_node(self._target_node,
+            KeyBytes())) is not None
+
+    def _run_find_value(self, client):
+        kvpid = self._random_kvpid()
+
+        return self._wait(client.find_value_from_node(self._target_node,
+            kvpid.key, kvpid.index))
+
+    def _run_store(self, client):
+        value = os.urandom(self._value_size)
+        kvpid = KVPID(KeyBytes(), KeyBytes.new_hash(value))
+        bytes_sent = self._wait(client.store_to_node(self._target_node,
+            kvpid.key, kvpid.index, value, time.time()))
+
+        if bytes_sent:
+            with self._lock:
+                self._stored_values.append((kvpid, len(value)))
+
+        return bytes_sent
+
+    def _run_get_value(self, client):
+        with self._lock:
+            if not self._stored_values:
+                return self._run_store(client)
+
+            kvpid, size = self._random.choice(self._stored_values)
+
+        task = client.get_value_from_node(self._target_node, kvpid.key,
+            kvpid.index)
+        file = self._wait(task)
+
+        if not file:
+            return False
+
+        with file:
+            file.seek(0)
+
+            return len(file.read()) == size
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Sends load to a Bytestag node.')
+    arg_parser.add_argument('target',
+        help='address of the node as HOST:PORT')
+    arg_parser.add_argument('--clients', type=int, default=10,
+        help='number of client identities')
+    arg_parser.add_argument('--rate', type=float, default=100,
+        help='operations per second')
+    arg_parser.add_argument('--duration', type=float, default=10,
+        help='seconds to send operations')
+    arg_parser.add_argument('--mix', type=parse_mix,
+        default=DEFAULT_MIX,
+        help='weights of the operations such as ping=1,find_node=4. '
+        'Operations are {}'.format(', '.join(Operations.ALL)))
+    arg_parser.add_argument('--value-size', type=int, default=1024,
+        help='size in bytes of stored values')
+    arg_parser.add_argument('--timeout', type=float, default=10,
+        help='seconds to wait for an operation')
+    arg_parser.add_argument('--max-outstanding', type=int, default=256,
+        help='maximum operations running at once')
+    arg_parser.add_argument('--host', default='0.0.0.0',
+        help='hostname or IP address the clients listen on')
+    arg_parser.add_argument('--json', default=False, action='store_true',
+        help='print the report as JSON')
+    arg_parser.add_argument('--log-level',
+        help='Python logging level')
+
+    args = arg_parser.parse_args()
+
+    if args.log_level:
+        logging.basicConfig(level=args.log_level,
+            format='%(levelname)s %(name)s %(module)s:%(lineno)d %(message)s')
+
+    host, port = args.target.rsplit(':', 1)
+    load_generator = LoadGenerator((host, int(port)), args.clients, args.mix,
+        args.value_size, args.timeout, args.max_outstanding, args.host)
+
+    try:
+        load_generator.start()
+        report = load_generator.run(args.duration, args.rate)
+    finally:
+        load_generator.stop()
+
+    if args.json:
+        print(json.dumps(report.to_dict(), indent=2))
+    else:
+        print(report.format())
+
+
+if __name__ == '__main__':
+    main()
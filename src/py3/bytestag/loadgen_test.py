@@ -0,0 +1,52 @@
+from bytestag.dht.network import DHTNetwork
+from bytestag.events import EventReactor
+from bytestag.loadgen import (LoadGenerator, Operations, parse_mix,
+    DEFAULT_MIX)
+from bytestag.storage import MemoryKVPTable
+import threading
+import unittest
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_parse_mix(self):
+        '''It should parse operation weights'''
+
+        self.assertEqual({Operations.PING: 1, Operations.STORE: 2.5},
+            parse_mix('ping=1, STORE=2.5'))
+        self.assertRaises(ValueError, parse_mix, 'bogus=1')
+        self.assertRaises(ValueError, parse_mix, 'ping=0')
+
+    def test_run(self):
+        '''It should send every operation to a node and report'''
+
+        event_reactor = EventReactor()
+        thread = threading.Thread(target=event_reactor.start)
+        thread.daemon = True
+        thread.start()
+
+        dht_network = DHTNetwork(event_reactor, MemoryKVPTable())
+        load_generator = LoadGenerator(dht_network.address, num_clients=3,
+            timeout=5, host='127.0.0.1', seed=1)
+
+        try:
+            load_generator.start()
+            report = load_generator.run(1, 40)
+        finally:
+            load_generator.stop()
+            event_reactor.put(EventReactor.STOP_ID)
+
+        report_dict = report.to_dict()
+
+        self.assertEqual(dht_network.key, load_generator.target_node.key)
+        self.assertEqual(40, report_dict['offered'])
+        self.assertEqual(40, report_dict['completed'])
+        self.assertTrue(report_dict['throughput'])
+
+        for operation in DEFAULT_MIX:
+            stats = report_dict['operations'].get(operation)
+
+            if stats:
+                self.assertEqual(0, stats['error'])
+                self.assertEqual(stats['count'], stats['ok'])
+
+        self.assertTrue(report.format())
@@ -2,9 +2,13 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-from bytestag.client import Client
+from bytestag.bandwidth import TrafficClasses
+from bytestag.client import Client, CacheBackends
+from bytestag.host import NodeHost
 from bytestag.keys import KeyBytes
+from bytestag.workers import WorkerPool
 import argparse
+import atexit
 import bytestag.basedir
 import logging
 import os.path
@@ -28,14 +32,36 @@ def main():
         help='hostname or IP address of the listening server')
     arg_parser.add_argument('--cache-size', type=int, default=2 ** 36,
         help='maximum size, in bytes, of the cache')
+    arg_parser.add_argument('--cache-backend', default=CacheBackends.DATABASE,
+        choices=[CacheBackends.DATABASE, CacheBackends.LOG],
+        help='storage of the cache: SQLite BLOBs or log-structured segments')
 #    arg_parser.add_argument('--max-disk-ratio', type=float, default=0.75,
 #        help='maximum free disk space that may be used')
+    arg_parser.add_argument('--upload-rate', type=int,
+        help='maximum upload rate in bytes per second')
+    arg_parser.add_argument('--download-rate', type=int,
+        help='maximum download rate in bytes per second')
+    arg_parser.add_argument('--replicate-rate', type=int,
+        help='maximum upload rate of replication in bytes per second')
+    arg_parser.add_argument('--metrics-file',
+        help='file where metrics are written in Prometheus text format')
+    arg_parser.add_argument('--metrics-interval', type=float, default=60,
+        help='seconds between writes of the metrics file')
+    arg_parser.add_argument('--profile-handlers', type=float,
+        metavar='SECONDS',
+        help='time event handlers and log those slower than SECONDS')
     arg_parser.add_argument('--share-dir', nargs='*',
         help='directory to share')
     arg_parser.add_argument('--known-node',
         help='initial known contact')
     arg_parser.add_argument('--node-id',
         help='node id of this server')
+    arg_parser.add_argument('--host-nodes', type=int, metavar='COUNT',
+        help='run COUNT DHT nodes in this process on consecutive ports '
+            'instead of a client')
+    arg_parser.add_argument('--workers', type=int, metavar='COUNT',
+        help='run one DHT node in COUNT processes sharing the port '
+            'instead of a client')
     arg_parser.add_argument('--log-level',
         help='Python logging level')
     arg_parser.add_argument('--log-filename',
@@ -65,15 +91,49 @@ def main():
     else:
         known_node_address = None
 
-    client = Client(args.cache_dir, known_node_address=known_node_address,
-        address=(args.host, args.port), node_id=KeyBytes(args.node_id or True),
-        initial_scan=args.initial_scan,
-        use_port_forwarding=args.port_forwarding
-    )
+    if args.workers:
+        pool = WorkerPool(args.cache_dir, args.workers,
+            address=(args.host, args.port),
+            node_id=KeyBytes(args.node_id or True),
+            known_node_address=known_node_address,
+            cache_size=args.cache_size)
 
-    client.cache_table.max_size = args.cache_size
+        pool.start()
+        pool.join()
 
-    if args.share_dir:
+        return
+
+    if args.host_nodes:
+        client = NodeHost(args.cache_dir, args.host_nodes, host=args.host,
+            port=args.port, known_node_address=known_node_address,
+            cache_backend=args.cache_backend, cache_size=args.cache_size)
+    else:
+        client = Client(args.cache_dir,
+            known_node_address=known_node_address,
+            address=(args.host, args.port),
+            node_id=KeyBytes(args.node_id or True),
+            initial_scan=args.initial_scan,
+            use_port_forwarding=args.port_forwarding,
+            cache_backend=args.cache_backend
+        )
+
+        client.cache_table.max_size = args.cache_size
+
+    client.set_bandwidth_limits(upload_rate=args.upload_rate,
+        download_rate=args.download_rate,
+        class_rates={TrafficClasses.REPLICATE: (args.replicate_rate, None)})
+
+    if args.metrics_file:
+        client.write_metrics_file(args.metrics_file, args.metrics_interval)
+
+    if args.profile_handlers:
+        profiler = client.event_reactor.enable_profiling(
+            args.profile_handlers)
+
+        atexit.register(lambda: _logger.info('Event handler profile:\n%s',
+            profiler.format_report()))
+
+    if args.share_dir and not args.host_nodes:
         share_dirs = map(os.path.abspath, args.share_dir)
         client.shared_files_table.shared_directories.extend(share_dirs)
 
@@ -0,0 +1,416 @@
+'''Runtime metrics
+
+Metrics are kept in a :class:`MetricsRegistry`. Modules register their
+metrics on the process-wide registry returned by :func:`default_registry`
+at import time and update them in place. Updating a metric only takes a
+lock and an addition so metrics are always enabled.
+
+Example usage::
+
+    >>> requests = default_registry().counter('requests_total',
+    ...     'Requests received', ('kind',))
+    >>> requests.labels('ping').inc()
+
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.files import file_overwriter
+import bisect
+import contextlib
+import logging
+import math
+import threading
+import time
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30)
+
+
+class MetricTypes(object):
+    '''Metric type names as used by the Prometheus text format'''
+
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+    HISTOGRAM = 'histogram'
+
+
+class CounterValue(object):
+    '''A value that only increases.'''
+
+    __slots__ = ('_lock', '_value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class GaugeValue(object):
+    '''A value that goes up and down.
+
+    Instead of being updated, a gauge can be given a function which is
+    called when the value is read.
+    '''
+
+    __slots__ = ('_lock', '_value', '_fn')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+        self._fn = None
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, fn):
+        '''Read the value from a function returning a number.'''
+
+        self._fn = fn
+
+    @property
+    def value(self):
+        if self._fn:
+            return self._fn()
+
+        return self._value
+
+
+class HistogramValue(object):
+    '''Counts observations into buckets.'''
+
+    __slots__ = ('_lock', '_upper_bounds', '_counts', '_sum', '_count')
+
+    def __init__(self, upper_bounds):
+        self._lock = threading.Lock()
+        self._upper_bounds = upper_bounds
+        self._counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._upper_bounds, value)
+
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        '''Observe the seconds spent in the context.'''
+
+        start_time = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time)
+
+    @property
+    def value(self):
+        '''A ``dict`` with the ``count``, ``sum``, and cumulative
+        ``buckets`` keyed by their upper bound.'''
+
+        with self._lock:
+            counts = list(self._counts)
+            sum_ = self._sum
+            count = self._count
+
+        buckets = {}
+        total = 0
+
+        for upper_bound, bucket_count in zip(
+        self._upper_bounds + (math.inf,), counts):
+            total += bucket_count
+            buckets[upper_bound] = total
+
+        return {'count': count, 'sum': sum_, 'buckets': buckets}
+
+
+class Metric(object):
+    '''A named metric with optional labels.
+
+    Without label names, the value methods such as ``inc`` can be called
+    on the metric itself. Otherwise, :func:`labels` returns the value of
+    a combination of labels.
+    '''
+
+    def __init__(self, metric_type, name, help_text, label_names, value_fn):
+        self._type = metric_type
+        self._name = name
+        self._help = help_text
+        self._label_names = tuple(label_names)
+        self._value_fn = value_fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if not self._label_names:
+            self._values[()] = value_fn()
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def help(self):
+        return self._help
+
+    @property
+    def label_names(self):
+        return self._label_names
+
+    def labels(self, *label_values):
+        '''Return the value of given labels.
+
+        The value is created on first use.
+        '''
+
+        assert len(label_values) == len(self._label_names)
+
+        value = self._values.get(label_values)
+
+        if value is None:
+            with self._lock:
+                value = self._values.get(label_values)
+
+                if value is None:
+                    value = self._value_fn()
+                    self._values[label_values] = value
+
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_') or self._label_names:
+            raise AttributeError(name)
+
+        return getattr(self._values[()], name)
+
+    def samples(self):
+        '''Return a list of ``(label_values, value)``.'''
+
+        with self._lock:
+            items = list(self._values.items())
+
+        return [(label_values, value.value) for label_values, value in items]
+
+
+class MetricsRegistry(object):
+    '''Holds metrics by name.
+
+    Registering a name again returns the existing metric so instances of
+    a class can share their metrics.
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_type, name, help_text, label_names, value_fn):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            if metric:
+                if metric.type != metric_type:
+                    raise ValueError('Metric {} is a {}'.format(name,
+                        metric.type))
+
+                return metric
+
+            metric = Metric(metric_type, name, help_text, label_names,
+                value_fn)
+            self._metrics[name] = metric
+
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        '''Register a counter.
+
+        :rtype: :class:`Metric` of :class:`CounterValue`
+        '''
+
+        return self._register(MetricTypes.COUNTER, name, help_text,
+            label_names, CounterValue)
+
+    def gauge(self, name, help_text, label_names=()):
+        '''Register a gauge.
+
+        :rtype: :class:`Metric` of :class:`GaugeValue`
+        '''
+
+        return self._register(MetricTypes.GAUGE, name, help_text,
+            label_names, GaugeValue)
+
+    def histogram(self, name, help_text, label_names=(),
+    buckets=LATENCY_BUCKETS):
+        '''Register a histogram.
+
+        :param buckets: The sorted upper bounds of the buckets.
+        :rtype: :class:`Metric` of :class:`HistogramValue`
+        '''
+
+        buckets = tuple(sorted(buckets))
+
+        return self._register(MetricTypes.HISTOGRAM, name, help_text,
+            label_names, lambda: HistogramValue(buckets))
+
+    def get(self, name):
+        '''Return the metric or ``None``.'''
+
+        return self._metrics.get(name)
+
+    def __iter__(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                key=lambda metric: metric.name)
+
+        return iter(metrics)
+
+    def snapshot(self):
+        '''Return the current values.
+
+        The values of metrics without labels are returned directly.
+        Otherwise, the values are in a ``dict`` keyed by the label values
+        joined by a comma.
+
+        :rtype: :obj:`dict`
+        '''
+
+        snapshot = {}
+
+        for metric in self:
+            samples = metric.samples()
+
+            if metric.label_names:
+                snapshot[metric.name] = dict((','.join(map(str, labels)),
+                    value) for labels, value in samples)
+            elif samples:
+                snapshot[metric.name] = samples[0][1]
+
+        return snapshot
+
+    def to_prometheus_text(self):
+        '''Return the metrics in the Prometheus text exposition format.
+
+        :rtype: :obj:`str`
+        '''
+
+        lines = []
+
+        for metric in self:
+            lines.append('# HELP {} {}'.format(metric.name,
+                metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+
+            for label_values, value in sorted(metric.samples(),
+            key=lambda sample: sample[0]):
+                labels = list(zip(metric.label_names, label_values))
+
+                if metric.type == MetricTypes.HISTOGRAM:
+                    for upper_bound, count in value['buckets'].items():
+                        lines.append(_format_sample(metric.name + '_bucket',
+                            labels + [('le', _format_number(upper_bound))],
+                            count))
+
+                    lines.append(_format_sample(metric.name + '_sum',
+                        labels, value['sum']))
+                    lines.append(_format_sample(metric.name + '_count',
+                        labels, value['count']))
+                else:
+                    lines.append(_format_sample(metric.name, labels, value))
+
+        lines.append('')
+
+        return '\n'.join(lines)
+
+    def write_prometheus_file(self, path):
+        '''Write the text format to a file atomically.'''
+
+        with file_overwriter(path, 'w') as f:
+            f.write(self.to_prometheus_text())
+
+
+def _format_number(number):
+    if number == math.inf:
+        return '+Inf'
+
+    return repr(float(number)) if isinstance(number, float) else str(number)
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        return '{}{{{}}} {}'.format(name, ','.join(
+            '{}="{}"'.format(label_name, str(label_value).replace('\\',
+            '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label_name, label_value in labels), _format_number(value))
+
+    return '{} {}'.format(name, _format_number(value))
+
+
+class MetricsFileWriter(threading.Thread):
+    '''Periodically writes a registry to a file in the Prometheus text
+    format.
+
+    The file can be read by the node exporter's textfile collector.
+    '''
+
+    def __init__(self, path, interval=60, registry=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'MetricsFileWriter'
+        self._path = path
+        self._interval = interval
+        self._registry = registry or default_registry()
+        self._stop_event = threading.Event()
+
+    @property
+    def path(self):
+        return self._path
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.write()
+
+    def write(self):
+        try:
+            self._registry.write_prometheus_file(self._path)
+        except IOError:
+            _logger.exception('Failed to write metrics file %s', self._path)
+
+    def stop(self):
+        '''Stop the thread after writing the file a last time.'''
+
+        self._stop_event.set()
+        self.write()
+
+
+_default_registry = MetricsRegistry()
+
+
+def default_registry():
+    '''Return the process-wide :class:`MetricsRegistry`.'''
+
+    return _default_registry
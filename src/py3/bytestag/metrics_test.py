@@ -0,0 +1,97 @@
+from bytestag.metrics import MetricsRegistry
+import math
+import os.path
+import tempfile
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        '''It should count with and without labels'''
+
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total', 'Requests')
+        labelled_counter = registry.counter('packets_total', 'Packets',
+            ('kind',))
+
+        counter.inc()
+        counter.inc(2)
+        labelled_counter.labels('ping').inc()
+        labelled_counter.labels('ping').inc()
+        labelled_counter.labels('store').inc()
+
+        snapshot = registry.snapshot()
+
+        self.assertEqual(3, snapshot['requests_total'])
+        self.assertEqual({'ping': 2, 'store': 1}, snapshot['packets_total'])
+
+    def test_register_again(self):
+        '''It should return the existing metric of the same name'''
+
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total', 'Requests')
+
+        self.assertIs(counter, registry.counter('requests_total', 'Requests'))
+        self.assertRaises(ValueError, registry.gauge, 'requests_total', '')
+
+    def test_gauge(self):
+        '''It should go up and down or read a function'''
+
+        registry = MetricsRegistry()
+        gauge = registry.gauge('depth', 'Depth')
+        function_gauge = registry.gauge('size', 'Size')
+
+        gauge.inc(5)
+        gauge.dec(2)
+        function_gauge.set_function(lambda: 42)
+
+        self.assertEqual(3, gauge.value)
+        self.assertEqual(42, registry.snapshot()['size'])
+
+    def test_histogram(self):
+        '''It should count observations in cumulative buckets'''
+
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency', 'Latency',
+            buckets=(1, 5, 10))
+
+        for value in (0.5, 1, 3, 7, 20):
+            histogram.observe(value)
+
+        value = histogram.value
+
+        self.assertEqual(5, value['count'])
+        self.assertEqual(31.5, value['sum'])
+        self.assertEqual({1: 2, 5: 3, 10: 4, math.inf: 5}, value['buckets'])
+
+    def test_prometheus_text(self):
+        '''It should format the metrics in the Prometheus text format'''
+
+        registry = MetricsRegistry()
+        registry.counter('packets_total', 'Packets', ('kind',)).labels(
+            'a"b').inc()
+        registry.histogram('latency', 'Latency', buckets=(1,)).observe(0.5)
+
+        text = registry.to_prometheus_text()
+
+        self.assertIn('# TYPE packets_total counter\n', text)
+        self.assertIn('packets_total{kind="a\\"b"} 1\n', text)
+        self.assertIn('# TYPE latency histogram\n', text)
+        self.assertIn('latency_bucket{le="1"} 1\n', text)
+        self.assertIn('latency_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('latency_sum 0.5\n', text)
+        self.assertIn('latency_count 1\n', text)
+
+    def test_write_file(self):
+        '''It should write the text format to a file'''
+
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests').inc()
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'metrics.prom')
+
+            registry.write_prometheus_file(path)
+
+            with open(path) as f:
+                self.assertIn('requests_total 1\n', f.read())
@@ -2,16 +2,20 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.bandwidth import BandwidthLimiter
 from bytestag.events import (EventReactorMixin, EventReactor, EventScheduler, 
     Task, EventID, WrappedThreadPoolExecutor)
 from bytestag.keys import bytes_to_b64
+from bytestag.metrics import default_registry
 from socketserver import BaseRequestHandler
 from threading import Thread
 import base64
 import binascii
 import collections
 import errno
+import hashlib
 import io
+import itertools
 import json
 import logging
 import os
@@ -26,6 +30,29 @@ import zlib
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
+_packets_received = default_registry().counter(
+    'bytestag_packets_received_total', 'UDP packets received', ('kind',))
+_packets_sent = default_registry().counter('bytestag_packets_sent_total',
+    'UDP packets sent', ('kind',))
+_bytes_received = default_registry().counter('bytestag_bytes_received_total',
+    'UDP payload bytes received')
+_bytes_sent = default_registry().counter('bytestag_bytes_sent_total',
+    'UDP payload bytes sent')
+_send_retries = default_registry().counter('bytestag_send_retries_total',
+    'Packets sent again because no reply arrived in time')
+_send_timeouts = default_registry().counter('bytestag_send_timeouts_total',
+    'Packets that never got a reply')
+_receive_batch_size = default_registry().histogram(
+    'bytestag_receive_batch_size', 'UDP datagrams read per socket wakeup',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+_late_replies = default_registry().counter('bytestag_late_replies_total',
+    'Replies that arrived after their request timed out')
+_reply_table_evictions = default_registry().counter(
+    'bytestag_reply_table_evictions_total',
+    'Reply table entries dropped because the table was full')
+_reply_latency = default_registry().histogram(
+    'bytestag_reply_latency_seconds',
+    'Time from sending a packet to receiving its reply')
 
 
 class UDP_INBOUND_EVENT(object):
@@ -38,8 +65,8 @@ class UDPRequestHandler(BaseRequestHandler):
 
     def handle(self):
         _logger.debug('Handler')
-        self.server.event_reactor.put(UDP_INBOUND_EVENT, self.client_address,
-            self.request[0])
+        self.server.event_reactor.put(self.server.inbound_event_id,
+            self.client_address, self.request[0])
 
 
 class DataPacket(collections.namedtuple('DataPacket', ['address', 'dict_obj',
@@ -57,16 +84,31 @@ class DataPacket(collections.namedtuple('DataPacket', ['address', 'dict_obj',
 class UDPServer(EventReactorMixin, Thread, socketserver.UDPServer):
     '''UDP server'''
 
-    def __init__(self, event_reactor, address=('127.0.0.1', 0)):
+    def __init__(self, event_reactor, address=('127.0.0.1', 0),
+    inbound_event_id=UDP_INBOUND_EVENT, reuse_port=False):
+        '''
+        :param inbound_event_id: The event ID used for received datagrams.
+        :param reuse_port: If ``True``, the socket is bound with
+            ``SO_REUSEPORT`` so other processes may bind the same port.
+        '''
+
         EventReactorMixin.__init__(self, event_reactor)
         Thread.__init__(self)
         self.name = 'network-udp-server'
         self.daemon = True
+        self.inbound_event_id = inbound_event_id
+        self.reuse_port = reuse_port
         socketserver.UDPServer.__init__(self, address, UDPRequestHandler)
         self.event_reactor.register_handler(EventReactor.STOP_ID,
             self._stop_cb)
         self._running = True
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        socketserver.UDPServer.server_bind(self)
+
     def run(self):
         '''Start the server'''
 
@@ -89,6 +131,148 @@ class UDPServer(EventReactorMixin, Thread, socketserver.UDPServer):
         _logger.debug('Network udp server stop requested')
 
 
+class BufferPool(object):
+    '''Reusable ``bytearray`` buffers of one size.
+
+    Buffers may be taken and given back on different threads.
+    '''
+
+    def __init__(self, buffer_size, max_buffers=256):
+        self._buffer_size = buffer_size
+        self._max_buffers = max_buffers
+        self._buffers = collections.deque()
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def acquire(self):
+        '''Return a free buffer or a new one.'''
+
+        try:
+            return self._buffers.pop()
+        except IndexError:
+            return bytearray(self._buffer_size)
+
+    def release(self, buffer):
+        '''Give back a buffer so it can be reused.'''
+
+        if len(self._buffers) < self._max_buffers:
+            self._buffers.append(buffer)
+
+
+class BatchUDPServer(EventReactorMixin, Thread):
+    '''UDP server that receives datagrams in batches.
+
+    Each wakeup drains the socket with ``recvfrom_into`` into buffers from
+    a :class:`BufferPool` and puts the datagrams on the event reactor
+    with one :func:`.EventReactor.put_many`. The handlers get a
+    ``memoryview`` of the buffer, which is reused once the batch was
+    dispatched, so handlers must not keep it.
+    '''
+
+    max_packet_size = 8192
+    batch_size = 64
+    poll_interval = 0.5
+
+    def __init__(self, event_reactor, address=('127.0.0.1', 0),
+    inbound_event_id=UDP_INBOUND_EVENT, reuse_port=False,
+    buffer_pool=None):
+        '''
+        :param inbound_event_id: The event ID used for received datagrams.
+        :param reuse_port: If ``True``, the socket is bound with
+            ``SO_REUSEPORT`` so other processes may bind the same port.
+        :param buffer_pool: A :class:`BufferPool` to share with other
+            instances. If ``None``, a new one is created.
+        '''
+
+        EventReactorMixin.__init__(self, event_reactor)
+        Thread.__init__(self)
+        self.name = 'network-udp-server'
+        self.daemon = True
+        self.inbound_event_id = inbound_event_id
+
+        if buffer_pool is None:
+            buffer_pool = BufferPool(self.max_packet_size,
+                self.batch_size * 4)
+
+        self._buffer_pool = buffer_pool
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.event_reactor.register_handler(EventReactor.STOP_ID,
+            self._stop_cb)
+        self._running = True
+
+    def run(self):
+        '''Start the server'''
+
+        _logger.debug('Network udp server started')
+
+        while self._running:
+            try:
+                readable = select.select([self.socket], [], [],
+                    self.poll_interval)[0]
+            except InterruptedError:
+                continue
+
+            if readable and self._running:
+                self._receive_batch()
+
+        _logger.debug('Network udp server stopped')
+
+    def _receive_batch(self):
+        '''Read the waiting datagrams and queue them as one event.'''
+
+        buffers = []
+        event_data_list = []
+
+        while len(buffers) < self.batch_size:
+            buffer = self._buffer_pool.acquire()
+
+            try:
+                num_bytes, address = self.socket.recvfrom_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                self._buffer_pool.release(buffer)
+                break
+            except OSError as e:
+                # e.g. an ICMP port unreachable of an earlier send
+                _logger.debug('Receive error %s', e)
+                self._buffer_pool.release(buffer)
+                continue
+
+            buffers.append(buffer)
+            event_data_list.append((address, memoryview(buffer)[:num_bytes]))
+
+        if not buffers:
+            return
+
+        _receive_batch_size.observe(len(buffers))
+
+        def release_buffers():
+            for buffer in buffers:
+                self._buffer_pool.release(buffer)
+
+        try:
+            self.event_reactor.put_many(self.inbound_event_id,
+                event_data_list, release_buffers)
+        except queue.Full:
+            _logger.warning('Dropped %d datagrams', len(buffers))
+            release_buffers()
+
+    def _stop_cb(self, event_id):
+        self._running = False
+        _logger.debug('Network udp server stop requested')
+
+
 class UDPClient(object):
     '''UDP Client'''
 
@@ -102,6 +286,33 @@ class UDPClient(object):
         self.socket.sendto(data, address)
 
 
+class UDPTransport(object):
+    '''Sends and receives datagrams through a UDP socket.
+
+    A transport provides ``server_address``, ``send(address, data)`` and
+    ``start()``. Received datagrams are put on the event reactor with the
+    inbound event ID given to the constructor.
+    '''
+
+    def __init__(self, event_reactor, address, inbound_event_id,
+    reuse_port=False):
+        self._server = BatchUDPServer(event_reactor, address=address,
+            inbound_event_id=inbound_event_id, reuse_port=reuse_port)
+        # By passing in the same socket object to the client, this method
+        # allows other nodes to reply to our server's port.
+        self._client = UDPClient(socket_obj=self._server.socket)
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def send(self, address, data):
+        self._client.send(address, data)
+
+    def start(self):
+        self._server.start()
+
+
 class JSONKeys(object):
     '''The keys used in the JSON data'''
 
@@ -113,14 +324,152 @@ class JSONKeys(object):
     TRANSFER_SIZE = 'xfer_size'
 
 
+class PacketKinds(object):
+    '''The kinds of packets counted in the metrics'''
+
+    REQUEST = 'request'
+    REPLY = 'reply'
+    TRANSFER = 'transfer'
+
+    @staticmethod
+    def from_dict(packet_dict):
+        if JSONKeys.REPLY_SEQUENCE_ID in packet_dict:
+            return PacketKinds.REPLY
+        elif JSONKeys.TRANSFER_ID in packet_dict:
+            return PacketKinds.TRANSFER
+        else:
+            return PacketKinds.REQUEST
+
+
+class RTTStats(object):
+    '''Round trip times of the replies of each peer.
+
+    A smoothed RTT and its variation are kept as in RFC 6298 along with the
+    most recent samples for percentiles. The least recently seen peers are
+    forgotten when there are too many.
+
+    This class is thread-safe.
+    '''
+
+    MAX_PEERS = 4096
+    NUM_SAMPLES = 32
+
+    def __init__(self, max_peers=MAX_PEERS):
+        self._max_peers = max_peers
+        self._peers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._peers)
+
+    def observe(self, address, rtt):
+        '''Add a round trip time sample in seconds.'''
+
+        with self._lock:
+            peer = self._peers.pop(address, None)
+
+            if peer is None:
+                peer = _PeerRTT(rtt, self.NUM_SAMPLES)
+
+                if len(self._peers) >= self._max_peers:
+                    self._peers.popitem(last=False)
+            else:
+                peer.update(rtt)
+
+            self._peers[address] = peer
+
+    def smoothed_rtt(self, address):
+        '''Return the smoothed RTT or ``None`` if there is no sample.'''
+
+        peer = self._peers.get(address)
+
+        if peer:
+            return peer.srtt
+
+    def rtt_variation(self, address):
+        '''Return the RTT variation or ``None`` if there is no sample.'''
+
+        peer = self._peers.get(address)
+
+        if peer:
+            return peer.rttvar
+
+    def percentile(self, address, fraction):
+        '''Return a percentile of the recent samples.
+
+        :param fraction: A number from 0 to 1.
+        :return: The RTT or ``None`` if there is no sample.
+        '''
+
+        peer = self._peers.get(address)
+
+        if not peer:
+            return
+
+        with self._lock:
+            samples = sorted(peer.samples)
+
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class _PeerRTT(object):
+    __slots__ = ('srtt', 'rttvar', 'samples')
+
+    def __init__(self, rtt, num_samples):
+        self.srtt = rtt
+        self.rttvar = rtt / 2
+        self.samples = collections.deque([rtt], num_samples)
+
+    def update(self, rtt):
+        self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+        self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples.append(rtt)
+
+
+class _OutEntry(object):
+    __slots__ = ('event', 'send_time', 'deadline', 'retransmitted')
+
+    def __init__(self, event, send_time, deadline):
+        self.event = event
+        self.send_time = send_time
+        self.deadline = deadline
+        self.retransmitted = False
+
+
 class ReplyTable(object):
-    '''Manages the matching of sequence IDs to prevent forged UDP replies'''
+    '''Manages the matching of sequence IDs to prevent forged UDP replies
 
-    def __init__(self):
-        self.out_table = {}
-        self.in_table = {}
+    Entries expire so replies that never arrive and replies that no one
+    picks up do not pile up. Expired requests are remembered for a while
+    so that their late replies still give a round trip time. The table
+    holds at most `max_entries` of each kind of entry; the oldest are
+    dropped first.
 
-    def add_out_entry(self, sequence_id, address, event):
+    This class is thread-safe.
+
+    :ivar rtt_stats: The :class:`RTTStats` of the replies.
+    '''
+
+    DEFAULT_TIMEOUT = 60  # seconds
+    LATE_REPLY_TIME = 60  # seconds
+    MAX_ENTRIES = 16384
+
+    def __init__(self, clock=time.monotonic, max_entries=MAX_ENTRIES,
+    rtt_stats=None):
+        self.out_table = collections.OrderedDict()
+        self.in_table = collections.OrderedDict()
+        self.rtt_stats = rtt_stats if rtt_stats is not None else RTTStats()
+        self._expired_table = collections.OrderedDict()
+        self._clock = clock
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.out_table) + len(self.in_table) \
+            + len(self._expired_table)
+
+    def add_out_entry(self, sequence_id, address, event,
+    timeout=DEFAULT_TIMEOUT):
         '''Add an entry that expects a reply
 
         :Parameters:
@@ -130,9 +479,16 @@ class ReplyTable(object):
                 The destination of the packet
             event: :class:`threading.Event`
                 The :class:`threading.Event` instance to wait on
+            timeout
+                The time in seconds before the entry is expired by
+                :func:`sweep`
         '''
 
-        self.out_table[(sequence_id, address)] = event
+        now = self._clock()
+
+        with self._lock:
+            self._add(self.out_table, (sequence_id, address),
+                _OutEntry(event, now, now + timeout))
 
     def get_out_entry(self, sequence_id, address):
         '''Get the Event instance
@@ -140,17 +496,79 @@ class ReplyTable(object):
         :rtype: :class:`threading.Event`, ``None``
         '''
 
-        return self.out_table.get((sequence_id, address))
+        entry = self.out_table.get((sequence_id, address))
+
+        if entry:
+            return entry.event
 
     def remove_out_entry(self, sequence_id, address):
         '''Remove the entry'''
 
-        del self.out_table[(sequence_id, address)]
+        with self._lock:
+            self.out_table.pop((sequence_id, address), None)
+
+    def mark_retransmitted(self, sequence_id, address):
+        '''Note that the packet was sent again.
+
+        The reply of a packet sent more than once does not give a round
+        trip time because it is not known which packet was answered.
+        '''
+
+        entry = self.out_table.get((sequence_id, address))
+
+        if entry:
+            entry.retransmitted = True
+
+    def expire_out_entry(self, sequence_id, address):
+        '''Stop waiting for a reply but watch for a late one.'''
+
+        key = (sequence_id, address)
+
+        with self._lock:
+            entry = self.out_table.pop(key, None)
+
+            if entry:
+                self._expire(key, entry)
+
+    def add_reply(self, data_packet):
+        '''Match a reply to its entry and store it.
+
+        :return: The :class:`threading.Event` to set or ``None`` if the
+            reply was not expected. Late replies only add a round trip time.
+        '''
+
+        key = (data_packet.sequence_id, data_packet.address)
+        now = self._clock()
+
+        with self._lock:
+            entry = self.out_table.pop(key, None)
+
+            if not entry:
+                late_entry = self._expired_table.pop(key, None)
+
+                if late_entry:
+                    send_time, dummy, retransmitted = late_entry
+                    _late_replies.inc()
+
+                    if not retransmitted:
+                        self.rtt_stats.observe(key[1], now - send_time)
+
+                return
+
+            self._add(self.in_table, key,
+                (data_packet, now + self.LATE_REPLY_TIME))
+
+        if not entry.retransmitted:
+            self.rtt_stats.observe(key[1], now - entry.send_time)
+
+        return entry.event
 
     def add_in_entry(self, sequence_id, address, data_packet):
         '''Store the data packet reply to be retrieved be woken thread'''
 
-        self.in_table[(sequence_id, address)] = data_packet
+        with self._lock:
+            self._add(self.in_table, (sequence_id, address),
+                (data_packet, self._clock() + self.LATE_REPLY_TIME))
 
     def get_in_entry(self, sequence_id, address):
         '''Get the stored data packet
@@ -158,12 +576,51 @@ class ReplyTable(object):
         :rtype: :class:`DataPacket`, ``None``
         '''
 
-        return self.in_table.get((sequence_id, address))
+        entry = self.in_table.get((sequence_id, address))
+
+        if entry:
+            return entry[0]
 
     def remove_in_entry(self, sequence_id, address):
         '''Delete the stored data packet'''
 
-        del self.in_table[(sequence_id, address)]
+        with self._lock:
+            self.in_table.pop((sequence_id, address), None)
+
+    def sweep(self):
+        '''Remove the expired entries.
+
+        :returns: The number of entries removed.
+        '''
+
+        now = self._clock()
+        count = 0
+
+        with self._lock:
+            for key, entry in list(self.out_table.items()):
+                if entry.deadline <= now:
+                    del self.out_table[key]
+                    self._expire(key, entry)
+                    count += 1
+
+            for table in (self.in_table, self._expired_table):
+                for key, entry in list(table.items()):
+                    if entry[1] <= now:
+                        del table[key]
+                        count += 1
+
+        return count
+
+    def _expire(self, key, entry):
+        self._add(self._expired_table, key, (entry.send_time,
+            self._clock() + self.LATE_REPLY_TIME, entry.retransmitted))
+
+    def _add(self, table, key, value):
+        table[key] = value
+
+        if len(table) > self._max_entries:
+            table.popitem(last=False)
+            _reply_table_evictions.inc()
 
 
 class Network(EventReactorMixin):
@@ -176,46 +633,102 @@ class Network(EventReactorMixin):
             The time in seconds before a reply is timed out
         STREAM_DATA_SIZE
             The size in bytes of the parts of the file transmitted
+        MAX_ACK_DELAY
+            The maximum time in seconds a download acknowledgement is
+            delayed by rate limiting. Senders of transfer data wait at
+            least this long plus the round trip time before sending again.
     '''
 
     MAX_UDP_PACKET_SIZE = 65507  # bytes
     DEFAULT_TIMEOUT = 10  # seconds
     STREAM_DATA_SIZE = 1024  # bytes
-    SEQUENCE_ID_SIZE = 20  # bytes
+    SEQUENCE_ID_SIZE = 6  # bytes
+    TRANSFER_ID_SIZE = 20  # bytes
+    REPLY_TABLE_SWEEP_INTERVAL = 30  # seconds
     DEFAULT_POOL_SIZE = 20
+    MAX_ACK_DELAY = 2  # seconds
+    MIN_RETRANSMIT_TIMEOUT = 0.2  # seconds
+
+    def __init__(self, event_reactor, address=('127.0.0.1', 0),
+    transport=UDPTransport, pool_executor=None, upload_limiter=None,
+    download_limiter=None):
+        '''
+        :param transport: A function that accepts the event reactor, the
+            address, and the inbound event ID and returns a transport such
+            as :class:`UDPTransport`.
+        :param pool_executor: A :class:`.WrappedThreadPoolExecutor` to
+            share with other instances. If ``None``, a new one is created.
+        :param upload_limiter: A :class:`.BandwidthLimiter` to share with
+            other instances. If ``None``, a new one is created.
+        :param download_limiter: Like `upload_limiter`.
+        '''
 
-    def __init__(self, event_reactor, address=('127.0.0.1', 0)):
         EventReactorMixin.__init__(self, event_reactor)
-        self._server = UDPServer(event_reactor, address=address)
-        # By passing in the same socket object to the client, this method
-        # allows other nodes to reply to our server's port.
-        self._client = UDPClient(socket_obj=self._server.socket)
-        self._reply_table = ReplyTable()
+        self._inbound_event_id = EventID(self, 'UDP inbound')
+        self._transport = transport(event_reactor, address,
+            self._inbound_event_id)
         self._downloads = {}
-        self._pool_executor = WrappedThreadPoolExecutor(
+        self._download_timers = {}
+        self._pool_executor = pool_executor or WrappedThreadPoolExecutor(
             Network.DEFAULT_POOL_SIZE, event_reactor)
         self._event_scheduler = EventScheduler(event_reactor)
+        self._clock = self._event_scheduler.timer_wheel.clock
+        self._reply_table = ReplyTable(clock=self._clock)
+        self._sequence_counter = itertools.count(
+            int.from_bytes(os.urandom(Network.SEQUENCE_ID_SIZE), 'big'))
+        self._sequence_salt_key = os.urandom(16)
         self._transfer_timer_id = EventID(self, 'Clean transfers')
+        self._ack_timer_id = EventID(self, 'Delayed ack')
+        self._sweep_timer_id = EventID(self, 'Sweep reply table')
+        self._upload_limiter = upload_limiter or BandwidthLimiter()
+        self._download_limiter = download_limiter or BandwidthLimiter()
         self._running = True
 
         self._register_handlers()
-        self._server.start()
+        self._sweep_timer = self._event_scheduler.add_periodic(
+            Network.REPLY_TABLE_SWEEP_INTERVAL, self._sweep_timer_id)
+        self._transport.start()
 
     @property
     def server_address(self):
         '''The address of the server'''
 
-        return self._server.server_address
+        return self._transport.server_address
+
+    @property
+    def rtt_stats(self):
+        '''The :class:`RTTStats` of the replies to sent packets.'''
+
+        return self._reply_table.rtt_stats
+
+    @property
+    def upload_limiter(self):
+        '''The :class:`.BandwidthLimiter` of uploads.'''
+
+        return self._upload_limiter
+
+    @property
+    def download_limiter(self):
+        '''The :class:`.BandwidthLimiter` of downloads.
+
+        Downloads are slowed by delaying the acknowledgement of each part.
+        '''
+
+        return self._download_limiter
 
     def _register_handlers(self):
         '''Register the event callbacks'''
 
-        self.event_reactor.register_handler(UDP_INBOUND_EVENT,
+        self.event_reactor.register_handler(self._inbound_event_id,
             self._udp_incoming_callback)
         self.event_reactor.register_handler(EventReactor.STOP_ID,
             self._stop_callback)
         self.event_reactor.register_handler(self._transfer_timer_id,
             self._clean_download)
+        self.event_reactor.register_handler(self._ack_timer_id,
+            self._delayed_ack_callback)
+        self.event_reactor.register_handler(self._sweep_timer_id,
+            self._sweep_callback)
 
     def _stop_callback(self, event_id):
         '''Stop and expire everything'''
@@ -224,28 +737,49 @@ class Network(EventReactorMixin):
 
         for transfer_id in list(self._downloads.keys()):
             download_task = self._downloads[transfer_id]
-            del self._downloads[transfer_id]
+            self._remove_download(transfer_id)
             download_task.transfer(None)
 
-        for key in list(self._reply_table.out_table.keys()):
-            event = self._reply_table.out_table[key]
-            event.set()
+        self._sweep_timer.cancel()
+
+        for entry in list(self._reply_table.out_table.values()):
+            entry.event.set()
+
+    def _sweep_callback(self, event_id):
+        count = self._reply_table.sweep()
+
+        _logger.debug('Swept reply table removed=%d remaining=%d', count,
+            len(self._reply_table))
 
     def _clean_download(self, event_id, transfer_id):
         '''Remove timed out file download'''
 
-        download_task = self._downloads[transfer_id]
+        download_task = self._downloads.get(transfer_id)
+
+        if not download_task:
+            return
+
         last_modified = download_task.last_modified
         timeout = download_task.timeout
 
-        if last_modified + timeout < time.time():
+        if last_modified + timeout < self._clock():
             _logger.debug('Cleaned out download %s', transfer_id)
-            del self._downloads[transfer_id]
+            self._remove_download(transfer_id)
             download_task.transfer(None)
         else:
             _logger.debug('Still alive download %s', transfer_id)
-            self._event_scheduler.add_one_shot(timeout,
-                self._transfer_timer_id, transfer_id)
+            self._download_timers[transfer_id] = \
+                self._event_scheduler.add_absolute(last_modified + timeout,
+                    self._transfer_timer_id, transfer_id)
+
+    def _remove_download(self, transfer_id):
+        '''Forget a download and cancel its timeout'''
+
+        del self._downloads[transfer_id]
+        timer = self._download_timers.pop(transfer_id, None)
+
+        if timer:
+            timer.cancel()
 
     def _udp_incoming_callback(self, event_id, address, data):
         '''udp incoming'''
@@ -253,13 +787,18 @@ class Network(EventReactorMixin):
         if not self._running:
             return
 
-        _logger.debug('UDP %s←%s %s', self.server_address, address,
-            data[:160])
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('UDP %s←%s %s', self.server_address, address,
+                bytes(data[:160]))
+
         packet_dict = self._unpack_udp_data(data)
 
         if not packet_dict:
             return
 
+        _packets_received.labels(PacketKinds.from_dict(packet_dict)).inc()
+        _bytes_received.inc(len(data))
+
         data_packet = DataPacket(address, packet_dict,
             packet_dict.get(JSONKeys.SEQUENCE_ID) \
             or packet_dict.get(JSONKeys.REPLY_SEQUENCE_ID))
@@ -288,7 +827,7 @@ class Network(EventReactorMixin):
         raise NotImplementedError()
 
     def expect_incoming_transfer(self, transfer_id, timeout=DEFAULT_TIMEOUT,
-    download_task_class=None, max_size=None):
+    download_task_class=None, max_size=None, traffic_class=None):
         '''Allow a transfer for download.
 
         :Parameters:
@@ -298,6 +837,8 @@ class Network(EventReactorMixin):
                 Time in seconds before the transfer times out.
             max_size: ``int`` ``None``
                 The maximum file size.
+            traffic_class: ``str`` ``None``
+                The :class:`.TrafficClasses` used for rate limiting.
 
         :rtype: :class:`DownloadTask`
         :return: A future that returns a file object that may have been
@@ -305,11 +846,14 @@ class Network(EventReactorMixin):
         '''
 
         download_task_class = download_task_class or DownloadTask
-        download_task = download_task_class(max_size=max_size)
+        download_task = download_task_class(max_size=max_size,
+            clock=self._clock)
+        download_task.traffic_class = traffic_class
         self._downloads[transfer_id] = download_task
 
-        self._event_scheduler.add_one_shot(timeout, self._transfer_timer_id,
-            transfer_id)
+        self._download_timers[transfer_id] = \
+            self._event_scheduler.add_one_shot(timeout,
+                self._transfer_timer_id, transfer_id)
 
         self._pool_executor.submit(download_task)
 
@@ -318,18 +862,13 @@ class Network(EventReactorMixin):
     def _accept_reply(self, data_packet):
         '''Process a reply and allow a future to resume'''
 
-        sequence_id = data_packet.sequence_id
-        address = data_packet.address
-
-        event = self._reply_table.get_out_entry(sequence_id,
-            address)
+        event = self._reply_table.add_reply(data_packet)
 
         if not event:
-            _logger.debug('Unknown seq id %s, packet discarded', sequence_id)
+            _logger.debug('Unknown seq id %s, packet discarded',
+                data_packet.sequence_id)
             return
 
-        self._reply_table.remove_out_entry(sequence_id, address)
-        self._reply_table.add_in_entry(sequence_id, address, data_packet)
         event.set()
 
     def _accept_transfer(self, data_packet):
@@ -354,6 +893,7 @@ class Network(EventReactorMixin):
         download_task.address = data_packet.address
 
         if data_str is None:
+            self._remove_download(transfer_id)
             download_task.transfer(None)
             _logger.debug('Read download finished')
 
@@ -365,7 +905,15 @@ class Network(EventReactorMixin):
                 _logger.debug('Decode error %s', e)
                 return
 
-            download_task.transfer(data)
+            if not download_task.transfer(data, data_packet.sequence_id):
+                # The acknowledgement was lost or is late
+                _logger.debug('Read download duplicate seq_id=%s',
+                    data_packet.sequence_id)
+                self.send_answer_reply(data_packet,
+                    {JSONKeys.TRANSFER_ID: transfer_id})
+
+                return
+
             _logger.debug('Read download len=%d', len(data))
 
         if download_task.is_running:
@@ -373,10 +921,22 @@ class Network(EventReactorMixin):
                 JSONKeys.TRANSFER_ID: transfer_id
             }
 
-            self.send_answer_reply(data_packet, d)
+            delay = self._download_limiter.reserve(len(data),
+                data_packet.address, download_task.traffic_class)
+
+            if delay:
+                self._event_scheduler.add_one_shot(
+                    min(delay, Network.MAX_ACK_DELAY), self._ack_timer_id,
+                    data_packet, d)
+            else:
+                self.send_answer_reply(data_packet, d)
         else:
             _logger.debug('Download aborted')
 
+    def _delayed_ack_callback(self, event_id, data_packet, dict_obj):
+        if self._running:
+            self.send_answer_reply(data_packet, dict_obj)
+
     def _pack_udp_data(self, packet_dict):
         '''Pack the dict into a format suitable for transmission.
 
@@ -436,7 +996,16 @@ class Network(EventReactorMixin):
         '''Send the data as a single UDP packet'''
 
         _logger.debug('Dict %s→%s', self.server_address, address)
-        self._client.send(address, self._pack_udp_data(dict_obj))
+        self._send_packet_dict(address, dict_obj)
+
+    def _send_packet_dict(self, address, packet_dict):
+        '''Pack and send the data as a single UDP packet'''
+
+        data = self._pack_udp_data(packet_dict)
+
+        _packets_sent.labels(PacketKinds.from_dict(packet_dict)).inc()
+        _bytes_sent.inc(len(data))
+        self._transport.send(address, data)
 
     def _send_expect_reply(self, address, dict_obj, timeout=DEFAULT_TIMEOUT):
         '''Send the data and wait for a reply
@@ -446,24 +1015,51 @@ class Network(EventReactorMixin):
 
         _logger.debug('Dict %s→%s timeout=%d', self.server_address,
             address, timeout)
-        sequence_id = self.new_sequence_id()
+        sequence_id = self.new_sequence_id(address)
 
         event = threading.Event()
-        self._reply_table.add_out_entry(sequence_id, address, event)
+        self._reply_table.add_out_entry(sequence_id, address, event,
+            timeout)
 
         packet_dict = dict_obj.copy()
         packet_dict[JSONKeys.SEQUENCE_ID] = sequence_id
 
         def send_fn():
-            self._client.send(address, self._pack_udp_data(packet_dict))
+            self._send_packet_dict(address, packet_dict)
+
+        # Acknowledgements of transfers may be delayed by rate limiting.
+        ack_delay = Network.MAX_ACK_DELAY \
+            if JSONKeys.TRANSFER_DATA in dict_obj else 0
 
         send_packet_task = SendPacketTask(send_fn, sequence_id, address,
-            self._reply_table, event, timeout)
+            self._reply_table, event, timeout,
+            first_wait=self._retransmit_timeout(address,
+                timeout / SendPacketTask.NUM_ATTEMPTS, ack_delay),
+            timer_wheel=self._event_scheduler.timer_wheel)
 
         self._pool_executor.submit(send_packet_task)
 
         return send_packet_task
 
+    def _retransmit_timeout(self, address, max_timeout, ack_delay=0):
+        '''Return the seconds to wait for a reply before sending again.
+
+        Like TCP, the timeout is the smoothed round trip time plus four
+        times its variation. It is at least the round trip time plus
+        `ack_delay`, the time the reply may be held back by the peer.
+        '''
+
+        rtt_stats = self._reply_table.rtt_stats
+        srtt = rtt_stats.smoothed_rtt(address)
+
+        if srtt is None:
+            return max_timeout
+
+        rto = max(srtt + 4 * rtt_stats.rtt_variation(address),
+            srtt + ack_delay)
+
+        return min(max_timeout, max(Network.MIN_RETRANSMIT_TIMEOUT, rto))
+
     def send_answer_reply(self, source_data_packet, dict_obj):
         '''Send ``dict`` that is a response to a incoming data packet
 
@@ -485,10 +1081,10 @@ class Network(EventReactorMixin):
         packet_dict = dict_obj.copy()
         packet_dict[JSONKeys.REPLY_SEQUENCE_ID] = sequence_id
 
-        self._client.send(address, self._pack_udp_data(packet_dict))
+        self._send_packet_dict(address, packet_dict)
 
     def send_bytes(self, address, transfer_id, bytes_,
-    timeout=DEFAULT_TIMEOUT):
+    timeout=DEFAULT_TIMEOUT, traffic_class=None):
         '''Transfer data to another client.
 
         :Parameters:
@@ -501,6 +1097,8 @@ class Network(EventReactorMixin):
             transfer_id: ``str``, ``None``
                 The transfer ID to be used. If ``None``, an ID will be
                 created automatically.
+            traffic_class: ``str`` ``None``
+                The :class:`.TrafficClasses` used for rate limiting.
 
         :see: :func:`send_file`
         :rtype: :class:`UploadTask`
@@ -508,9 +1106,11 @@ class Network(EventReactorMixin):
 
         f = io.BytesIO(bytes_)
 
-        return self.send_file(address, transfer_id, f, timeout)
+        return self.send_file(address, transfer_id, f, timeout,
+            traffic_class)
 
-    def send_file(self, address, transfer_id, file_, timeout=DEFAULT_TIMEOUT):
+    def send_file(self, address, transfer_id, file_, timeout=DEFAULT_TIMEOUT,
+    traffic_class=None):
         '''Transfer data to another client.
 
         :Parameters:
@@ -523,6 +1123,8 @@ class Network(EventReactorMixin):
             transfer_id: ``str``, ``None``
                 The transfer ID to be used. If ``None``, an ID will be
                 created automatically.
+            traffic_class: ``str`` ``None``
+                The :class:`.TrafficClasses` used for rate limiting.
 
         :rtype: :class:`UploadTask`
         :return: A future that returns an ``int`` that is the number of bytes
@@ -534,42 +1136,88 @@ class Network(EventReactorMixin):
         else:
             source_file = open(file_, 'rb')
 
-        transfer_id = transfer_id or self.new_sequence_id()
+        transfer_id = transfer_id or self.new_transfer_id()
 
         _logger.debug('Send file %s→%s', self.server_address, address)
 
         upload_task = UploadTask(self, address, source_file,
-            transfer_id, timeout)
+            transfer_id, timeout, traffic_class)
 
         self._pool_executor.submit(upload_task)
 
         return upload_task
 
-    def new_sequence_id(self):
+    def new_sequence_id(self, address=None):
         '''Generate a new sequence ID.
 
+        The IDs are a counter offset by a secret salt for each address, so
+        they are short but others cannot guess the IDs sent to a peer.
+
+        :param address: The destination of the packet.
         :rtype: ``str``
         '''
 
-        return bytes_to_b64(os.urandom(Network.SEQUENCE_ID_SIZE))
+        return bytes_to_b64(self._new_sequence_id_bytes(address))
+
+    def _new_sequence_id_bytes(self, address):
+        salt = hashlib.blake2b(repr(address).encode(),
+            digest_size=Network.SEQUENCE_ID_SIZE,
+            key=self._sequence_salt_key).digest()
+        number = next(self._sequence_counter) + int.from_bytes(salt, 'big')
+
+        return (number % 2 ** (Network.SEQUENCE_ID_SIZE * 8)).to_bytes(
+            Network.SEQUENCE_ID_SIZE, 'big')
+
+    def new_transfer_id(self):
+        '''Generate a new random transfer ID.
+
+        Transfers are accepted from any address that knows their ID, so
+        the IDs are random instead of counted like sequence IDs.
+
+        :rtype: ``str``
+        '''
+
+        return bytes_to_b64(self._new_transfer_id_bytes())
+
+    def _new_transfer_id_bytes(self):
+        return os.urandom(Network.TRANSFER_ID_SIZE)
 
 
 class DownloadTask(Task):
     '''Downloads data from a contact and returns a file object.'''
 
-    def __init__(self, timeout=Network.DEFAULT_TIMEOUT, max_size=None):
+    def __init__(self, timeout=Network.DEFAULT_TIMEOUT, max_size=None,
+    clock=time.time):
         Task.__init__(self)
         self._file = tempfile.SpooledTemporaryFile(1048576)
         self._bytes_queue = queue.Queue(1)
+        self._clock = clock
         self.timeout = timeout
-        self.last_modified = time.time()
+        self.last_modified = clock()
         self.address = None
         self.max_size = max_size
+        self.traffic_class = None
+        self._chunk_ids = set()
+
+    def transfer(self, bytes_, chunk_id=None):
+        '''Add data to the download.
+
+        :param chunk_id: The sequence ID of the packet carrying the data.
+            Retransmitted packets have the same ID.
+        :return: ``False`` if the data was already received.
+        '''
+
+        if chunk_id is not None:
+            if chunk_id in self._chunk_ids:
+                return False
 
-    def transfer(self, bytes_):
-        self.last_modified = time.time()
+            self._chunk_ids.add(chunk_id)
+
+        self.last_modified = self._clock()
         self._bytes_queue.put(bytes_)
 
+        return True
+
     def run(self):
         while self.is_running:
             try:
@@ -593,12 +1241,17 @@ class DownloadTask(Task):
 
 class UploadTask(Task):
     '''Returns the number of bytes sent.'''
-    def run(self, network, address, source_file, transfer_id, timeout):
+    def run(self, network, address, source_file, transfer_id, timeout,
+    traffic_class=None):
         self.progress = 0
 
         while self.is_running:
             data = source_file.read(Network.STREAM_DATA_SIZE)
 
+            if data:
+                network.upload_limiter.throttle(len(data), address,
+                    traffic_class)
+
             d = {
                 JSONKeys.TRANSFER_ID: transfer_id,
                 JSONKeys.TRANSFER_DATA: bytes_to_b64(data),
@@ -625,29 +1278,80 @@ class SendPacketTask(Task):
     '''Send a data packet and return the response.
 
     The result returned is either `None` or :class:`DataPacket`.
+
+    The first attempt waits `first_wait` seconds and the other attempts
+    share the rest of the timeout.
     '''
 
+    NUM_ATTEMPTS = 2
+
     def __init__(self, *args, **kwargs):
         Task.__init__(self, *args, **kwargs)
         self.event = args[4]  # used by Network._stop_callback
 
     def run(self, send_fn, sequence_id, address, reply_table, event, timeout,
-    num_attempts=2):
+    num_attempts=NUM_ATTEMPTS, first_wait=None, timer_wheel=None):
+        start_time = time.monotonic()
+        time_left = timeout
+
         for i in range(num_attempts):
             if not self.is_running:
                 break
 
+            if i:
+                _send_retries.inc()
+                reply_table.mark_retransmitted(sequence_id, address)
+
+            if i == 0 and first_wait and num_attempts > 1:
+                wait_time = min(first_wait, timeout)
+            else:
+                wait_time = time_left / (num_attempts - i)
+
+            time_left -= wait_time
+
             _logger.debug('SendPacketTask →%s attempt=%d', address, i)
+            self._attempt = i
             send_fn()
-            event.wait(timeout / num_attempts)
+            self._wait(event, wait_time, timer_wheel)
 
             data_packet = reply_table.get_in_entry(sequence_id, address)
 
             if data_packet:
                 reply_table.remove_in_entry(sequence_id, address)
+                _reply_latency.observe(time.monotonic() - start_time)
                 _logger.debug('SendPacketTask got confirm →%s attempt=%d',
                     address, i)
                 return data_packet
 
+        reply_table.expire_out_entry(sequence_id, address)
+
+        if self.is_running:
+            _send_timeouts.inc()
+
         _logger.debug('SendPacketTask no reply →%s attempt=%d', address, i)
         return data_packet
+
+    def _wait(self, event, timeout, timer_wheel):
+        '''Wait for the reply or the timeout.
+
+        The timeout is counted by the timer wheel so that it follows the
+        wheel's clock.
+        '''
+
+        if not timer_wheel:
+            event.wait(timeout)
+            return
+
+        timer = timer_wheel.add(timer_wheel.clock() + timeout,
+            self._timed_out, event, self._attempt)
+
+        event.wait()
+        timer.cancel()
+
+        if self.is_running:
+            event.clear()
+
+    def _timed_out(self, event, attempt):
+        # A late timer of a previous attempt must not cut the next short
+        if attempt == self._attempt:
+            event.set()
@@ -1,9 +1,12 @@
 from bytestag.events import EventReactor, EventScheduler
-from bytestag.network import UDPServer, UDPClient, Network, ReplyTable
+from bytestag.network import (UDPServer, UDPClient, Network, ReplyTable,
+    BatchUDPServer, BufferPool, RTTStats, DataPacket)
+import base64
 import bytestag.network
 import hashlib
 import io
 import logging
+import os
 import threading
 import unittest
 
@@ -43,6 +46,54 @@ class TestUDP(unittest.TestCase):
         self.assertEqual(data, b'hello')
 
 
+    def test_batch_udp(self):
+        '''It should receive datagrams in batches into reused buffers'''
+
+        event_reactor = EventReactor()
+        buffer_pool = BufferPool(BatchUDPServer.max_packet_size)
+        server = BatchUDPServer(event_reactor, buffer_pool=buffer_pool)
+        client = UDPClient()
+        received = []
+
+        def my_callback(event_id, address, data):
+            received.append(bytes(data))
+
+            if len(received) == 100:
+                event_reactor.put(EventReactor.STOP_ID)
+
+        event_reactor.register_handler(
+            bytestag.network.UDP_INBOUND_EVENT, my_callback)
+
+        for i in range(100):
+            client.send(server.server_address, str(i).encode())
+
+        server.start()
+        reactor_thread = threading.Thread(target=event_reactor.start)
+        reactor_thread.daemon = True
+        reactor_thread.start()
+        reactor_thread.join(2)
+        event_reactor.put(EventReactor.STOP_ID)
+
+        self.assertEqual([str(i).encode() for i in range(100)], received)
+        self.assertTrue(len(buffer_pool))
+
+    def test_buffer_pool(self):
+        '''It should reuse buffers given back'''
+
+        buffer_pool = BufferPool(16, max_buffers=1)
+        buffer_1 = buffer_pool.acquire()
+        buffer_2 = buffer_pool.acquire()
+
+        self.assertEqual(16, len(buffer_1))
+        self.assertIsNot(buffer_1, buffer_2)
+
+        buffer_pool.release(buffer_1)
+        buffer_pool.release(buffer_2)
+
+        self.assertEqual(1, len(buffer_pool))
+        self.assertIs(buffer_1, buffer_pool.acquire())
+
+
 class TestNetworkControllerComponents(unittest.TestCase):
     def test_udp_packing(self):
         '''It should pack and unpack the data symmetrically'''
@@ -199,6 +250,38 @@ class TestNetworkControllerMultiNode(unittest.TestCase):
         self.assertEqual(len(data), f_other.tell())
         self.assertEqual(test_hasher.digest(), hasher.digest())
 
+    def test_send_file_throttled(self):
+        '''It should transfer a file intact when the receiver delays
+        acknowledgements after round trip times are known'''
+
+        transfer_id = '123'
+        data = os.urandom(8192)
+
+        self.setup_nodes(2)
+
+        self.nc[1].receive_callback = lambda data_packet: \
+            self.nc[1].send_answer_reply(data_packet, {'pong': True})
+
+        for dummy in range(5):
+            self.assertTrue(self.nc[0].send(self.nc[1].server_address,
+                {'ping': True}, timeout=self.TIMEOUT).result())
+
+        self.nc[1].download_limiter.rate = 4096
+
+        read_transfer_task = self.nc[1].expect_incoming_transfer(transfer_id,
+            timeout=self.TIMEOUT)
+        future = self.nc[0].send_file(self.nc[1].server_address, transfer_id,
+            io.BytesIO(data), timeout=self.TIMEOUT)
+
+        bytes_sent = future.result()
+        f_other = read_transfer_task.result()
+
+        self.stop_event_reactors()
+        self.join_event_reactors()
+
+        self.assertEqual(len(data), bytes_sent)
+        self.assertEqual(data, f_other.read())
+
 
 class TestReplyTable(unittest.TestCase):
     def test_add_remove_out(self):
@@ -220,3 +303,123 @@ class TestReplyTable(unittest.TestCase):
         self.assertEqual(table.get_in_entry(0, 0), None)
         table.remove_in_entry(0, 0)
         self.assertFalse(table.get_in_entry(0, 0))
+
+    def test_expire(self):
+        '''It should remove entries after their deadline'''
+
+        now = 0
+        table = ReplyTable(clock=lambda: now)
+        event = threading.Event()
+
+        table.add_out_entry('a', 'addr', event, timeout=10)
+        table.add_in_entry('b', 'addr', None)
+
+        self.assertEqual(0, table.sweep())
+
+        now = 11
+
+        self.assertEqual(1, table.sweep())
+        self.assertFalse(table.get_out_entry('a', 'addr'))
+
+        now = 1000
+
+        self.assertEqual(2, table.sweep())
+        self.assertEqual(0, len(table))
+
+    def test_reply_rtt(self):
+        '''It should record round trip times, also of late replies'''
+
+        now = 0
+        table = ReplyTable(clock=lambda: now)
+        event = threading.Event()
+
+        table.add_out_entry('a', 'addr', event)
+        table.add_out_entry('b', 'addr', event)
+        table.add_out_entry('c', 'addr', event)
+        table.mark_retransmitted('c', 'addr')
+        table.expire_out_entry('b', 'addr')
+
+        now = 2
+
+        self.assertIs(event, table.add_reply(DataPacket('addr', {}, 'a')))
+        self.assertEqual(2, table.rtt_stats.smoothed_rtt('addr'))
+
+        now = 4
+
+        self.assertIsNone(table.add_reply(DataPacket('addr', {}, 'b')))
+        self.assertEqual(2.25, table.rtt_stats.smoothed_rtt('addr'))
+
+        self.assertIsNone(table.add_reply(DataPacket('addr', {}, 'b')))
+        table.add_reply(DataPacket('addr', {}, 'c'))
+        self.assertEqual(2.25, table.rtt_stats.smoothed_rtt('addr'))
+        self.assertTrue(table.get_in_entry('a', 'addr'))
+
+    def test_max_entries(self):
+        '''It should drop the oldest entries when full'''
+
+        table = ReplyTable(max_entries=2)
+
+        for sequence_id in range(3):
+            table.add_out_entry(sequence_id, 'addr', None)
+
+        self.assertFalse(table.get_out_entry(0, 'addr'))
+        self.assertEqual(2, len(table))
+
+
+class TestRTTStats(unittest.TestCase):
+    def test_stats(self):
+        '''It should keep smoothed RTTs and percentiles per peer'''
+
+        stats = RTTStats(max_peers=2)
+
+        for rtt in range(1, 11):
+            stats.observe('a', rtt / 10)
+
+        self.assertAlmostEqual(1.0, stats.percentile('a', 0.95))
+        self.assertAlmostEqual(0.1, stats.percentile('a', 0))
+        self.assertTrue(0.1 < stats.smoothed_rtt('a') < 1)
+        self.assertIsNone(stats.smoothed_rtt('b'))
+
+        stats.observe('b', 1)
+        stats.observe('c', 1)
+
+        self.assertIsNone(stats.percentile('a', 0.5))
+        self.assertEqual(2, len(stats))
+
+
+class TestSequenceIDs(unittest.TestCase):
+    def test_sequence_ids(self):
+        '''It should make short IDs that differ per peer'''
+
+        event_reactor = EventReactor()
+        network = Network(event_reactor)
+
+        try:
+            ids_a = [network.new_sequence_id(('127.0.0.1', 1))
+                for dummy in range(100)]
+            ids_b = [network.new_sequence_id(('127.0.0.1', 2))
+                for dummy in range(100)]
+
+            self.assertEqual(200, len(set(ids_a + ids_b)))
+            self.assertEqual(8, len(ids_a[0]))
+        finally:
+            event_reactor.put(EventReactor.STOP_ID)
+            event_reactor.start()
+
+    def test_transfer_ids(self):
+        '''It should make transfer IDs that cannot be guessed from the
+        previous one'''
+
+        event_reactor = EventReactor()
+        network = Network(event_reactor)
+
+        try:
+            ids = [base64.b64decode(network.new_transfer_id())
+                for dummy in range(2)]
+            numbers = [int.from_bytes(id_bytes, 'big') for id_bytes in ids]
+
+            self.assertEqual(Network.TRANSFER_ID_SIZE, len(ids[0]))
+            self.assertNotIn(numbers[1] - numbers[0], (-1, 0, 1))
+        finally:
+            event_reactor.put(EventReactor.STOP_ID)
+            event_reactor.start()
@@ -3,54 +3,112 @@
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
 from bytestag.events import asynchronous
+from bytestag.keys import KeyBytes
+from bytestag.tables import KVPID
 import atexit
-import contextlib
+import collections
+import mmap
+import os
 import os.path
 import pickle
 import queue
-import sqlite3
+import struct
 import tempfile
 import threading
 
 __docformat__ = 'restructuredtext en'
 
 
+class PickleCodec(object):
+    '''Encodes any item that can be pickled.'''
+
+    @staticmethod
+    def encode(item):
+        return pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(data):
+        return pickle.loads(data)
+
+
+class KVPIDCodec(object):
+    '''Encodes a :class:`.KVPID` as its raw key and index bytes.'''
+
+    HASH_SIZE = KeyBytes.BIT_SIZE // 8
+
+    @staticmethod
+    def encode(kvpid):
+        return bytes(kvpid.key) + bytes(kvpid.index)
+
+    @staticmethod
+    def decode(data):
+        return KVPID(KeyBytes(data[:KVPIDCodec.HASH_SIZE]),
+            KeyBytes(data[KVPIDCodec.HASH_SIZE:]))
+
+
 class BigDiskQueue(object):
     '''A queue that spools onto disk when needed.
 
-    The core functionality is similar to :class:`queue.Queue`.
-    '''
+    The core functionality is similar to :class:`queue.Queue`. Items are
+    returned in strict FIFO order.
 
-    def __init__(self, memory_size=100):
-        self._queue = queue.Queue(memory_size)
-        self._event = threading.Event()
-        self._tables_created = False
-
-        self._loop()
+    Once the memory queue is full, items are buffered and appended in
+    batches to segment files. When items are removed, the memory queue is
+    refilled in batches by reading the segment files through :mod:`mmap`.
+    Segment files are deleted once they are read.
+    '''
 
-    @contextlib.contextmanager
-    def _connection(self):
-        con = sqlite3.connect(self._path, isolation_level='DEFERRED',
-            detect_types=sqlite3.PARSE_DECLTYPES)
-        con.row_factory = sqlite3.Row
-        con.execute('PRAGMA synchronous=OFF')
-        con.execute('PRAGMA journal_mode=WAL')
-        # con.execute('PRAGMA foreign_keys = ON')
+    SEGMENT_SIZE = 2 ** 24
+    _LENGTH = struct.Struct('!I')
 
-        with con:
-            yield con
+    def __init__(self, memory_size=100, codec=PickleCodec,
+    spill_batch_size=None, segment_size=SEGMENT_SIZE):
+        '''
+        :param memory_size: The number of items kept in memory.
+        :param codec: An object with ``encode`` and ``decode`` functions
+            that convert items to and from :obj:`bytes`.
+        :param spill_batch_size: The number of items buffered before they
+            are written to disk. The default is `memory_size`.
+        :param segment_size: The size at which a new segment file is
+            started.
+        '''
 
-    def _create_tables(self):
-        self._tables_created = True
+        self._memory_size = memory_size
+        self._queue = queue.Queue(memory_size)
+        self._codec = codec
+        self._spill_batch_size = spill_batch_size or memory_size
+        self._segment_size = segment_size
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._spill_buffer = collections.deque()
+        self._segment_ids = collections.deque()
+        self._next_segment_id = 0
+        self._write_file = None
+        self._read_mmap = None
+        self._read_offset = 0
+        self._disk_count = 0
+        self._temp_dir = None
+        self._loop_started = False
+
+    def _create_temp_dir(self):
         self._temp_dir = tempfile.TemporaryDirectory(suffix='-queue')
-        self._path = os.path.join(self._temp_dir.name, 'queue.db')
 
         # FIXME: tempdir isn't being cleaned, perhaps problem with threads
         atexit.register(self._temp_dir.cleanup)
 
-        with self._connection() as con:
-            con.execute('CREATE TABLE IF NOT EXISTS queue '
-                '(id INTEGER PRIMARY KEY, pickle BLOB NOT NULL)')
+    def _segment_path(self, segment_id):
+        return os.path.join(self._temp_dir.name,
+            '{:08d}.segment'.format(segment_id))
+
+    @property
+    def _is_spilled(self):
+        return self._disk_count or self._spill_buffer
+
+    def qsize(self):
+        '''Return the number of items in the queue.'''
+
+        return self._queue.qsize() + len(self._spill_buffer) \
+            + self._disk_count
 
     def put(self, item, block=None, timeout=None):
         '''Put an item on the queue.
@@ -59,13 +117,23 @@ class BigDiskQueue(object):
         compatibility with :class:`queue.Queue`.
         '''
 
-        try:
-            self._queue.put_nowait(item)
-        except queue.Full:
-            if not self._tables_created:
-                self._create_tables()
+        with self._lock:
+            if not self._is_spilled:
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    pass
+                else:
+                    return
 
-            self._put_database(item)
+            if not self._loop_started:
+                self._loop_started = True
+                self._loop()
+
+            self._spill_buffer.append(item)
+
+            if len(self._spill_buffer) >= self._spill_batch_size:
+                self._flush()
 
     def put_nowait(self, item):
         '''Put an item on the queue.'''
@@ -76,7 +144,7 @@ class BigDiskQueue(object):
 
         item = self._queue.get(block, timeout)
 
-        if self._tables_created:
+        if self._is_spilled:
             self._event.set()
 
         return item
@@ -86,33 +154,75 @@ class BigDiskQueue(object):
 
         return self.get(False)
 
-    def _put_database(self, item):
-        data = pickle.dumps(item)
+    def _flush(self):
+        if not self._temp_dir:
+            self._create_temp_dir()
+
+        if not self._write_file:
+            segment_id = self._next_segment_id
+            self._next_segment_id += 1
+            self._write_file = open(self._segment_path(segment_id), 'wb')
+            self._segment_ids.append(segment_id)
+
+        chunks = []
+
+        for item in self._spill_buffer:
+            data = self._codec.encode(item)
+            chunks.append(self._LENGTH.pack(len(data)))
+            chunks.append(data)
+
+        self._write_file.write(b''.join(chunks))
+        self._disk_count += len(self._spill_buffer)
+        self._spill_buffer.clear()
+
+        if self._write_file.tell() >= self._segment_size:
+            self._seal()
+
+    def _seal(self):
+        self._write_file.close()
+        self._write_file = None
+
+    def _read_disk_item(self):
+        if not self._read_mmap:
+            if self._write_file and len(self._segment_ids) == 1:
+                self._seal()
+
+            path = self._segment_path(self._segment_ids[0])
+
+            with open(path, 'rb') as f:
+                self._read_mmap = mmap.mmap(f.fileno(), 0,
+                    access=mmap.ACCESS_READ)
 
-        with self._connection() as con:
-            con.execute('INSERT INTO queue (pickle) VALUES (?)', (data,))
+            self._read_offset = 0
+
+        offset = self._read_offset + self._LENGTH.size
+        length, = self._LENGTH.unpack_from(self._read_mmap, self._read_offset)
+        data = self._read_mmap[offset:offset + length]
+        self._read_offset = offset + length
+        self._disk_count -= 1
+
+        if self._read_offset >= len(self._read_mmap):
+            self._read_mmap.close()
+            self._read_mmap = None
+            os.remove(self._segment_path(self._segment_ids.popleft()))
+
+        return self._codec.decode(data)
+
+    def _refill(self):
+        with self._lock:
+            free = self._memory_size - self._queue.qsize()
+
+            while free > 0 and self._disk_count:
+                self._queue.put_nowait(self._read_disk_item())
+                free -= 1
+
+            while free > 0 and self._spill_buffer:
+                self._queue.put_nowait(self._spill_buffer.popleft())
+                free -= 1
 
     @asynchronous(name='BigDiskQueue loop')
     def _loop(self):
         while True:
             self._event.wait()
             self._event.clear()
-            row_id = None
-
-            with self._connection() as con:
-                cur = con.execute('SELECT id, pickle FROM queue LIMIT 1')
-
-                for row in cur:
-                    item = pickle.loads(row['pickle'])
-                    row_id = row['id']
-
-            if not row_id:
-                continue
-
-            try:
-                self._queue.put_nowait(item)
-            except queue.Full:
-                continue
-            else:
-                with self._connection() as con:
-                    con.execute('DELETE FROM queue WHERE ID = ?', (row_id,))
+            self._refill()
@@ -1,4 +1,7 @@
-from bytestag.queue import BigDiskQueue
+from bytestag.keys import KeyBytes
+from bytestag.queue import BigDiskQueue, KVPIDCodec
+from bytestag.tables import KVPID
+import os
 import random
 import unittest
 
@@ -52,5 +55,42 @@ class TestBigDiskQueue(unittest.TestCase):
                     num_gets += 1
 
         self.assertEqual(n, len(l))
-        self.assertEqual(list(range(0, n)), list(sorted(l)))
+        self.assertEqual(list(range(0, n)), l)
+
+    def test_fifo(self):
+        '''It should return items in the order they were added'''
+
+        q = BigDiskQueue(memory_size=10, spill_batch_size=7)
+        n = 1000
+
+        for i in range(n):
+            q.put(i)
+
+        self.assertEqual(n, q.qsize())
+        self.assertEqual(list(range(n)), [q.get(timeout=1) for i in range(n)])
+        self.assertEqual(0, q.qsize())
+
+    def test_segments(self):
+        '''It should remove segment files after they are read'''
+
+        q = BigDiskQueue(memory_size=10, segment_size=100)
+        n = 500
+
+        for i in range(n):
+            q.put(i)
+
+        self.assertLess(1, len(os.listdir(q._temp_dir.name)))
+        self.assertEqual(list(range(n)), [q.get(timeout=1) for i in range(n)])
+        self.assertFalse(os.listdir(q._temp_dir.name))
+
+    def test_kvpid_codec(self):
+        '''It should store KVPIDs'''
+
+        q = BigDiskQueue(memory_size=2, codec=KVPIDCodec)
+        kvpids = [KVPID(KeyBytes(), KeyBytes()) for dummy in range(50)]
+
+        for kvpid in kvpids:
+            q.put(kvpid)
+
+        self.assertEqual(kvpids, [q.get(timeout=1) for kvpid in kvpids])
 
@@ -0,0 +1,721 @@
+'''In-process network simulation
+
+A :class:`Simulation` runs many :class:`.DHTNetwork` instances in one
+process. Datagrams travel through a :class:`DatagramFabric` instead of UDP
+sockets and all timers follow a :class:`VirtualClock`.
+
+The simulation drives time itself. After work is started, it dispatches
+the event reactor until the nodes are quiet and then jumps the clock to the
+next timer, such as the delivery of a datagram or a retransmission. Network
+latency therefore costs no real time.
+
+Record timestamps and routing table freshness still use the wall clock.
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.dht.network import DHTNetwork
+from bytestag.dht.tables import DeadNodeCache
+from bytestag.events import (EventReactor, TimerWheel,
+    WrappedThreadPoolExecutor, set_default_timer_wheel)
+from bytestag.keys import KeyBytes
+from bytestag.metrics import default_registry
+from bytestag.network import Network
+from bytestag.storage import MemoryKVPTable
+from bytestag.tables import KVPID
+import collections
+import logging
+import math
+import queue
+import random
+import threading
+import time
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+
+class VirtualClock(object):
+    '''A clock that only moves when it is set.'''
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+
+    def __call__(self):
+        return self._now
+
+    def set(self, now):
+        '''Move the clock forward. The clock never goes backwards.'''
+
+        self._now = max(self._now, now)
+
+
+class FabricEndpoint(object):
+    '''A datagram endpoint attached to a :class:`DatagramFabric`.
+
+    It has the interface of :class:`.UDPTransport`.
+    '''
+
+    def __init__(self, fabric, event_reactor, address, inbound_event_id):
+        self._fabric = fabric
+        self._event_reactor = event_reactor
+        self._address = address
+        self._inbound_event_id = inbound_event_id
+        self.link_free_time = 0
+
+    @property
+    def server_address(self):
+        return self._address
+
+    def send(self, address, data):
+        self._fabric._send(self, address, data)
+
+    def start(self):
+        pass
+
+    def _receive(self, source_address, data):
+        try:
+            self._event_reactor.put(self._inbound_event_id, source_address,
+                data)
+        except queue.Full:
+            return False
+
+        return True
+
+
+class DatagramFabric(object):
+    '''An in-memory datagram network.
+
+    Each datagram is delayed by the latency plus a random jitter and may
+    be lost. If a bandwidth is given, the uplink of each endpoint sends
+    one datagram at a time so large transfers queue up behind each other.
+    '''
+
+    DEFAULT_PORT = 7000
+
+    def __init__(self, timer_wheel, latency=0.05, jitter=0, loss=0,
+    bandwidth=None, seed=None):
+        '''
+        :param timer_wheel: The :class:`.TimerWheel` that delivers the
+            datagrams.
+        :param latency: The one way delay in seconds.
+        :param jitter: The maximum random delay added in seconds.
+        :param loss: The probability that a datagram is lost.
+        :param bandwidth: The uplink bytes per second of each endpoint or
+            ``None``.
+        '''
+
+        self._timer_wheel = timer_wheel
+        self._latency = latency
+        self._jitter = jitter
+        self._loss = loss
+        self._bandwidth = bandwidth
+        self._random = random.Random(seed)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._num_hosts = 0
+        self._counter = collections.Counter()
+
+    @property
+    def num_sent(self):
+        return self._counter['sent']
+
+    def stats(self):
+        '''Return the datagram counters.
+
+        The keys are ``sent``, ``bytes``, ``delivered``, ``lost``,
+        ``unreachable`` and ``overflow``.
+
+        :rtype: :obj:`dict`
+        '''
+
+        with self._lock:
+            return dict((name, self._counter[name]) for name in ('sent',
+                'bytes', 'delivered', 'lost', 'unreachable', 'overflow'))
+
+    def create_endpoint(self, event_reactor, address, inbound_event_id):
+        '''Attach a new endpoint.
+
+        This function can be given to :class:`.Network` as the transport.
+        If the port of the address is 0, a new address is assigned.
+
+        :rtype: :class:`FabricEndpoint`
+        '''
+
+        with self._lock:
+            if not address[1]:
+                self._num_hosts += 1
+                host_number = self._num_hosts
+                address = ('10.{}.{}.{}'.format(host_number >> 16 & 0xff,
+                    host_number >> 8 & 0xff, host_number & 0xff),
+                    DatagramFabric.DEFAULT_PORT)
+
+            if address in self._endpoints:
+                raise ValueError('Address {} in use'.format(address))
+
+            endpoint = FabricEndpoint(self, event_reactor, address,
+                inbound_event_id)
+            self._endpoints[address] = endpoint
+
+        return endpoint
+
+    def disconnect(self, address):
+        '''Detach an endpoint. Datagrams to it are dropped.'''
+
+        with self._lock:
+            self._endpoints.pop(address, None)
+
+    def _send(self, endpoint, address, data):
+        now = self._timer_wheel.clock()
+
+        with self._lock:
+            self._counter['sent'] += 1
+            self._counter['bytes'] += len(data)
+
+            if self._loss and self._random.random() < self._loss:
+                self._counter['lost'] += 1
+                return
+
+            send_time = now
+
+            if self._bandwidth:
+                send_time = max(now, endpoint.link_free_time) \
+                    + len(data) / self._bandwidth
+                endpoint.link_free_time = send_time
+
+            delivery_time = send_time + self._latency
+
+            if self._jitter:
+                delivery_time += self._random.random() * self._jitter
+
+        self._timer_wheel.add(delivery_time, self._deliver, address,
+            endpoint.server_address, data)
+
+    def _deliver(self, address, source_address, data):
+        endpoint = self._endpoints.get(address)
+
+        if not endpoint:
+            counter_name = 'unreachable'
+        elif endpoint._receive(source_address, data):
+            counter_name = 'delivered'
+        else:
+            counter_name = 'overflow'
+
+        with self._lock:
+            self._counter[counter_name] += 1
+
+
+class PhaseReport(object):
+    '''Results of a phase of a simulation.
+
+    :ivar name: The name of the phase.
+    :ivar latencies: The virtual seconds of each operation that finished.
+    :ivar hops: The lookup iterations of each lookup.
+    :ivar num_operations: The number of operations started.
+    :ivar num_succeeded: The number of operations that succeeded.
+    :ivar virtual_duration: The virtual seconds the phase took.
+    :ivar real_duration: The wall clock seconds the phase took.
+    :ivar messages: The :func:`DatagramFabric.stats` of the phase.
+    :ivar rpcs: The number of RPC requests sent by type.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.hops = []
+        self.num_operations = 0
+        self.num_succeeded = 0
+        self.virtual_duration = 0
+        self.real_duration = 0
+        self.messages = {}
+        self.rpcs = {}
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'operations': self.num_operations,
+            'succeeded': self.num_succeeded,
+            'latency': summarize(self.latencies),
+            'hops': summarize(self.hops),
+            'hop_distribution': dict(collections.Counter(self.hops)),
+            'virtual_duration': self.virtual_duration,
+            'real_duration': self.real_duration,
+            'messages': self.messages,
+            'rpcs': self.rpcs,
+        }
+
+    def format(self):
+        '''Return the report as text.'''
+
+        lines = ['{} ({} ok of {}, {:.1f}s virtual, {:.1f}s real)'.format(
+            self.name, self.num_succeeded, self.num_operations,
+            self.virtual_duration, self.real_duration)]
+
+        for label, values, unit in (('latency', self.latencies, 's'),
+        ('hops', self.hops, '')):
+            if not values:
+                continue
+
+            stats = summarize(values)
+            lines.append('  {:8} mean={mean:.3f}{unit} p50={p50:.3f}{unit} '
+                'p90={p90:.3f}{unit} p99={p99:.3f}{unit} max={max:.3f}{unit}'
+                .format(label, unit=unit, **stats))
+
+        if self.hops:
+            lines.append('  hop distribution ' + ' '.join('{}:{}'.format(
+                hops, count) for hops, count in sorted(
+                collections.Counter(self.hops).items())))
+
+        lines.append('  messages ' + ' '.join('{}={}'.format(name, count)
+            for name, count in sorted(self.messages.items())))
+
+        if self.num_operations:
+            lines.append('  messages per operation {:.1f}'.format(
+                self.messages.get('sent', 0) / self.num_operations))
+
+        lines.append('  rpcs ' + ' '.join('{}={}'.format(name, count)
+            for name, count in sorted(self.rpcs.items())))
+
+        return '\n'.join(lines)
+
+
+def percentile(sorted_values, fraction):
+    '''Return the value at a fraction of a sorted list.'''
+
+    if not sorted_values:
+        return 0
+
+    index = min(len(sorted_values) - 1,
+        int(math.ceil(fraction * len(sorted_values))) - 1)
+
+    return sorted_values[max(0, index)]
+
+
+def summarize(values):
+    '''Return the mean, percentiles and maximum of a list.
+
+    :rtype: :obj:`dict`
+    '''
+
+    sorted_values = sorted(values)
+
+    return {
+        'count': len(sorted_values),
+        'mean': sum(sorted_values) / len(sorted_values)
+            if sorted_values else 0,
+        'p50': percentile(sorted_values, 0.5),
+        'p90': percentile(sorted_values, 0.9),
+        'p99': percentile(sorted_values, 0.99),
+        'max': sorted_values[-1] if sorted_values else 0,
+    }
+
+
+def _key_int(key):
+    return int.from_bytes(key, 'big')
+
+
+class Simulation(object):
+    '''Runs many DHT nodes in one process over a :class:`DatagramFabric`.
+
+    While the simulation exists, the process-wide timer wheel is replaced
+    by a wheel following the virtual clock. Use the simulation as a
+    context manager or call :func:`close`.
+
+    Example usage::
+
+        >>> with Simulation(latency=0.05, seed=1) as simulation:
+        ...     simulation.add_nodes(1000)
+        ...     simulation.bootstrap()
+        ...     print(simulation.run_lookups(100).format())
+
+    '''
+
+    MAX_QUEUE_SIZE = 2 ** 20
+
+    def __init__(self, latency=0.05, jitter=0, loss=0, bandwidth=None,
+    seed=None, tick=0.001, pool_size=512, settle_time=0.001,
+    timeout=600):
+        '''
+        :param latency: See :class:`DatagramFabric`.
+        :param jitter: See :class:`DatagramFabric`.
+        :param loss: See :class:`DatagramFabric`.
+        :param bandwidth: See :class:`DatagramFabric`.
+        :param seed: The seed of the random generators.
+        :param tick: The resolution of the virtual clock in seconds.
+        :param pool_size: The maximum threads of each shared executor.
+        :param settle_time: The real seconds without activity after which
+            the nodes are considered quiet.
+        :param timeout: The real seconds after which unfinished operations
+            of a phase are stopped.
+        '''
+
+        self._random = random.Random(seed)
+        self._clock = VirtualClock()
+        self._timer_wheel = TimerWheel(tick=tick, clock=self._clock)
+        self._old_timer_wheel = set_default_timer_wheel(self._timer_wheel)
+        self._event_reactor = EventReactor(Simulation.MAX_QUEUE_SIZE)
+        self._fabric = DatagramFabric(self._timer_wheel, latency, jitter,
+            loss, bandwidth, seed)
+        self._network_pool = WrappedThreadPoolExecutor(pool_size,
+            self._event_reactor)
+        self._dht_pool = WrappedThreadPoolExecutor(pool_size,
+            self._event_reactor)
+        self._settle_time = settle_time
+        self._timeout = timeout
+        self._nodes = []
+        self._bootstrapped_nodes = []
+        self._published_kvpids = []
+        self._reports = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def clock(self):
+        '''The :class:`VirtualClock`.'''
+
+        return self._clock
+
+    @property
+    def fabric(self):
+        '''The :class:`DatagramFabric`.'''
+
+        return self._fabric
+
+    @property
+    def event_reactor(self):
+        return self._event_reactor
+
+    @property
+    def nodes(self):
+        '''The :class:`.DHTNetwork` instances.'''
+
+        return self._nodes
+
+    @property
+    def reports(self):
+        '''The :class:`PhaseReport` of each phase run.'''
+
+        return self._reports
+
+    def add_node(self, node_id=None):
+        '''Create a node with a :class:`.MemoryKVPTable`.
+
+        Each node has its own :class:`.DeadNodeCache` like nodes in
+        separate processes.
+
+        :rtype: :class:`.DHTNetwork`
+        '''
+
+        node_id = node_id or self._random_key()
+        network = Network(self._event_reactor,
+            transport=self._fabric.create_endpoint,
+            pool_executor=self._network_pool)
+        dht_network = DHTNetwork(self._event_reactor, MemoryKVPTable(),
+            node_id, network, pool_executor=self._dht_pool,
+            dead_node_cache=DeadNodeCache(clock=self._clock))
+
+        self._nodes.append(dht_network)
+
+        return dht_network
+
+    def add_nodes(self, count):
+        '''Create many nodes.
+
+        :rtype: :obj:`list`
+        '''
+
+        return [self.add_node() for dummy in range(count)]
+
+    def _random_key(self):
+        return KeyBytes(bytes(self._random.getrandbits(8)
+            for dummy in range(20)))
+
+    def _activity(self):
+        return (self._fabric.num_sent, len(self._timer_wheel),
+            self._event_reactor.queue_size)
+
+    def settle(self):
+        '''Dispatch events until the nodes are quiet.
+
+        The nodes are quiet when no event was dispatched, no datagram was
+        sent, and no timer was added for two periods of `settle_time`.
+        '''
+
+        quiet_count = 0
+
+        while quiet_count < 2:
+            activity = self._activity()
+            num_dispatched = self._event_reactor.dispatch_pending()
+
+            time.sleep(self._settle_time)
+
+            if num_dispatched or activity != self._activity():
+                quiet_count = 0
+            else:
+                quiet_count += 1
+
+    def step(self, deadline=None):
+        '''Jump the clock to the next timer and settle.
+
+        :param deadline: The virtual time not to go beyond.
+        :returns: ``False`` if there were no timers before the deadline.
+        '''
+
+        next_time = self._timer_wheel.next_expire_time()
+
+        if next_time is None or deadline is not None \
+        and next_time > deadline:
+            if deadline is not None:
+                self._clock.set(deadline)
+                self._timer_wheel.advance()
+                self.settle()
+
+            return False
+
+        self._clock.set(next_time)
+        self._timer_wheel.advance()
+        self.settle()
+
+        return True
+
+    def run(self, seconds):
+        '''Run the simulation for virtual seconds.'''
+
+        deadline = self._clock() + seconds
+
+        self.settle()
+
+        while self.step(deadline):
+            pass
+
+    def _run_operations(self, name, operations, parallelism):
+        '''Run operations concurrently.
+
+        :param operations: An iterable of functions. Each starts an
+            operation and returns a :class:`.Task` and a function that
+            accepts the task result and returns whether it succeeded and
+            the number of hops or ``None``.
+        :rtype: :class:`PhaseReport`
+        '''
+
+        report = PhaseReport(name)
+        operations = collections.deque(operations)
+        running = []
+        fabric_stats = self._fabric.stats()
+        rpc_counts = self._rpc_counts()
+        start_time = self._clock()
+        real_start_time = time.time()
+
+        while operations or running:
+            if time.time() - real_start_time > self._timeout:
+                _logger.warning('Phase %s timed out', name)
+
+                for task, result_fn, operation_start_time in running:
+                    task.stop()
+
+                break
+
+            while operations and len(running) < parallelism:
+                task, result_fn = operations.popleft()()
+                report.num_operations += 1
+                running.append((task, result_fn, self._clock()))
+
+            self.settle()
+
+            still_running = []
+
+            for task, result_fn, operation_start_time in running:
+                if not task.is_finished:
+                    still_running.append((task, result_fn,
+                        operation_start_time))
+                    continue
+
+                succeeded, hops = result_fn(task.result_)
+                report.latencies.append(self._clock() - operation_start_time)
+
+                if succeeded:
+                    report.num_succeeded += 1
+
+                if hops is not None:
+                    report.hops.append(hops)
+
+            running = still_running
+
+            if running and not operations \
+            or len(running) >= parallelism:
+                self.step()
+
+        report.virtual_duration = self._clock() - start_time
+        report.real_duration = time.time() - real_start_time
+        new_fabric_stats = self._fabric.stats()
+        report.messages = dict((key, new_fabric_stats[key] - value)
+            for key, value in fabric_stats.items())
+        new_rpc_counts = self._rpc_counts()
+        report.rpcs = dict((key, value - rpc_counts.get(key, 0))
+            for key, value in new_rpc_counts.items())
+
+        self._reports.append(report)
+
+        return report
+
+    def _rpc_counts(self):
+        return dict(default_registry().snapshot().get(
+            'bytestag_rpcs_sent_total', {}))
+
+    def bootstrap(self, parallelism=32):
+        '''Join the nodes that have not joined yet.
+
+        The first node is the seed. Each other node bootstraps through a
+        random node that already joined.
+
+        :rtype: :class:`PhaseReport`
+        '''
+
+        nodes = [node for node in self._nodes
+            if node not in self._bootstrapped_nodes]
+
+        if not self._bootstrapped_nodes and nodes:
+            self._bootstrapped_nodes.append(nodes.pop(0))
+
+        def make_operation(dht_network):
+            def operation():
+                address = self._random.choice(self._bootstrapped_nodes).address
+                task = dht_network.bootstrap([address])
+
+                def result_fn(result):
+                    if result:
+                        self._bootstrapped_nodes.append(dht_network)
+
+                    return result, None
+
+                return task, result_fn
+
+            return operation
+
+        return self._run_operations('bootstrap',
+            map(make_operation, nodes), parallelism)
+
+    def run_lookups(self, count, parallelism=16):
+        '''Look up random keys from random nodes.
+
+        A lookup succeeds if the closest node found is the closest node
+        in the whole simulation.
+
+        :rtype: :class:`PhaseReport`
+        '''
+
+        node_keys = [_key_int(node.key) for node in self._nodes]
+
+        def make_operation():
+            def operation():
+                dht_network = self._random.choice(self._nodes)
+                key = self._random_key()
+                key_int = _key_int(key)
+                own_key_int = _key_int(dht_network.key)
+                closest_key_int = min((node_key for node_key in node_keys
+                    if node_key != own_key_int),
+                    key=lambda node_key: node_key ^ key_int)
+                task = dht_network.find_node_shortlist(key)
+
+                def result_fn(shortlist):
+                    if not shortlist or not shortlist.nodes:
+                        return False, task.num_hops
+
+                    found_key_int = _key_int(shortlist.sorted_nodes[0].key)
+
+                    return found_key_int == closest_key_int, task.num_hops
+
+                return task, result_fn
+
+            return operation
+
+        return self._run_operations('lookups',
+            (make_operation() for dummy in range(count)), parallelism)
+
+    def publish(self, count, size=1024, parallelism=16):
+        '''Store random values from random nodes.
+
+        A store succeeds if at least one other node accepted the value.
+
+        :rtype: :class:`PhaseReport`
+        '''
+
+        def make_operation():
+            def operation():
+                dht_network = self._random.choice(self._nodes)
+                value = bytes(self._random.getrandbits(8)
+                    for dummy in range(size))
+                key = self._random_key()
+                index = KeyBytes.new_hash(value)
+                kvpid = KVPID(key, index)
+                kvp_table = dht_network._kvp_table
+                kvp_table[kvpid] = value
+                kvp_record = kvp_table.record(kvpid)
+                kvp_record.timestamp = self._clock()
+                kvp_record.time_to_live = DHTNetwork.TIME_EXPIRE
+                kvp_record.is_original = True
+                task = dht_network.store_value(key, index)
+
+                def result_fn(store_count):
+                    if store_count:
+                        self._published_kvpids.append(kvpid)
+
+                    return bool(store_count), None
+
+                return task, result_fn
+
+            return operation
+
+        return self._run_operations('publish',
+            (make_operation() for dummy in range(count)), parallelism)
+
+    def run_value_lookups(self, count, parallelism=16):
+        '''Look up published values from random nodes.
+
+        A lookup succeeds if a node having the value is found.
+
+        :rtype: :class:`PhaseReport`
+        '''
+
+        def make_operation():
+            def operation():
+                dht_network = self._random.choice(self._nodes)
+                kvpid = self._random.choice(self._published_kvpids)
+                task = dht_network.find_value_shortlist(kvpid.key,
+                    kvpid.index)
+
+                def result_fn(shortlist):
+                    return bool(shortlist and shortlist.useful_nodes), \
+                        task.num_hops
+
+                return task, result_fn
+
+            return operation
+
+        if not self._published_kvpids:
+            raise ValueError('No values published')
+
+        return self._run_operations('value lookups',
+            (make_operation() for dummy in range(count)), parallelism)
+
+    def format_report(self):
+        '''Return the reports of all phases as text.'''
+
+        return '\n'.join(report.format() for report in self._reports)
+
+    def close(self):
+        '''Stop the nodes and restore the process-wide timer wheel.'''
+
+        if self._closed:
+            return
+
+        self._closed = True
+
+        self._event_reactor.put(EventReactor.STOP_ID)
+        self._event_reactor.dispatch_pending()
+        set_default_timer_wheel(self._old_timer_wheel)
@@ -0,0 +1,98 @@
+from bytestag.events import default_timer_wheel
+from bytestag.simulation import Simulation, VirtualClock, percentile
+import unittest
+
+
+class TestSimulation(unittest.TestCase):
+    def test_lookups(self):
+        '''It should bootstrap nodes and find the closest nodes'''
+
+        with Simulation(latency=0.05, seed=1) as simulation:
+            simulation.add_nodes(16)
+
+            report = simulation.bootstrap()
+
+            self.assertEqual(15, report.num_operations)
+            self.assertEqual(15, report.num_succeeded)
+            self.assertTrue(report.messages['sent'])
+            self.assertGreaterEqual(report.virtual_duration, 0.1)
+
+            report = simulation.run_lookups(10)
+
+            self.assertEqual(10, report.num_succeeded)
+            self.assertTrue(all(hops >= 1 for hops in report.hops))
+            self.assertTrue(simulation.format_report())
+
+    def test_values(self):
+        '''It should publish values and find them'''
+
+        with Simulation(latency=0.01, seed=2) as simulation:
+            simulation.add_nodes(12)
+            simulation.bootstrap()
+
+            report = simulation.publish(3, size=100)
+
+            self.assertEqual(3, report.num_succeeded)
+
+            report = simulation.run_value_lookups(3)
+
+            self.assertEqual(3, report.num_succeeded)
+
+    def test_loss(self):
+        '''It should drop all datagrams'''
+
+        with Simulation(loss=1.0, seed=3, timeout=60) as simulation:
+            simulation.add_nodes(3)
+
+            report = simulation.bootstrap()
+
+            self.assertEqual(0, report.num_succeeded)
+            self.assertEqual(report.messages['sent'], report.messages['lost'])
+
+    def test_restore_timer_wheel(self):
+        '''It should restore the process-wide timer wheel'''
+
+        timer_wheel = default_timer_wheel()
+
+        with Simulation() as simulation:
+            self.assertIsNot(timer_wheel, default_timer_wheel())
+            self.assertIs(simulation.clock,
+                default_timer_wheel().clock)
+
+        self.assertIs(timer_wheel, default_timer_wheel())
+
+
+    def test_dead_node_caches(self):
+        '''It should give each node its own dead node cache'''
+
+        with Simulation(seed=4) as simulation:
+            node_1, node_2, node_3 = simulation.add_nodes(3)
+
+            node_1.dead_node_cache.mark_failed(node_3.node)
+
+            self.assertIsNot(node_1.dead_node_cache, node_2.dead_node_cache)
+            self.assertTrue(node_1.dead_node_cache.is_suspect(node_3.node))
+            self.assertFalse(node_2.dead_node_cache.is_suspect(node_3.node))
+
+
+class TestVirtualClock(unittest.TestCase):
+    def test_forward(self):
+        '''It should never go backwards'''
+
+        clock = VirtualClock(100)
+        clock.set(105)
+        clock.set(101)
+
+        self.assertEqual(105, clock())
+
+
+class TestPercentile(unittest.TestCase):
+    def test_percentile(self):
+        '''It should return the nearest rank'''
+
+        values = list(range(1, 11))
+
+        self.assertEqual(5, percentile(values, 0.5))
+        self.assertEqual(9, percentile(values, 0.9))
+        self.assertEqual(10, percentile(values, 1))
+        self.assertEqual(0, percentile([], 0.5))
@@ -2,10 +2,13 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-from bytestag.dht.models import FileInfo, CollectionInfo, BitTorrentInfoFile
+from bytestag.dht.hashtree import HashTreeBuilder
+from bytestag.dht.models import (FileInfo, CollectionInfo, BitTorrentInfoFile,
+    file_info_from_bytes)
 from bytestag.events import Task
 from bytestag.keys import KeyBytes
-from bytestag.tables import KVPTable, KVPRecord, KVPID
+from bytestag.metrics import default_registry
+from bytestag.tables import KVPTable, KVPRecord, KVPID, KVPSummary
 import collections
 import contextlib
 import fnmatch
@@ -13,12 +16,20 @@ import hashlib
 import itertools
 import logging
 import math
+import mmap
 import os
+import re
 import sqlite3
+import struct
 import threading
+import time
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
+_transaction_duration = default_registry().histogram(
+    'bytestag_sqlite_transaction_seconds',
+    'Duration of SQLite connections and their queries', ('table',))
+_open_database_lock = threading.RLock()
 
 
 def part_to_byte_number(part_number, part_size):
@@ -148,12 +159,21 @@ class MemoryKVPRecord(KVPRecord):
 
 
 class SQLite3Mixin(object):
-    '''A SQLite 3 mixin class to provide connection management'''
+    '''A SQLite 3 mixin class to provide connection management
+
+    The database is not opened until the first connection. Classes that
+    need tables implement ``_create_tables`` which is called then.
+    '''
+
+    _database_state = None
 
     @contextlib.contextmanager
     def connection(self):
         '''Return a connection context manager'''
 
+        if self._database_state != 'open':
+            self._open_database_once()
+
         if not hasattr(self, '_num_connections'):
             self._num_connections = 0
 
@@ -161,6 +181,7 @@ class SQLite3Mixin(object):
 #            _logger.warning('There are %d connections already',
 #                self._num_connections)
 
+        start_time = time.monotonic()
         con = sqlite3.connect(self._path, isolation_level='DEFERRED',
             detect_types=sqlite3.PARSE_DECLTYPES)
         con.row_factory = sqlite3.Row
@@ -176,9 +197,35 @@ class SQLite3Mixin(object):
                 yield con
         finally:
             self._num_connections -= 1
+            _transaction_duration.labels(type(self).__name__).observe(
+                time.monotonic() - start_time)
 
             _logger.debug('End transaction current=%d', self._num_connections)
 
+    def _open_database_once(self):
+        with _open_database_lock:
+            # While opening, this thread's own connections pass through.
+            if self._database_state:
+                return
+
+            self._database_state = 'opening'
+
+            try:
+                self._open_database()
+            except Exception:
+                self._database_state = None
+                raise
+
+            self._database_state = 'open'
+
+    def _open_database(self):
+        '''Prepare the database before it is first used.'''
+
+        self._create_tables()
+
+    def _create_tables(self):
+        pass
+
     @property
     def database_size(self):
         '''The size of the database.
@@ -225,19 +272,92 @@ class SQLite3Mixin(object):
             offset += limit
 
 
+class EvictionPolicy(object):
+    '''Chooses which key-value pairs are evicted when a table is full.
+
+    :cvar ORDER_BY: A SQL ``ORDER BY`` expression that sorts the rows of
+        the key-value table with the first to be evicted first.
+    '''
+
+    ORDER_BY = None
+
+    def prepare_connection(self, con):
+        '''Register any SQL functions used by :attr:`ORDER_BY`.'''
+
+        pass
+
+
+class LRUEvictionPolicy(EvictionPolicy):
+    '''Evict the least recently used key-value pairs first.'''
+
+    ORDER_BY = 'last_access ASC, last_update ASC'
+
+
+class ExpiryEvictionPolicy(EvictionPolicy):
+    '''Evict the key-value pairs that expire the soonest first.'''
+
+    ORDER_BY = 'timestamp + time_to_live ASC'
+
+
+class DistanceEvictionPolicy(EvictionPolicy):
+    '''Evict the keys farthest from the node ID first.
+
+    Nodes closest to a key are the ones expected to store it so keys far
+    away from the node are the least useful to keep.
+    '''
+
+    ORDER_BY = 'bytestag_distance(key_id) DESC'
+
+    def __init__(self, node_id):
+        self._node_id = node_id.integer
+
+    def _distance(self, key_id):
+        return (int.from_bytes(key_id, 'big') ^ self._node_id).to_bytes(
+            KeyBytes.BIT_SIZE // 8, 'big')
+
+    def prepare_connection(self, con):
+        con.create_function('bytestag_distance', 1, self._distance)
+
+
 class DatabaseKVPTable(KVPTable, SQLite3Mixin):
-    '''A KVPTable stored as a SQLite database'''
+    '''A KVPTable stored as a SQLite database
+
+    The total size of the values is tracked in memory. Stores are accepted
+    when the table is full and key-value pairs are evicted in batches by a
+    background thread according to the :class:`EvictionPolicy`.
+    '''
+
+    EVICT_BATCH_SIZE = 100
+    EVICT_RATIO = 0.9
+    ACCESS_FLUSH_SIZE = 1000
+    DEFAULT_TABLE_NAME = 'kvps'
+    _SIZE_COLUMN = 'LENGTH(value)'
 
-    def __init__(self, path, max_size=2 ** 36):
+    def __init__(self, path, max_size=2 ** 36, eviction_policy=None,
+    table_name=DEFAULT_TABLE_NAME):
         '''
         :param path: A filename to the database.
-        :param max_size: The maximum database size that the table will grow.
+        :param max_size: The maximum size of the values that the table
+            will hold.
+        :param eviction_policy: An :class:`EvictionPolicy`. If ``None``,
+            :class:`LRUEvictionPolicy` is used.
+        :param table_name: The name of the SQL table. Tables of different
+            names partition one database file.
         '''
 
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', table_name):
+            raise ValueError('Invalid table name {}'.format(table_name))
+
         KVPTable.__init__(self)
         self._max_size = max_size
         self._path = path
-        self._create_tables()
+        self._table_name = table_name
+        self._eviction_policy = eviction_policy or LRUEvictionPolicy()
+        self._size_lock = threading.Lock()
+        self._accesses = {}
+        self._evictor_event = threading.Event()
+        self._evictor_thread = None
+        self._used_size = None
 
     @property
     def max_size(self):
@@ -247,67 +367,202 @@ class DatabaseKVPTable(KVPTable, SQLite3Mixin):
     @max_size.setter
     def max_size(self, s):
         self._max_size = s
+        self._check_size()
+
+    @property
+    def used_size(self):
+        '''The total size of the values.
+
+        :rtype: :obj:`int`
+        '''
+
+        if self._used_size is None:
+            self._open_database_once()
+
+        return self._used_size
+
+    @property
+    def table_name(self):
+        '''The name of the SQL table.'''
+
+        return self._table_name
+
+    @property
+    def eviction_policy(self):
+        '''The :class:`EvictionPolicy`'''
+
+        return self._eviction_policy
+
+    @eviction_policy.setter
+    def eviction_policy(self, policy):
+        self._eviction_policy = policy
+
+    def _open_database(self):
+        self._create_tables()
+
+        # Count before any value is stored so no store is counted twice.
+        self._used_size = self._query_used_size()
 
     def _create_tables(self):
         with self.connection() as con:
-            con.execute('CREATE TABLE IF NOT EXISTS kvps ('
+            con.execute('CREATE TABLE IF NOT EXISTS {} ('
                 'key_id BLOB NOT NULL, index_id BLOB NOT NULL,'
                 'timestamp INTEGER,'
                 'time_to_live INTEGER,'
                 'is_original INTEGER,'
                 'value BLOB,'
                 'last_update INTEGER DEFAULT 0,'
-                'PRIMARY KEY (key_id, index_id))')
+                'last_access INTEGER DEFAULT 0,'
+                'PRIMARY KEY (key_id, index_id))'.format(self._table_name))
+            self._add_missing_column(con, 'last_access', 'INTEGER DEFAULT 0')
+
+    def _add_missing_column(self, con, name, definition):
+        cur = con.execute('PRAGMA table_info({})'.format(self._table_name))
+
+        if name not in (row['name'] for row in cur):
+            con.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                self._table_name, name, definition))
+
+    def _query_used_size(self):
+        with self.connection() as con:
+            cur = con.execute('SELECT SUM({}) FROM {}'.format(
+                self._SIZE_COLUMN, self._table_name))
+
+            return cur.fetchone()[0] or 0
+
+    def _stored_size(self, con, kvpid):
+        cur = con.execute('SELECT {} FROM {} '
+            'WHERE key_id = ? AND index_id = ? LIMIT 1'.format(
+                self._SIZE_COLUMN, self._table_name),
+            (kvpid.key, kvpid.index))
+
+        row = cur.fetchone()
+
+        return row[0] if row else 0
+
+    def _add_used_size(self, size):
+        with self._size_lock:
+            self._used_size += size
+
+        if size > 0:
+            self._check_size()
+
+    def _record_access(self, kvpid):
+        self._accesses[kvpid] = int(time.time())
+
+        if len(self._accesses) >= self.ACCESS_FLUSH_SIZE:
+            self._wake_evictor()
 
     def _getitem(self, kvpid):
         with self.connection() as con:
-            cur = con.execute('SELECT value FROM kvps '
+            cur = con.execute('SELECT value FROM {} '
                 'WHERE key_id = ? AND index_id = ? '
-                'LIMIT 1', (kvpid.key, kvpid.index))
+                'LIMIT 1'.format(self._table_name), (kvpid.key, kvpid.index))
 
         for row in cur:
+            self._record_access(kvpid)
+
             return row['value']
 
     def _contains(self, kvpid):
         with self.connection() as con:
-            cur = con.execute('SELECT 1 FROM kvps '
-                'WHERE key_id = ? AND index_id = ? LIMIT 1',
-                (kvpid.key, kvpid.index))
+            cur = con.execute('SELECT 1 FROM {} '
+                'WHERE key_id = ? AND index_id = ? LIMIT 1'.format(
+                    self._table_name), (kvpid.key, kvpid.index))
 
             return True if cur.fetchone() else False
 
     def _setitem(self, kvpid, value):
         with self.connection() as con:
-            params = (value, kvpid.key, kvpid.index)
+            old_size = self._stored_size(con, kvpid)
+            params = (value, int(time.time()), kvpid.key, kvpid.index)
 
             try:
-                con.execute('INSERT INTO kvps '
-                    '(value, key_id, index_id) VALUES (?, ?, ?)', params)
+                con.execute('INSERT INTO {} '
+                    '(value, last_access, key_id, index_id) '
+                    'VALUES (?, ?, ?, ?)'.format(self._table_name), params)
             except sqlite3.IntegrityError:
-                con.execute('UPDATE kvps SET value = ? '
-                    'WHERE key_id = ? AND index_id = ?', params)
+                con.execute('UPDATE {} SET value = ?, last_access = ? '
+                    'WHERE key_id = ? AND index_id = ?'.format(
+                        self._table_name), params)
+
+        self._add_used_size(len(value) - old_size)
 
     def keys(self):
-        query = 'SELECT key_id, index_id FROM kvps LIMIT {} OFFSET {}'
+        query = 'SELECT key_id, index_id FROM ' + self._table_name \
+            + ' LIMIT {} OFFSET {}'
 
         for row in self.iter_query(query):
             yield KVPID(KeyBytes(row['key_id']), KeyBytes(row['index_id']))
 
     def indices(self, key):
-        for row in self.iter_query('SELECT index_id FROM kvps WHERE '
-        'key_id = ? LIMIT {} OFFSET {}', (key,)):
+        for row in self.iter_query('SELECT index_id FROM '
+        + self._table_name + ' WHERE key_id = ? LIMIT {} OFFSET {}',
+        (key,)):
             yield KeyBytes(row['index_id'])
 
+    def count_indices(self, key):
+        with self.connection() as con:
+            cur = con.execute('SELECT COUNT(*) FROM {} '
+                'WHERE key_id = ?'.format(self._table_name), (key,))
+
+            return cur.fetchone()[0]
+
+    def index_range(self, key, after_index=None, limit=None, min_size=None,
+    max_size=None, newest=False):
+        conditions = ['key_id = ?']
+        params = [key]
+
+        if after_index is not None:
+            conditions.append('index_id > ?')
+            params.append(after_index)
+
+        if min_size is not None:
+            conditions.append('{} >= ?'.format(self._SIZE_COLUMN))
+            params.append(min_size)
+
+        if max_size is not None:
+            conditions.append('{} <= ?'.format(self._SIZE_COLUMN))
+            params.append(max_size)
+
+        if newest:
+            order_by = 'timestamp IS NULL, timestamp DESC, index_id'
+        else:
+            order_by = 'index_id'
+
+        params.append(-1 if limit is None else limit)
+
+        # One query for the whole page instead of one for each field of
+        # each record.
+        with self.connection() as con:
+            cur = con.execute('SELECT index_id, {} AS size, timestamp '
+                'FROM {} WHERE {} ORDER BY {} LIMIT ?'.format(
+                    self._SIZE_COLUMN, self._table_name,
+                    ' AND '.join(conditions), order_by), params)
+
+            return [KVPSummary(key, KeyBytes(row['index_id']), row['size'],
+                row['timestamp']) for row in cur]
+
     def _delitem(self, kvpid):
         with self.connection() as con:
-            con.execute('DELETE FROM kvps WHERE '
-                'key_id = ? AND index_id = ?', (kvpid.key, kvpid.index))
+            old_size = self._stored_size(con, kvpid)
+            con.execute('DELETE FROM {} WHERE '
+                'key_id = ? AND index_id = ?'.format(self._table_name),
+                (kvpid.key, kvpid.index))
+
+        self._add_used_size(-old_size)
 
     def is_acceptable(self, kvpid, size, timestamp):
-        if kvpid in self and self.record(kvpid).timestamp == timestamp:
+        if size > self._max_size:
             return False
 
-        if self.database_size + size > self._max_size:
+        with self.connection() as con:
+            cur = con.execute('SELECT timestamp FROM {} '
+                'WHERE key_id = ? AND index_id = ? LIMIT 1'.format(
+                    self._table_name), (kvpid.key, kvpid.index))
+            row = cur.fetchone()
+
+        if row and row['timestamp'] == timestamp:
             return False
 
         return True
@@ -321,8 +576,120 @@ class DatabaseKVPTable(KVPTable, SQLite3Mixin):
         _logger.debug('Clean database')
 
         with self.connection() as con:
-            con.execute('''DELETE FROM kvps WHERE '''
-                '''timestamp + time_to_live < strftime('%s', 'now')''')
+            cur = con.execute('''SELECT key_id, index_id FROM {} WHERE '''
+                '''timestamp + time_to_live < strftime('%s', 'now')'''
+                .format(self._table_name))
+            rows = cur.fetchall()
+
+            con.executemany('DELETE FROM {} '
+                'WHERE key_id = ? AND index_id = ?'.format(self._table_name),
+                [(row['key_id'], row['index_id']) for row in rows])
+
+        self.refresh_used_size()
+
+        for row in rows:
+            self._value_changed_observer(KVPID(KeyBytes(row['key_id']),
+                KeyBytes(row['index_id'])))
+
+    def refresh_used_size(self):
+        '''Count the size of the values again.
+
+        Call this when other processes write to the same table.
+        '''
+
+        with self._size_lock:
+            self._used_size = self._query_used_size()
+
+        self._check_size()
+
+    def _check_size(self):
+        if self.used_size > self._max_size:
+            self._wake_evictor()
+
+    def _wake_evictor(self):
+        if not self._evictor_thread:
+            self._evictor_thread = threading.Thread(target=self._evictor_loop)
+            self._evictor_thread.daemon = True
+            self._evictor_thread.name = 'DatabaseKVPTable evictor'
+            self._evictor_thread.start()
+
+        self._evictor_event.set()
+
+    def _evictor_loop(self):
+        while True:
+            self._evictor_event.wait()
+            self._evictor_event.clear()
+
+            try:
+                self.evict()
+            except Exception:
+                _logger.exception('Eviction failed')
+
+    def _flush_accesses(self):
+        accesses = self._accesses
+        self._accesses = {}
+
+        if not accesses:
+            return
+
+        with self.connection() as con:
+            con.executemany('UPDATE {} SET last_access = ? '
+                'WHERE key_id = ? AND index_id = ?'.format(self._table_name),
+                [(timestamp, kvpid.key, kvpid.index)
+                    for kvpid, timestamp in accesses.items()])
+
+    def evict(self):
+        '''Evict key-value pairs until the table is below its limit.
+
+        Key-value pairs originally published by this client are not
+        evicted. Usually, this function is called by the background thread.
+
+        :returns: The number of key-value pairs evicted.
+        '''
+
+        self._flush_accesses()
+
+        target_size = self._max_size * self.EVICT_RATIO
+        count = 0
+
+        while self.used_size > target_size:
+            with self.connection() as con:
+                self._eviction_policy.prepare_connection(con)
+
+                cur = con.execute('SELECT key_id, index_id, {} AS size '
+                    'FROM {} WHERE NOT COALESCE(is_original, 0) '
+                    'ORDER BY {} LIMIT ?'.format(self._SIZE_COLUMN,
+                        self._table_name, self._eviction_policy.ORDER_BY),
+                    (self.EVICT_BATCH_SIZE,))
+                rows = []
+                evicted_size = 0
+
+                for row in cur.fetchall():
+                    if self._used_size - evicted_size <= target_size:
+                        break
+
+                    rows.append(row)
+                    evicted_size += row['size'] or 0
+
+                con.executemany('DELETE FROM {} '
+                    'WHERE key_id = ? AND index_id = ?'.format(
+                        self._table_name),
+                    [(row['key_id'], row['index_id']) for row in rows])
+
+            if not rows:
+                break
+
+            self._add_used_size(-evicted_size)
+
+            count += len(rows)
+
+            for row in rows:
+                self._value_changed_observer(KVPID(KeyBytes(row['key_id']),
+                    KeyBytes(row['index_id'])))
+
+        _logger.debug('Evicted count=%s used_size=%s', count, self._used_size)
+
+        return count
 
 
 class DatabaseKVPRecord(KVPRecord):
@@ -336,8 +703,9 @@ class DatabaseKVPRecord(KVPRecord):
 
     def _get_field(self, name):
         with self._table.connection() as con:
-            cur = con.execute('SELECT {} FROM kvps '
-                'WHERE key_id = ? AND index_id = ?'.format(name),
+            cur = con.execute('SELECT {} FROM {} '
+                'WHERE key_id = ? AND index_id = ?'.format(name,
+                    self._table.table_name),
                 (self._kvpid.key, self._kvpid.index))
 
         for row in cur:
@@ -345,8 +713,9 @@ class DatabaseKVPRecord(KVPRecord):
 
     def _save_field(self, name, value):
         with self._table.connection() as con:
-            con.execute('UPDATE kvps SET {} = ? '
-                'WHERE key_id = ? AND index_id = ?'.format(name),
+            con.execute('UPDATE {} SET {} = ? '
+                'WHERE key_id = ? AND index_id = ?'.format(
+                    self._table.table_name, name),
                 (value, self._kvpid.key, self._kvpid.index))
 
     @property
@@ -398,6 +767,312 @@ class DatabaseKVPRecord(KVPRecord):
         self._save_field('last_update', seconds)
 
 
+class LogStructuredKVPTable(DatabaseKVPTable):
+    '''A KVPTable with values stored in append-only segment files.
+
+    The SQLite database holds only the metadata and the location of each
+    value within a segment file. Values are appended to the active segment
+    and are read through :mod:`mmap`. Space left by deleted or replaced
+    values is reclaimed by :func:`compact` which copies the live values of
+    mostly dead segments into the active segment.
+
+    This class is a drop-in replacement for :class:`DatabaseKVPTable`.
+    '''
+
+    SEGMENT_SIZE = 2 ** 26
+    COMPACT_RATIO = 0.5
+    COMPACT_INTERVAL = 600
+    SEGMENT_EXTENSION = '.segment'
+    _HEADER = struct.Struct('!20s20sI')
+    _SIZE_COLUMN = 'length'
+
+    def __init__(self, path, max_size=2 ** 36, segment_size=SEGMENT_SIZE,
+    compact_interval=COMPACT_INTERVAL, eviction_policy=None,
+    table_name=DatabaseKVPTable.DEFAULT_TABLE_NAME):
+        '''
+        :param path: A filename to the database. The segment files are
+            stored in a directory next to it. Each table has its own
+            directory.
+        :param max_size: The maximum size of the values that the table
+            will hold.
+        :param segment_size: The size at which a new segment is started.
+        :param compact_interval: The time in seconds between background
+            compactions. If ``None``, the background compactor is not
+            started. Otherwise, it is started when the table is first
+            used.
+        :param eviction_policy: An :class:`EvictionPolicy`.
+        :param table_name: See :class:`DatabaseKVPTable`.
+        '''
+
+        if table_name == DatabaseKVPTable.DEFAULT_TABLE_NAME:
+            self._segment_dir = path + '.segments'
+        else:
+            self._segment_dir = '{}.{}.segments'.format(path, table_name)
+
+        self._segment_size = segment_size
+        self._lock = threading.RLock()
+        self._mmaps = {}
+
+        os.makedirs(self._segment_dir, exist_ok=True)
+
+        self._segment_id = max(self._segment_ids(), default=0) + 1
+        self._segment_file = open(self._segment_path(self._segment_id), 'ab')
+
+        self._compact_interval = compact_interval
+
+        DatabaseKVPTable.__init__(self, path, max_size, eviction_policy,
+            table_name)
+
+    def _open_database(self):
+        DatabaseKVPTable._open_database(self)
+
+        if self._compact_interval:
+            self._start_compactor(self._compact_interval)
+
+    def _create_tables(self):
+        with self.connection() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS {} ('
+                'key_id BLOB NOT NULL, index_id BLOB NOT NULL,'
+                'timestamp INTEGER,'
+                'time_to_live INTEGER,'
+                'is_original INTEGER,'
+                'segment_id INTEGER NOT NULL,'
+                'offset INTEGER NOT NULL,'
+                'length INTEGER NOT NULL,'
+                'last_update INTEGER DEFAULT 0,'
+                'last_access INTEGER DEFAULT 0,'
+                'PRIMARY KEY (key_id, index_id))'.format(self._table_name))
+
+            if self._table_name == DatabaseKVPTable.DEFAULT_TABLE_NAME:
+                index_name = 'segment_id'
+            else:
+                index_name = self._table_name + '_segment_id'
+
+            con.execute('CREATE INDEX IF NOT EXISTS {} '
+                'ON {} (segment_id)'.format(index_name, self._table_name))
+
+    def _start_compactor(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    self.compact()
+                except Exception:
+                    _logger.exception('Compaction failed')
+
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.name = 'LogStructuredKVPTable compactor'
+        thread.start()
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self._segment_dir,
+            '{:08d}{}'.format(segment_id, self.SEGMENT_EXTENSION))
+
+    def _segment_ids(self):
+        for filename in os.listdir(self._segment_dir):
+            name, ext = os.path.splitext(filename)
+
+            if ext == self.SEGMENT_EXTENSION and name.isdigit():
+                yield int(name)
+
+    def _append(self, kvpid, value):
+        '''Append the value to the active segment.
+
+        :rtype: :obj:`tuple`
+        :returns: The segment ID and offset of the value.
+        '''
+
+        with self._lock:
+            if self._segment_file.tell() >= self._segment_size:
+                self._segment_file.close()
+                self._segment_id += 1
+                self._segment_file = open(
+                    self._segment_path(self._segment_id), 'ab')
+
+            self._segment_file.write(
+                self._HEADER.pack(kvpid.key, kvpid.index, len(value)))
+            offset = self._segment_file.tell()
+            self._segment_file.write(value)
+            self._segment_file.flush()
+
+            return self._segment_id, offset
+
+    def _read(self, segment_id, offset, length):
+        with self._lock:
+            mmap_ = self._mmaps.get(segment_id)
+
+            if not mmap_ or len(mmap_) < offset + length:
+                if mmap_:
+                    mmap_.close()
+
+                with open(self._segment_path(segment_id), 'rb') as f:
+                    mmap_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+                self._mmaps[segment_id] = mmap_
+
+            return mmap_[offset:offset + length]
+
+    def _location(self, con, kvpid):
+        cur = con.execute('SELECT segment_id, offset, length FROM {} '
+            'WHERE key_id = ? AND index_id = ? LIMIT 1'.format(
+                self._table_name), (kvpid.key, kvpid.index))
+
+        return cur.fetchone()
+
+    def _getitem(self, kvpid):
+        with self._lock:
+            with self.connection() as con:
+                row = self._location(con, kvpid)
+
+            if row:
+                self._record_access(kvpid)
+
+                return self._read(*row)
+
+    def _setitem(self, kvpid, value):
+        with self._lock:
+            segment_id, offset = self._append(kvpid, value)
+
+            with self.connection() as con:
+                old_size = self._stored_size(con, kvpid)
+                params = (segment_id, offset, len(value), int(time.time()),
+                    kvpid.key, kvpid.index)
+
+                try:
+                    con.execute('INSERT INTO {} '
+                        '(segment_id, offset, length, last_access, '
+                        'key_id, index_id) '
+                        'VALUES (?, ?, ?, ?, ?, ?)'.format(self._table_name),
+                        params)
+                except sqlite3.IntegrityError:
+                    con.execute('UPDATE {} SET segment_id = ?, '
+                        'offset = ?, length = ?, last_access = ? '
+                        'WHERE key_id = ? AND index_id = ?'.format(
+                            self._table_name), params)
+
+        self._add_used_size(len(value) - old_size)
+
+    def record(self, kvpid):
+        return LogStructuredKVPRecord(self, kvpid)
+
+    @property
+    def database_size(self):
+        '''The size of the database including the segment files.
+
+        :rtype: :obj:`int`
+        '''
+
+        size = DatabaseKVPTable.database_size.fget(self)
+
+        for segment_id in self._segment_ids():
+            size += os.path.getsize(self._segment_path(segment_id))
+
+        return size
+
+    def segment_usage(self):
+        '''Return the file size and live size of each segment.
+
+        :rtype: :obj:`dict`
+        :returns: A mapping of segment ID to a tuple of the file size and
+            bytes used by live values.
+        '''
+
+        usage = {}
+
+        for segment_id in self._segment_ids():
+            usage[segment_id] = (
+                os.path.getsize(self._segment_path(segment_id)), 0)
+
+        with self.connection() as con:
+            cur = con.execute('SELECT segment_id, '
+                'SUM(length) + COUNT(1) * ? FROM {} GROUP BY segment_id'
+                .format(self._table_name), (self._HEADER.size,))
+
+            for segment_id, live_size in cur:
+                if segment_id in usage:
+                    usage[segment_id] = (usage[segment_id][0], live_size)
+
+        return usage
+
+    def compact(self, ratio=COMPACT_RATIO):
+        '''Reclaim the space of deleted values.
+
+        Segments, other than the active segment, where the live values
+        occupy less than the given ratio are rewritten and removed.
+
+        :returns: The number of bytes reclaimed.
+        '''
+
+        reclaimed = 0
+
+        for segment_id, (size, live_size) in sorted(
+        self.segment_usage().items()):
+            if segment_id == self._segment_id:
+                continue
+
+            if size and live_size / size >= ratio:
+                continue
+
+            _logger.debug('Compact segment %s size=%s live=%s', segment_id,
+                size, live_size)
+
+            self._compact_segment(segment_id)
+
+            reclaimed += size - live_size
+
+        return reclaimed
+
+    def _compact_segment(self, segment_id):
+        query = ('SELECT key_id, index_id, offset, length FROM '
+            + self._table_name + ' WHERE segment_id = ? LIMIT {} OFFSET {}')
+
+        for row in list(self.iter_query(query, (segment_id,))):
+            with self._lock:
+                value = self._read(segment_id, row['offset'], row['length'])
+                kvpid = KVPID(KeyBytes(row['key_id']),
+                    KeyBytes(row['index_id']))
+                new_segment_id, new_offset = self._append(kvpid, value)
+
+                with self.connection() as con:
+                    con.execute('UPDATE {} SET segment_id = ?, offset = ? '
+                        'WHERE key_id = ? AND index_id = ? '
+                        'AND segment_id = ? AND offset = ?'.format(
+                            self._table_name),
+                        (new_segment_id, new_offset, kvpid.key, kvpid.index,
+                        segment_id, row['offset']))
+
+        with self._lock:
+            mmap_ = self._mmaps.pop(segment_id, None)
+
+            if mmap_:
+                mmap_.close()
+
+            os.remove(self._segment_path(segment_id))
+
+    def close(self):
+        '''Close the segment files.'''
+
+        with self._lock:
+            self._segment_file.close()
+
+            for mmap_ in self._mmaps.values():
+                mmap_.close()
+
+            self._mmaps.clear()
+
+
+class LogStructuredKVPRecord(DatabaseKVPRecord):
+    '''The record associated with :class:`LogStructuredKVPTable`.'''
+
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self._get_field('length')
+
+
 class ReadOnlyTableError(Exception):
     '''This error is raised when the table does support storing values.'''
     pass
@@ -420,7 +1095,6 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
         KVPTable.__init__(self)
         self._path = path
         self._shared_directories = []
-        self._create_tables()
 
     def _create_tables(self):
         with self.connection() as con:
@@ -443,6 +1117,14 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
                 'FOREIGN KEY (file_id) REFERENCES files (id)'
                 'ON DELETE CASCADE'
                 ')')
+            con.execute('CREATE TABLE IF NOT EXISTS tree_nodes ('
+                'hash_id BLOB PRIMARY KEY,'
+                'file_id INTEGER NOT NULL,'
+                'data BLOB NOT NULL,'
+                'last_update INTEGER DEFAULT 0,'
+                'FOREIGN KEY (file_id) REFERENCES files (id)'
+                'ON DELETE CASCADE'
+                ')')
             con.execute('CREATE TABLE IF NOT EXISTS collections ('
                 'file_id INTEGER PRIMARY KEY,'
                 'type INTEGER NOT NULL,'
@@ -465,7 +1147,7 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
         return False
 
     def indices(self, key):
-        if self._contains_part(key):
+        if self._contains_part(key) or self._contains_tree_node(key):
             yield key
 
         for i in self._file_hash_index(key):
@@ -473,13 +1155,14 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
 
     def _file_hash_index(self, key):
         for row in self.iter_query('SELECT `index` FROM files '
-        'WHERE key = ?', (key,)):
+        'WHERE key = ? LIMIT {} OFFSET {}', (key,)):
 
             yield KeyBytes(row['index'])
 
     def _contains(self, kvpid):
         if kvpid.key == kvpid.index:
-            return self._contains_part(kvpid.key)
+            return self._contains_part(kvpid.key) \
+                or self._contains_tree_node(kvpid.key)
 
         return self._contains_file_hash_info(kvpid)
 
@@ -492,6 +1175,15 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
             if row:
                 return True
 
+    def _contains_tree_node(self, key):
+        with self.connection() as con:
+            cur = con.execute('SELECT 1 FROM tree_nodes WHERE '
+                'hash_id = ? ', (key,))
+            row = cur.fetchone()
+
+            if row:
+                return True
+
     def _contains_file_hash_info(self, kvpid):
         with self.connection() as con:
             cur = con.execute('SELECT 1 FROM files WHERE '
@@ -502,7 +1194,8 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
                 return True
 
     def keys(self):
-        return itertools.chain(self._parts_keys(), self._files_keys())
+        return itertools.chain(self._parts_keys(), self._tree_nodes_keys(),
+            self._files_keys())
 
     def _parts_keys(self):
         query = 'SELECT hash_id FROM parts LIMIT {} OFFSET {}'
@@ -510,6 +1203,12 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
         for row in self.iter_query(query):
             yield KVPID(KeyBytes(row[0]), KeyBytes(row[0]))
 
+    def _tree_nodes_keys(self):
+        query = 'SELECT hash_id FROM tree_nodes LIMIT {} OFFSET {}'
+
+        for row in self.iter_query(query):
+            yield KVPID(KeyBytes(row[0]), KeyBytes(row[0]))
+
     def _files_keys(self):
         query = 'SELECT key, `index` FROM files LIMIT {} OFFSET {}'
 
@@ -530,15 +1229,34 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
                 'ON parts.file_id = files.id '
                 'WHERE hash_id = ?', (key,))
 
-            filename, offset, part_size = cur.fetchone()
+            row = cur.fetchone()
+
+            if not row:
+                return self._get_tree_node(con, key)
+
+            filename, offset, part_size = row
 
         with open(filename, 'rb') as f:
             f.seek(offset)
 
             return f.read(part_size)
 
+    def _get_tree_node(self, con, key):
+        cur = con.execute('SELECT data FROM tree_nodes '
+            'WHERE hash_id = ? LIMIT 1', (key,))
+
+        for row in cur:
+            return row['data']
+
+        raise IndexError('Not found')
+
     def file_hash_info(self, kvpid):
-        return FileInfo.from_bytes(self._get_file_hash_info(kvpid))
+        '''Return the file info.
+
+        :rtype: :class:`.FileInfo`, :class:`.TreeFileInfo`
+        '''
+
+        return file_info_from_bytes(self._get_file_hash_info(kvpid))
 
     def _get_file_hash_info(self, kvpid):
         with self.connection() as con:
@@ -559,6 +1277,9 @@ class SharedFilesKVPTable(KVPTable, SQLite3Mixin):
 
     def record(self, kvpid):
         if kvpid.key == kvpid.index:
+            if self._contains_tree_node(kvpid.key):
+                return SharedTreeNodeRecord(self, kvpid)
+
             return SharedFilesRecord(self, kvpid)
         else:
             return SharedFileHashRecord(self, kvpid)
@@ -678,6 +1399,30 @@ class SharedFilesRecord(KVPRecord):
         self._save_field('last_update', seconds)
 
 
+class SharedTreeNodeRecord(SharedFilesRecord):
+    '''The record associated with :class:`SharedFilesKVPTable`.
+
+    This record describes a hash tree node of a large file.
+    '''
+
+    __slots__ = ()
+
+    def _get_field(self, name):
+        with self._table.connection() as con:
+            cur = con.execute('SELECT {} FROM tree_nodes '
+                'WHERE hash_id = ?'.format(name),
+                (self._kvpid.key,))
+
+            for row in cur:
+                return row[0]
+
+    def _save_field(self, name, value):
+        with self._table.connection() as con:
+            con.execute('UPDATE tree_nodes SET {} = ? '
+                'WHERE hash_id = ?'.format(name),
+                (value, self._kvpid.key))
+
+
 class SharedFileHashRecord(KVPRecord):
     '''The record associated with :class:`SharedFilesKVPTable`.
 
@@ -765,6 +1510,10 @@ class SharedFilesHashTask(Task):
 
     :ivar progress: a tuple (`str`, `int`) describing the filename and bytes
         read.
+
+    Files with more than :attr:`.FileInfo.MAX_PART_HASHES` parts are
+    described with a :class:`.TreeFileInfo`. The tree is built while the file
+    is read and its nodes are stored in the table to be published.
     '''
 
     FILTERS = ('*.bytestag-incomplete',)
@@ -802,18 +1551,20 @@ class SharedFilesHashTask(Task):
         self._table = table
         self._part_size = part_size
 
-        for directory in table.shared_directories:
-            if not self.is_running:
-                return
-
-            self._hash_directory(directory, filters)
+        try:
+            for directory in table.shared_directories:
+                if not self.is_running:
+                    return
 
-        if not table.shared_directories:
-            _logger.info('No directories to hash')
+                self._hash_directory(directory, filters)
 
-        self._clean_database()
+            if not table.shared_directories:
+                _logger.info('No directories to hash')
 
-        self._table.value_changed_observer(None)
+            self._clean_database()
+        finally:
+            # Files may have been removed or rehashed even if stopped early.
+            self._table.value_changed_observer(None)
 
     def _hash_directory(self, directory, filters):
         _logger.info('Hashing directory %s', directory)
@@ -849,6 +1600,8 @@ class SharedFilesHashTask(Task):
 
         whole_file_hasher = hashlib.sha1()
         hashes = []
+        tree_nodes = []
+        tree_builder = HashTreeBuilder(node_callback=tree_nodes.append)
 
         with open(path, 'rb') as f:
             while True:
@@ -865,10 +1618,18 @@ class SharedFilesHashTask(Task):
                 whole_file_hasher.update(data)
                 part_hasher = hashlib.sha1(data)
                 hashes.append(part_hasher.digest())
+                tree_builder.add_part_hash(hashes[-1])
 
         file_hash = whole_file_hasher.digest()
-        file_hash_info = FileInfo(file_hash, hashes)
-        index = hashlib.sha1(file_hash_info.to_bytes()).digest()
+
+        if len(hashes) > FileInfo.MAX_PART_HASHES:
+            file_hash_info = tree_builder.finish(file_hash)
+        else:
+            file_hash_info = FileInfo(file_hash, hashes)
+            tree_nodes = ()
+
+        file_hash_info_bytes = file_hash_info.to_binary_bytes()
+        index = hashlib.sha1(file_hash_info_bytes).digest()
 
         with self._table.connection() as con:
             cur = con.execute('INSERT INTO files '
@@ -876,7 +1637,7 @@ class SharedFilesHashTask(Task):
                 'file_hash_info) '
                 'VALUES (?, ? , ? , ? , ?, ?, ?)', (file_hash, index,
                     size, mtime, self._part_size, path,
-                    file_hash_info.to_bytes()))
+                    file_hash_info_bytes))
 
             row_id = cur.lastrowid
 
@@ -892,6 +1653,14 @@ class SharedFilesHashTask(Task):
                 except sqlite3.IntegrityError:
                     _logger.exception('Possible duplicate')
 
+            for tree_node in tree_nodes:
+                try:
+                    con.execute('INSERT INTO tree_nodes '
+                        '(hash_id, file_id, data) VALUES (?, ?, ?)',
+                        (tree_node.key, row_id, tree_node.to_bytes()))
+                except sqlite3.IntegrityError:
+                    _logger.exception('Possible duplicate')
+
             collection_type = self._get_collection_type(path)
 
             if collection_type:
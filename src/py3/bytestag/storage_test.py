@@ -1,7 +1,10 @@
 
+from bytestag.dht.hashtree import HashTreeVerifier
+from bytestag.dht.models import FileInfo, TreeFileInfo
 from bytestag.keys import KeyBytes
 from bytestag.storage import (MemoryKVPTable, DatabaseKVPTable,
-    SharedFilesKVPTable)
+    SharedFilesKVPTable, SharedFilesHashTask, LogStructuredKVPTable,
+    DistanceEvictionPolicy, ExpiryEvictionPolicy)
 from bytestag.tables import KVPID
 import bytestag.storage
 import hashlib
@@ -11,6 +14,7 @@ import random
 import tempfile
 import time
 import unittest
+import unittest.mock
 
 
 _logger = logging.getLogger(__name__)
@@ -77,6 +81,43 @@ class TableMixin(object):
 
         self.assertFalse(kvpid in kvp_table)
 
+    def table_index_range(self, kvp_table):
+        key = KeyBytes()
+
+        for size in range(1, 11):
+            value = os.urandom(size)
+            kvpid = KVPID(key, KeyBytes.new_hash(value))
+            kvp_table[kvpid] = value
+            kvp_table.record(kvpid).timestamp = 1000 + size
+
+        kvp_table[KVPID(KeyBytes(), KeyBytes.new_hash(b'other'))] = b'other'
+
+        self.assertEqual(10, kvp_table.count_indices(key))
+
+        summaries = kvp_table.index_range(key)
+        indices = [summary.index for summary in summaries]
+
+        self.assertEqual(sorted(indices), indices)
+        self.assertEqual(10, len(summaries))
+
+        first_page = kvp_table.index_range(key, limit=4)
+        second_page = kvp_table.index_range(key,
+            after_index=first_page[-1].index, limit=4)
+
+        self.assertEqual(summaries[:4], first_page)
+        self.assertEqual(summaries[4:8], second_page)
+
+        summaries = kvp_table.index_range(key, min_size=3, max_size=5)
+
+        self.assertEqual([3, 4, 5],
+            sorted(summary.size for summary in summaries))
+
+        summaries = kvp_table.index_range(key, limit=2, newest=True)
+
+        self.assertEqual([10, 9], [summary.size for summary in summaries])
+        self.assertEqual([1010, 1009],
+            [summary.timestamp for summary in summaries])
+
 
 class TestMemoryKVPTable(unittest.TestCase, TableMixin):
     def test_store_get(self):
@@ -87,6 +128,11 @@ class TestMemoryKVPTable(unittest.TestCase, TableMixin):
 
         self.table_store_get(data, kvp_table)
 
+    def test_index_range(self):
+        '''It should return pages of the indices of a key'''
+
+        self.table_index_range(MemoryKVPTable())
+
 
 class TestDatabaseKVPTable(unittest.TestCase, TableMixin):
     def test_store_get(self):
@@ -99,6 +145,233 @@ class TestDatabaseKVPTable(unittest.TestCase, TableMixin):
 
         self.table_store_get(data, kvp_table)
 
+    def test_index_range(self):
+        '''It should return pages of the indices of a key'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+
+        self.table_index_range(DatabaseKVPTable(path))
+
+    def populate(self, kvp_table, count=10, size=100):
+        kvpids = []
+
+        for dummy in range(count):
+            value = os.urandom(size)
+            kvpid = KVPID(KeyBytes(), KeyBytes.new_hash(value))
+            kvp_table[kvpid] = value
+            kvpids.append(kvpid)
+
+        return kvpids
+
+    def test_used_size(self):
+        '''It should track the size of the values'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = DatabaseKVPTable(path)
+        kvpids = self.populate(kvp_table)
+
+        self.assertEqual(1000, kvp_table.used_size)
+
+        del kvp_table[kvpids[0]]
+
+        self.assertEqual(900, kvp_table.used_size)
+        self.assertEqual(900, DatabaseKVPTable(path).used_size)
+
+    def test_table_name(self):
+        '''It should keep tables with different names in one file apart'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table_1 = DatabaseKVPTable(path, table_name='node_1')
+        kvp_table_2 = DatabaseKVPTable(path, table_name='node_2')
+        kvpids = self.populate(kvp_table_1, count=3)
+
+        self.assertEqual(300, kvp_table_1.used_size)
+        self.assertEqual(0, kvp_table_2.used_size)
+        self.assertIn(kvpids[0], kvp_table_1)
+        self.assertNotIn(kvpids[0], kvp_table_2)
+
+        self.assertRaises(ValueError, DatabaseKVPTable, path,
+            table_name='node; DROP TABLE kvps')
+
+    def test_open_on_first_use(self):
+        '''It should not open the database until it is used'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = DatabaseKVPTable(path)
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(0, kvp_table.used_size)
+        self.assertTrue(os.path.exists(path))
+
+    def test_evict_lru(self):
+        '''It should accept stores when full and evict least recently used'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = DatabaseKVPTable(path)
+        kvpids = self.populate(kvp_table)
+        kvp_table._wake_evictor = lambda: None
+
+        with kvp_table.connection() as con:
+            con.execute('UPDATE kvps SET last_access = 1')
+
+        kvp_table[kvpids[0]]
+        kvp_table.max_size = 500
+
+        self.assertTrue(kvp_table.is_acceptable(
+            KVPID(KeyBytes(), KeyBytes()), 100, 123))
+
+        kvp_table.evict()
+
+        self.assertLessEqual(kvp_table.used_size, 500 * 0.9)
+        self.assertIn(kvpids[0], kvp_table)
+
+    def test_evict_distance(self):
+        '''It should evict the keys farthest from the node first'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        node_id = KeyBytes()
+        kvp_table = DatabaseKVPTable(path,
+            eviction_policy=DistanceEvictionPolicy(node_id))
+        kvp_table._wake_evictor = lambda: None
+        kvpids = self.populate(kvp_table)
+        kvpids.sort(key=lambda kvpid: kvpid.key.distance_int(node_id))
+
+        kvp_table.max_size = 600
+        kvp_table.evict()
+
+        for kvpid in kvpids[:5]:
+            self.assertIn(kvpid, kvp_table)
+
+        for kvpid in kvpids[5:]:
+            self.assertNotIn(kvpid, kvp_table)
+
+    def test_evict_expiry(self):
+        '''It should evict the keys that expire soonest and keep originals'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = DatabaseKVPTable(path,
+            eviction_policy=ExpiryEvictionPolicy())
+        kvp_table._wake_evictor = lambda: None
+        kvpids = self.populate(kvp_table)
+
+        for i, kvpid in enumerate(kvpids):
+            record = kvp_table.record(kvpid)
+            record.timestamp = 1000
+            record.time_to_live = i
+
+        kvp_table.record(kvpids[0]).is_original = True
+        kvp_table.max_size = 600
+        kvp_table.evict()
+
+        self.assertIn(kvpids[0], kvp_table)
+
+        for kvpid in kvpids[1:6]:
+            self.assertNotIn(kvpid, kvp_table)
+
+        for kvpid in kvpids[6:]:
+            self.assertIn(kvpid, kvp_table)
+
+    def test_background_evict(self):
+        '''It should evict in the background when full'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = DatabaseKVPTable(path, max_size=500)
+
+        self.populate(kvp_table)
+
+        for dummy in range(100):
+            if kvp_table.used_size <= 500:
+                break
+
+            time.sleep(0.05)
+
+        self.assertLessEqual(kvp_table.used_size, 500)
+
+
+class TestLogStructuredKVPTable(unittest.TestCase, TableMixin):
+    def test_store_get(self):
+        '''It should store and get'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        data = b'kitteh' * 100
+        kvp_table = LogStructuredKVPTable(path, compact_interval=None)
+
+        self.table_store_get(data, kvp_table)
+        kvp_table.close()
+
+    def test_index_range(self):
+        '''It should return pages of the indices of a key'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = LogStructuredKVPTable(path, compact_interval=None)
+
+        self.table_index_range(kvp_table)
+        kvp_table.close()
+
+    def test_overwrite(self):
+        '''It should return the latest value across segments'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = LogStructuredKVPTable(path, segment_size=100,
+            compact_interval=None)
+        data = b'kitteh' * 10
+        kvpid = KVPID(KeyBytes(), KeyBytes.new_hash(data))
+
+        for dummy in range(10):
+            kvp_table[kvpid] = data
+
+            self.assertEqual(data, kvp_table[kvpid])
+
+        self.assertEqual(len(data), kvp_table.record(kvpid).size)
+        self.assertEqual(10, len(kvp_table.segment_usage()))
+        kvp_table.close()
+
+        kvp_table = LogStructuredKVPTable(path, compact_interval=None)
+
+        self.assertEqual(data, kvp_table[kvpid])
+        kvp_table.close()
+
+    def test_compact(self):
+        '''It should reclaim the space of deleted values'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = LogStructuredKVPTable(path, segment_size=1000,
+            compact_interval=None)
+        values = [os.urandom(200) for dummy in range(20)]
+        kvpids = [KVPID(KeyBytes(), KeyBytes.new_hash(value))
+            for value in values]
+
+        for kvpid, value in zip(kvpids, values):
+            kvp_table[kvpid] = value
+
+        num_segments = len(kvp_table.segment_usage())
+
+        for kvpid in kvpids[::2]:
+            del kvp_table[kvpid]
+
+        self.assertTrue(kvp_table.compact())
+        self.assertLess(len(kvp_table.segment_usage()), num_segments)
+
+        for kvpid, value in zip(kvpids[1::2], values[1::2]):
+            self.assertEqual(value, kvp_table[kvpid])
+
+        for kvpid in kvpids[::2]:
+            self.assertNotIn(kvpid, kvp_table)
+
+        kvp_table.close()
+
 
 class TestSharedFilesKVPTable(unittest.TestCase, TableMixin):
     def create_file(self, path):
@@ -186,3 +459,46 @@ class TestSharedFilesKVPTable(unittest.TestCase, TableMixin):
             hash_ = hashlib.sha1(filename.encode()).digest()
             self.assertNotIn(KVPID(KeyBytes(hash_), KeyBytes(hash_)),
                 kvp_table)
+
+    def test_hash_tree(self):
+        '''It should describe large files with a hash tree'''
+
+        shared_dir = tempfile.TemporaryDirectory()
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'test.db')
+        kvp_table = SharedFilesKVPTable(path)
+        part_size = 16
+        data = os.urandom(part_size * 20 + 5)
+        file_hash = KeyBytes(hashlib.sha1(data).digest())
+
+        kvp_table.shared_directories.append(shared_dir.name)
+
+        with open(os.path.join(shared_dir.name, 'big.bin'), 'wb') as f:
+            f.write(data)
+
+        with unittest.mock.patch.object(FileInfo, 'MAX_PART_HASHES', 10):
+            task = SharedFilesHashTask(kvp_table, part_size)
+            task()
+
+        index = list(kvp_table.indices(file_hash))[0]
+        info = kvp_table.file_hash_info(KVPID(file_hash, index))
+
+        self.assertIsInstance(info, TreeFileInfo)
+        self.assertEqual(21, info.num_parts)
+
+        def fetch_fn(key):
+            return kvp_table[KVPID(key, key)]
+
+        verifier = HashTreeVerifier(info, fetch_fn)
+
+        for part_number in range(info.num_parts):
+            offset = part_number * part_size
+            part_data = data[offset:offset + part_size]
+
+            self.assertTrue(verifier.verify_part(part_number, part_data))
+
+        root_kvpid = KVPID(info.root_hash, info.root_hash)
+
+        self.assertIn(root_kvpid, kvp_table)
+        self.assertIn(root_kvpid, list(kvp_table.keys()))
+        self.assertFalse(kvp_table.record(root_kvpid).last_update)
@@ -4,13 +4,20 @@
 # Licensed under GNU GPLv3. See COPYING.txt for details.
 from bytestag.events import Observer
 from bytestag.keys import KeyBytes
+from bytestag.metrics import default_registry
 import abc
 import collections
 import itertools
 import logging
+import threading
 
 __docformat__ = 'restructuredtext en'
 _logger = logging.getLogger(__name__)
+_value_cache_hits = default_registry().counter(
+    'bytestag_value_cache_hits_total', 'Values read from the value cache')
+_value_cache_misses = default_registry().counter(
+    'bytestag_value_cache_misses_total',
+    'Values not in the value cache and read from a table')
 
 
 class KVPID(collections.namedtuple('KVPID', ['key', 'index'])):
@@ -26,6 +33,26 @@ class KVPID(collections.namedtuple('KVPID', ['key', 'index'])):
         return '<KVPID {}:{}>'.format(self.key.base16, self.index.base16)
 
 
+class KVPSummary(collections.namedtuple('KVPSummary',
+['key', 'index', 'size', 'timestamp'])):
+    '''The size and timestamp of a key-value pair without its value.
+
+    :see: :func:`KVPTable.index_range`
+    '''
+
+    __slots__ = ()
+
+
+def sort_summaries(summaries, newest=False):
+    '''Return the :class:`KVPSummary` sorted by index or newest first.'''
+
+    if newest:
+        return sorted(summaries,
+            key=lambda summary: (-(summary.timestamp or 0), summary.index))
+
+    return sorted(summaries, key=lambda summary: summary.index)
+
+
 class KVPTable(metaclass=abc.ABCMeta):
     '''A base class for key-value tables.
 
@@ -122,6 +149,47 @@ class KVPTable(metaclass=abc.ABCMeta):
 
         return l
 
+    def count_indices(self, key):
+        '''Return the number of indices associated with the key.
+
+        :rtype: :obj:`int`
+        '''
+
+        return sum(1 for dummy in self.indices(key))
+
+    def index_range(self, key, after_index=None, limit=None, min_size=None,
+    max_size=None, newest=False):
+        '''Return the key-value pairs of a key in order of index.
+
+        :param after_index: If given, only indices greater than this
+            :class:`.KeyBytes` are returned.
+        :param limit: The maximum number of key-value pairs returned.
+        :param min_size: If given, smaller values are skipped.
+        :param max_size: If given, larger values are skipped.
+        :param newest: If ``True``, the key-value pairs are returned newest
+            timestamp first instead.
+
+        :rtype: :obj:`list`
+        :returns: a list of :class:`KVPSummary`
+        '''
+
+        summaries = []
+
+        for index in self.indices(key):
+            if after_index is not None and index <= after_index:
+                continue
+
+            record = self.record(KVPID(key, index))
+            size = record.size
+
+            if min_size is not None and size < min_size \
+            or max_size is not None and size > max_size:
+                continue
+
+            summaries.append(KVPSummary(key, index, size, record.timestamp))
+
+        return sort_summaries(summaries, newest)[:limit]
+
     @abc.abstractmethod
     def is_acceptable(self, kvpid, size, timestamp):
         '''Return whether the table accepts adding new keys.
@@ -216,18 +284,112 @@ class KVPRecord(metaclass=abc.ABCMeta):
         pass
 
 
+class ValueCache(object):
+    '''A least recently used cache of values limited by their total size.
+
+    This class is thread-safe.
+    '''
+
+    MAX_SIZE = 2 ** 25  # bytes
+
+    def __init__(self, max_size=MAX_SIZE):
+        '''
+        :param max_size: The maximum total size of the values. Larger
+            values are not cached.
+        '''
+
+        self._max_size = max_size
+        self._size = 0
+        self._values = collections.OrderedDict()  # kvpid → value
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, kvpid):
+        return kvpid in self._values
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        '''The total size of the cached values.'''
+
+        return self._size
+
+    def get(self, kvpid):
+        '''Return the value or ``None`` if it is not cached.'''
+
+        with self._lock:
+            value = self._values.get(kvpid)
+
+            if value is None:
+                _value_cache_misses.inc()
+                return
+
+            self._values.move_to_end(kvpid)
+
+        _value_cache_hits.inc()
+
+        return value
+
+    def put(self, kvpid, value):
+        if len(value) > self._max_size:
+            return
+
+        with self._lock:
+            old_value = self._values.pop(kvpid, None)
+
+            if old_value is not None:
+                self._size -= len(old_value)
+
+            self._values[kvpid] = value
+            self._size += len(value)
+
+            while self._size > self._max_size:
+                dummy, old_value = self._values.popitem(last=False)
+                self._size -= len(old_value)
+
+    def discard(self, kvpid):
+        '''Remove the value. If `kvpid` is ``None``, remove all values.'''
+
+        with self._lock:
+            if kvpid is None:
+                self._values.clear()
+                self._size = 0
+                return
+
+            old_value = self._values.pop(kvpid, None)
+
+            if old_value is not None:
+                self._size -= len(old_value)
+
+
 class AggregatedKVPTable(KVPTable):
-    '''Combines several :class:`KVPTable`'''
+    '''Combines several :class:`KVPTable`
+
+    Values read are kept in a :class:`ValueCache` so values served to many
+    nodes are read from the tables once. Values are removed from the cache
+    when the tables report them changed.
+    '''
 
-    def __init__(self, primary_table, tables):
+    def __init__(self, primary_table, tables, value_cache=None):
         '''
         :param primary_table: The table where values are set.
         :param tables: A list of tables which are generally read-only.
+        :param value_cache: A :class:`ValueCache`. If ``None``, a new one
+            is created.
         '''
 
         KVPTable.__init__(self)
         self._tables = tuple(tables)
         self._primary_table = primary_table
+        self._value_cache = value_cache if value_cache is not None \
+            else ValueCache()
+
+        self.value_changed_observer.register(self._value_cache.discard)
 
         for table in tables:
             table.value_changed_observer.register(self.value_changed_observer)
@@ -236,6 +398,12 @@ class AggregatedKVPTable(KVPTable):
     def tables(self):
         return self._tables
 
+    @property
+    def value_cache(self):
+        '''The :class:`ValueCache`'''
+
+        return self._value_cache
+
     @property
     def primary_table(self):
         return self._primary_table
@@ -252,9 +420,19 @@ class AggregatedKVPTable(KVPTable):
         return False
 
     def _getitem(self, kvpid):
+        value = self._value_cache.get(kvpid)
+
+        if value is not None:
+            return value
+
         for table in self._tables:
             if kvpid in table:
-                return table[kvpid]
+                value = table[kvpid]
+
+                if value is not None:
+                    self._value_cache.put(kvpid, value)
+
+                return value
 
         raise IndexError()
 
@@ -287,13 +465,30 @@ class AggregatedKVPTable(KVPTable):
 
         for table in self._tables:
             for index in table.indices(key):
-                _logger.debug('asdfsfasdf %s:%s', key, index)
                 record = self.record(KVPID(key, index))
                 assert record
                 l.append(record)
 
         return l
 
+    def count_indices(self, key):
+        if len(self._tables) == 1:
+            return self._tables[0].count_indices(key)
+
+        # An index may be in several tables.
+        return len(set(self.indices(key)))
+
+    def index_range(self, key, after_index=None, limit=None, min_size=None,
+    max_size=None, newest=False):
+        summaries = {}
+
+        for table in reversed(self._tables):
+            for summary in table.index_range(key, after_index, limit,
+            min_size, max_size, newest):
+                summaries[summary.index] = summary
+
+        return sort_summaries(summaries.values(), newest)[:limit]
+
     def is_acceptable(self, kvpid, size, timestamp):
         if kvpid not in self:
             return self._primary_table.is_acceptable(kvpid, size, timestamp)
@@ -0,0 +1,132 @@
+from bytestag.keys import KeyBytes
+from bytestag.storage import MemoryKVPTable, DatabaseKVPTable
+from bytestag.tables import KVPID, ValueCache, AggregatedKVPTable
+import os.path
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+
+def new_kvpid(value):
+    return KVPID(KeyBytes(), KeyBytes.new_hash(value))
+
+
+class TestValueCache(unittest.TestCase):
+    def test_size_limit(self):
+        '''It should drop the least recently used values when full'''
+
+        cache = ValueCache(max_size=10)
+        kvpids = [new_kvpid(bytes([i])) for i in range(3)]
+
+        cache.put(kvpids[0], b'aaaa')
+        cache.put(kvpids[1], b'bbbb')
+        cache.get(kvpids[0])
+        cache.put(kvpids[2], b'cccc')
+
+        self.assertEqual(b'aaaa', cache.get(kvpids[0]))
+        self.assertIsNone(cache.get(kvpids[1]))
+        self.assertEqual(b'cccc', cache.get(kvpids[2]))
+        self.assertEqual(8, cache.size)
+
+        cache.put(kvpids[1], b'x' * 11)
+
+        self.assertNotIn(kvpids[1], cache)
+
+    def test_discard(self):
+        '''It should remove one value or all values'''
+
+        cache = ValueCache()
+        kvpids = [new_kvpid(bytes([i])) for i in range(2)]
+
+        cache.put(kvpids[0], b'aaaa')
+        cache.put(kvpids[1], b'bbbb')
+        cache.discard(kvpids[0])
+
+        self.assertEqual([False, True], [kvpid in cache for kvpid in kvpids])
+        self.assertEqual(4, cache.size)
+
+        cache.discard(None)
+
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.size)
+
+
+class TestAggregatedKVPTable(unittest.TestCase):
+    def test_value_cache(self):
+        '''It should read a value from the tables once until it changes'''
+
+        primary_table = MemoryKVPTable()
+        other_table = MemoryKVPTable()
+        kvp_table = AggregatedKVPTable(primary_table,
+            [primary_table, other_table])
+        value = b'kitteh'
+        kvpid = new_kvpid(value)
+        other_table[kvpid] = value
+
+        with unittest.mock.patch.object(other_table, '_getitem',
+        wraps=other_table._getitem) as getitem:
+            for dummy in range(3):
+                self.assertEqual(value, kvp_table[kvpid])
+
+            self.assertEqual(1, getitem.call_count)
+
+        self.assertIn(kvpid, kvp_table.value_cache)
+
+        del other_table[kvpid]
+
+        self.assertNotIn(kvpid, kvp_table.value_cache)
+        self.assertNotIn(kvpid, kvp_table)
+
+    def test_value_cache_clean(self):
+        '''It should forget cached values removed by cleaning expired
+        values'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        cache_table = DatabaseKVPTable(os.path.join(temp_dir.name, 'test.db'))
+        kvp_table = AggregatedKVPTable(cache_table, [cache_table])
+        value = b'kitteh'
+        kvpid = new_kvpid(value)
+        timestamp = int(time.time()) - 100
+
+        kvp_table[kvpid] = value
+        kvp_table.record(kvpid).timestamp = timestamp
+        kvp_table.record(kvpid).time_to_live = 10
+
+        self.assertEqual(value, kvp_table[kvpid])
+        self.assertIn(kvpid, kvp_table.value_cache)
+
+        cache_table.clean()
+
+        self.assertNotIn(kvpid, kvp_table.value_cache)
+        self.assertNotIn(kvpid, kvp_table)
+        self.assertTrue(kvp_table.is_acceptable(kvpid, len(value), timestamp))
+
+    def test_contains_asks_tables(self):
+        '''It should not report a value only because it is cached'''
+
+        table = MemoryKVPTable()
+        kvp_table = AggregatedKVPTable(table, [table])
+        value = b'kitteh'
+        kvpid = new_kvpid(value)
+
+        kvp_table.value_cache.put(kvpid, value)
+
+        self.assertNotIn(kvpid, kvp_table)
+
+    def test_count_indices(self):
+        '''It should count an index in several tables once'''
+
+        tables = [MemoryKVPTable(), MemoryKVPTable()]
+        kvp_table = AggregatedKVPTable(tables[0], tables)
+        key = KeyBytes()
+
+        for value in (b'a', b'b'):
+            for table in tables:
+                table[KVPID(key, KeyBytes.new_hash(value))] = value
+
+        tables[1][KVPID(key, KeyBytes.new_hash(b'c'))] = b'c'
+
+        self.assertEqual(3, kvp_table.count_indices(key))
+        self.assertEqual(3, len(kvp_table.index_range(key)))
@@ -0,0 +1,382 @@
+'''Running one node in several processes
+
+A :class:`WorkerPool` starts worker processes that bind the same UDP port
+with ``SO_REUSEPORT``. The kernel spreads the incoming datagrams over them
+so decoding and handling RPCs is not limited to one interpreter. All
+workers use the same node ID and the same cache database.
+
+The kernel sends all datagrams of a peer to the same worker, but that
+worker may not be the one that sent the request being answered. Sequence
+and transfer IDs carry the number of the worker that made them, so replies
+and transfers are passed to that worker. New contacts are passed to every
+worker so the routing tables stay alike.
+'''
+# This file is part of Bytestag.
+# Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
+# Licensed under GNU GPLv3. See COPYING.txt for details.
+from bytestag.dht.network import DHTNetwork
+from bytestag.dht.publishing import Publisher, Replicator
+from bytestag.dht.tables import Node
+from bytestag.events import EventReactor, EventID, FnTaskSlot
+from bytestag.keys import KeyBytes, bytes_to_b64
+from bytestag.network import Network, UDPTransport, JSONKeys
+from bytestag.storage import DatabaseKVPTable, DistanceEvictionPolicy
+import base64
+import binascii
+import functools
+import logging
+import multiprocessing
+import os.path
+import queue
+import socket
+import threading
+
+__docformat__ = 'restructuredtext en'
+_logger = logging.getLogger(__name__)
+
+
+class Messages(object):
+    '''Kinds of messages sent between workers'''
+
+    PACKET = 'packet'
+    CONTACT = 'contact'
+    STOP = 'stop'
+
+
+class WorkerChannels(object):
+    '''Queues for passing messages between workers.
+
+    Each worker reads its own queue and puts messages on the queues of the
+    others.
+    '''
+
+    def __init__(self, worker_index, queues):
+        '''
+        :param worker_index: The number of this worker.
+        :param queues: A list of :class:`multiprocessing.Queue` with one
+            queue for each worker.
+        '''
+
+        self._worker_index = worker_index
+        self._queues = queues
+
+    @property
+    def worker_index(self):
+        return self._worker_index
+
+    @property
+    def num_workers(self):
+        return len(self._queues)
+
+    def send(self, worker_index, *message):
+        self._queues[worker_index].put(message)
+
+    def broadcast(self, *message):
+        '''Send the message to every other worker.'''
+
+        for worker_index in range(len(self._queues)):
+            if worker_index != self._worker_index:
+                self._queues[worker_index].put(message)
+
+    def get(self, timeout=None):
+        '''Return the next message for this worker.
+
+        :raise queue.Empty: No message arrived in time.
+        '''
+
+        return self._queues[self._worker_index].get(timeout=timeout)
+
+    def tag_id_bytes(self, id_bytes):
+        '''Return the ID with its first byte changed to identify this
+        worker.'''
+
+        id_bytes = bytearray(id_bytes)
+        range_size = 256 // self.num_workers
+        id_bytes[0] = (id_bytes[0] % range_size) * self.num_workers \
+            + self._worker_index
+
+        return bytes(id_bytes)
+
+    def owner_of(self, id_str):
+        '''Return the number of the worker that made the ID.
+
+        IDs that were not made by a worker belong to this worker.
+        '''
+
+        try:
+            id_bytes = base64.b64decode(id_str.encode())
+        except (AttributeError, binascii.Error):
+            return self._worker_index
+
+        if not id_bytes:
+            return self._worker_index
+
+        return id_bytes[0] % self.num_workers
+
+
+class ShardedNetwork(Network):
+    '''A :class:`.Network` sharing its port with other workers.'''
+
+    def __init__(self, event_reactor, address, channels, **kwargs):
+        '''
+        :param channels: The :class:`WorkerChannels` of this worker.
+        '''
+
+        Network.__init__(self, event_reactor, address,
+            transport=functools.partial(UDPTransport, reuse_port=True),
+            **kwargs)
+        self._channels = channels
+        self._forwarded_event_id = EventID(self, 'Forwarded packet')
+
+        self.event_reactor.register_handler(self._forwarded_event_id,
+            self._forwarded_callback)
+
+    def new_sequence_id(self, address=None):
+        return bytes_to_b64(self._channels.tag_id_bytes(
+            self._new_sequence_id_bytes(address)))
+
+    def new_transfer_id(self):
+        return bytes_to_b64(self._channels.tag_id_bytes(
+            self._new_transfer_id_bytes()))
+
+    def _accept_reply(self, data_packet):
+        if not self._forward(data_packet, data_packet.sequence_id):
+            Network._accept_reply(self, data_packet)
+
+    def _accept_transfer(self, data_packet):
+        if not self._forward(data_packet,
+        data_packet.dict_obj[JSONKeys.TRANSFER_ID]):
+            Network._accept_transfer(self, data_packet)
+
+    def _forward(self, data_packet, id_str):
+        '''Pass the packet to the worker that made the ID.
+
+        :return: ``True`` if the packet belongs to another worker.
+        '''
+
+        owner = self._channels.owner_of(id_str)
+
+        if owner == self._channels.worker_index:
+            return False
+
+        _logger.debug('Forward packet %s→worker %s', data_packet.address,
+            owner)
+        self._channels.send(owner, Messages.PACKET, data_packet)
+
+        return True
+
+    def accept_forwarded(self, data_packet):
+        '''Handle a packet forwarded by another worker.
+
+        This function is thread-safe.
+        '''
+
+        self.event_reactor.put(self._forwarded_event_id, data_packet)
+
+    def _forwarded_callback(self, event_id, data_packet):
+        if not self._running:
+            return
+
+        if JSONKeys.REPLY_SEQUENCE_ID in data_packet.dict_obj:
+            Network._accept_reply(self, data_packet)
+        else:
+            Network._accept_transfer(self, data_packet)
+
+
+class ShardedDHTNetwork(DHTNetwork):
+    '''A :class:`.DHTNetwork` sharing new contacts with other workers.'''
+
+    def __init__(self, *args, channels=None, **kwargs):
+        DHTNetwork.__init__(self, *args, **kwargs)
+        self._channels = channels
+        self._contact_event_id = EventID(self, 'Shared contact')
+
+        self.event_reactor.register_handler(self._contact_event_id,
+            self._shared_contact_callback)
+
+    def _update_routing_table(self, node):
+        is_new = node not in self._routing_table
+
+        DHTNetwork._update_routing_table(self, node)
+
+        if is_new and node in self._routing_table:
+            self._channels.broadcast(Messages.CONTACT, bytes(node.key),
+                node.address)
+
+    def add_shared_contact(self, key, address):
+        '''Add a contact found by another worker.
+
+        This function is thread-safe.
+        '''
+
+        self.event_reactor.put(self._contact_event_id,
+            Node(KeyBytes(key), address))
+
+    def _shared_contact_callback(self, event_id, node):
+        DHTNetwork._update_routing_table(self, node)
+
+
+class Worker(object):
+    '''A DHT node in a worker process.
+
+    Only the first worker publishes and replicates values because the
+    workers share their cache table.
+    '''
+
+    SIZE_REFRESH_INTERVAL = 60  # seconds
+
+    def __init__(self, channels, cache_dir, address, node_id,
+    known_node_address=None, cache_size=2 ** 36):
+        node_id = KeyBytes(node_id)
+        self._channels = channels
+        self._known_node_address = known_node_address
+        self._event_reactor = EventReactor()
+        self._network = ShardedNetwork(self._event_reactor, address,
+            channels)
+        self._kvp_table = DatabaseKVPTable(
+            os.path.join(cache_dir, 'cache.db'), cache_size,
+            eviction_policy=DistanceEvictionPolicy(node_id))
+        self._upload_slot = FnTaskSlot()
+        self._dht_network = ShardedDHTNetwork(self._event_reactor,
+            self._kvp_table, node_id, self._network, FnTaskSlot(),
+            channels=channels)
+
+        if channels.worker_index == 0:
+            self._publisher = Publisher(self._event_reactor,
+                self._dht_network, self._kvp_table, self._upload_slot)
+            self._replicator = Replicator(self._event_reactor,
+                self._dht_network, self._kvp_table, self._upload_slot)
+
+    def run(self):
+        thread = threading.Thread(target=self._channel_loop)
+        thread.daemon = True
+        thread.name = 'worker-channel-{}'.format(self._channels.worker_index)
+        thread.start()
+
+        if self._known_node_address:
+            self._dht_network.bootstrap([self._known_node_address])
+
+        self._event_reactor.start()
+
+    def _channel_loop(self):
+        while True:
+            try:
+                message = self._channels.get(self.SIZE_REFRESH_INTERVAL)
+            except queue.Empty:
+                # Other workers store values in the same table.
+                self._kvp_table.refresh_used_size()
+                continue
+
+            if message[0] == Messages.PACKET:
+                self._network.accept_forwarded(message[1])
+            elif message[0] == Messages.CONTACT:
+                self._dht_network.add_shared_contact(message[1], message[2])
+            elif message[0] == Messages.STOP:
+                self._event_reactor.put(EventReactor.STOP_ID)
+                break
+
+
+def run_worker(worker_index, queues, *args, **kwargs):
+    '''Run a :class:`Worker` until it is stopped.
+
+    This is the target of the worker processes.
+    '''
+
+    Worker(WorkerChannels(worker_index, queues), *args, **kwargs).run()
+
+
+class WorkerPool(object):
+    '''Runs a node in several processes sharing one UDP port.
+
+    ``SO_REUSEPORT`` is needed, so this works on Linux and the BSDs.
+    '''
+
+    def __init__(self, cache_dir, num_workers, address=('0.0.0.0', 0),
+    node_id=None, known_node_address=None, cache_size=2 ** 36):
+        '''
+        :param num_workers: The number of processes. At most 256.
+        :param address: The address shared by the workers. If the port
+            is ``0``, a free port is chosen.
+        '''
+
+        if not 0 < num_workers <= 256:
+            raise ValueError('Number of workers must be from 1 to 256')
+
+        self._cache_dir = cache_dir
+        self._num_workers = num_workers
+        self._address = address
+        self._node_id = node_id or KeyBytes()
+        self._known_node_address = known_node_address
+        self._cache_size = cache_size
+        self._processes = []
+        self._queues = []
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def node_id(self):
+        return self._node_id
+
+    @property
+    def node(self):
+        '''The :class:`.Node` run by the workers.'''
+
+        return Node(self._node_id, self._address)
+
+    @property
+    def processes(self):
+        return self._processes
+
+    def _choose_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self._address)
+
+            return sock.getsockname()[1]
+        finally:
+            sock.close()
+
+    def start(self):
+        '''Start the worker processes.'''
+
+        if not self._address[1]:
+            self._address = (self._address[0], self._choose_port())
+
+        # Spawned processes do not inherit the threads and locks of this one
+        context = multiprocessing.get_context('spawn')
+        self._queues = [context.Queue() for dummy in range(self._num_workers)]
+
+        for worker_index in range(self._num_workers):
+            process = context.Process(target=run_worker,
+                args=(worker_index, self._queues, self._cache_dir,
+                    self._address, bytes(self._node_id)),
+                kwargs=dict(known_node_address=self._known_node_address,
+                    cache_size=self._cache_size),
+                name='bytestag-worker-{}'.format(worker_index))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        _logger.info('Started %d workers on %s', self._num_workers,
+            self._address)
+
+    def stop(self, timeout=5):
+        '''Stop the worker processes.'''
+
+        for queue_ in self._queues:
+            queue_.put((Messages.STOP,))
+
+        for process in self._processes:
+            process.join(timeout)
+
+            if process.is_alive():
+                _logger.warning('Worker %s did not stop', process.name)
+                process.terminate()
+
+    def join(self):
+        for process in self._processes:
+            process.join()
@@ -0,0 +1,175 @@
+from bytestag.dht.network import DHTNetwork
+from bytestag.events import EventReactor
+from bytestag.keys import KeyBytes, bytes_to_b64
+from bytestag.network import DataPacket, JSONKeys, Network
+from bytestag.storage import MemoryKVPTable
+from bytestag.workers import (WorkerChannels, ShardedNetwork, Messages,
+    WorkerPool)
+import hashlib
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestWorkerChannels(unittest.TestCase):
+    def test_ids(self):
+        '''It should make IDs that name the worker that made them'''
+
+        for num_workers in (1, 3, 7, 256):
+            queues = [queue.Queue() for dummy in range(num_workers)]
+
+            for worker_index in range(num_workers):
+                channels = WorkerChannels(worker_index, queues)
+                id_str = bytes_to_b64(channels.tag_id_bytes(
+                    os.urandom(Network.SEQUENCE_ID_SIZE)))
+
+                self.assertEqual(worker_index, channels.owner_of(id_str))
+
+        channels = WorkerChannels(1, [queue.Queue(), queue.Queue()])
+
+        self.assertEqual(1, channels.owner_of('not base64!'))
+        self.assertEqual(1, channels.owner_of(''))
+
+    def test_broadcast(self):
+        '''It should send to every other worker'''
+
+        queues = [queue.Queue() for dummy in range(3)]
+        channels = WorkerChannels(1, queues)
+
+        channels.broadcast(Messages.STOP)
+
+        self.assertEqual((Messages.STOP,), queues[0].get_nowait())
+        self.assertTrue(queues[1].empty())
+        self.assertEqual((Messages.STOP,), queues[2].get_nowait())
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'needs SO_REUSEPORT')
+class TestShardedNetwork(unittest.TestCase):
+    TIMEOUT = 5
+
+    def setUp(self):
+        self.queues = [queue.Queue(), queue.Queue()]
+        self.event_reactors = []
+        self.networks = []
+        address = ('127.0.0.1', 0)
+
+        for worker_index in range(2):
+            event_reactor = EventReactor()
+            thread = threading.Thread(target=event_reactor.start)
+            thread.daemon = True
+            thread.start()
+
+            network = ShardedNetwork(event_reactor, address,
+                WorkerChannels(worker_index, self.queues))
+            address = network.server_address
+
+            self.event_reactors.append(event_reactor)
+            self.networks.append(network)
+
+    def tearDown(self):
+        for event_reactor in self.event_reactors:
+            event_reactor.put(EventReactor.STOP_ID)
+
+    def test_forward_reply(self):
+        '''It should pass replies to the worker that sent the request'''
+
+        sequence_id = self.networks[0].new_sequence_id()
+        data_packet = DataPacket(('127.0.0.1', 1),
+            {JSONKeys.REPLY_SEQUENCE_ID: sequence_id}, sequence_id)
+
+        self.networks[1]._accept_reply(data_packet)
+
+        self.assertEqual((Messages.PACKET, data_packet),
+            self.queues[0].get_nowait())
+        self.assertTrue(self.queues[1].empty())
+
+    def test_reply_on_shared_port(self):
+        '''It should get replies whichever worker receives them'''
+
+        def pump():
+            while True:
+                message = self.queues[0].get()
+
+                if message[0] == Messages.STOP:
+                    break
+
+                self.networks[0].accept_forwarded(message[1])
+
+        thread = threading.Thread(target=pump)
+        thread.daemon = True
+        thread.start()
+
+        event_reactor = EventReactor()
+        er_thread = threading.Thread(target=event_reactor.start)
+        er_thread.daemon = True
+        er_thread.start()
+        peer = Network(event_reactor)
+        peer.receive_callback = lambda data_packet: \
+            peer.send_answer_reply(data_packet, {'pong': True})
+
+        try:
+            for dummy in range(5):
+                task = self.networks[0].send(peer.server_address,
+                    {'ping': True}, self.TIMEOUT)
+
+                self.assertTrue(task.result().dict_obj['pong'])
+        finally:
+            event_reactor.put(EventReactor.STOP_ID)
+            self.queues[0].put((Messages.STOP,))
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'needs SO_REUSEPORT')
+class TestWorkerPool(unittest.TestCase):
+    TIMEOUT = 10
+
+    def test_pool(self):
+        '''It should run one node in several processes'''
+
+        temp_dir = tempfile.TemporaryDirectory()
+        event_reactor = EventReactor()
+        thread = threading.Thread(target=event_reactor.start)
+        thread.daemon = True
+        thread.start()
+
+        nodes = [DHTNetwork(event_reactor, MemoryKVPTable(),
+            network=Network(event_reactor)) for dummy in range(2)]
+        pool = WorkerPool(temp_dir.name, 2, address=('127.0.0.1', 0),
+            known_node_address=nodes[0].address)
+
+        pool.start()
+
+        try:
+            deadline = time.time() + self.TIMEOUT
+
+            while pool.node not in nodes[0].routing_table \
+            and time.time() < deadline:
+                time.sleep(0.1)
+
+            self.assertIn(pool.node, nodes[0].routing_table)
+
+            data = b'kitteh' * 100
+            key = KeyBytes(hashlib.sha1(data).digest())
+
+            task = nodes[0].store_to_node(pool.node, key, key, data,
+                int(time.time()))
+
+            self.assertEqual(len(data), task.result())
+
+            while time.time() < deadline:
+                task = nodes[1].find_value_from_node(pool.node, key)
+                result = task.result()
+
+                if result and result.kvp_info_list:
+                    break
+
+                time.sleep(0.1)
+
+            self.assertEqual(len(data), result.kvp_info_list[0].size)
+        finally:
+            pool.stop()
+            event_reactor.put(EventReactor.STOP_ID)
+            temp_dir.cleanup()
@@ -2,7 +2,6 @@
 # This file is part of Bytestag.
 # Copyright © 2012 Christopher Foo <chris.foo@gmail.com>.
 # Licensed under GNU GPLv3. See COPYING.txt for details.
-import bytestag.lib.pkg_resources
 import bytestagui.views
 import logging
 import os.path
@@ -16,6 +15,8 @@ class Resource(object):
 
     @classmethod
     def get_bytes(cls, name):
+        import bytestag.lib.pkg_resources
+
         try:
             return bytestag.lib.pkg_resources.resource_string(
                 cls.module_name, name)